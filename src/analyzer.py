@@ -1,18 +1,126 @@
+import threading
+from typing import List, Tuple
+
+from java.util import HashMap
 from org.apache.lucene.analysis.core import SimpleAnalyzer, WhitespaceAnalyzer, StopAnalyzer
 from org.apache.lucene.analysis.en import EnglishAnalyzer  # Used as StemAnalyzer for English
+from org.apache.lucene.analysis.miscellaneous import PerFieldAnalyzerWrapper
+from org.apache.lucene.analysis.shingle import ShingleAnalyzerWrapper
 from org.apache.lucene.analysis.standard import StandardAnalyzer
 
-from .stopwords import load_stopwords_spacy, load_lucene_stopwords
+from .config import Config
+from .stopwords import load_stopwords, get_stopwords, stopwords_digest, SPACY_STOPWORDS_FILE
+
+
+# Analyzer of an index with a text field per analyzer, so a single index serves every analyzer
+MULTI_FIELD_ANALYZER = "multi_field"
+# Suffix of the analyzer of an index that also indexes the two-word shingles of every text field
+SHINGLES_SUFFIX = "_shingles"
+
+
+def get_field_name(analyzer_type: str, multi_field: bool = False) -> str:
+    """
+    Return the name of the field holding the text analyzed by an analyzer: text_content, or text_content_<analyzer>
+    in a multi-field index.
+    """
+    return f"text_content_{analyzer_type}" if multi_field else "text_content"
+
+
+def get_shingle_field_name(field: str) -> str:
+    """Return the name of the field holding the two-word shingles of a text field."""
+    return f"{field}{SHINGLES_SUFFIX}"
 
 
 class AnalyzerFactory:
+    # The stopword source of every analyzer type: the built-in Lucene list, a stopword file or None (no stopwords, or
+    # the default stopwords of the Lucene analyzer)
+    STOPWORD_SOURCES = {
+        "simple": None,
+        "standard": "lucene",
+        "whitespace": None,
+        "stop": "lucene",
+        "english": None,
+        "english_spacy": SPACY_STOPWORDS_FILE,
+    }
+    _analyzers = {}  # (analyzer type, stopword source) -> analyzer
+    _lock = threading.RLock()  # the multi-field analyzer gets the analyzers of its fields while holding the lock
+
     @staticmethod
     def get_analyzer(analyzer_type: str) -> "Analyzer":
+        """
+        Return the analyzer of the given type. Analyzers are thread-safe, so every analyzer is created once per process
+        and shared by all index writers and query parsers.
+        """
+        key = (analyzer_type, AnalyzerFactory.STOPWORD_SOURCES.get(analyzer_type))
+        with AnalyzerFactory._lock:
+            analyzer = AnalyzerFactory._analyzers.get(key)
+            if analyzer is None:
+                analyzer = AnalyzerFactory._analyzers[key] = AnalyzerFactory.create_analyzer(analyzer_type)
+            return analyzer
+
+    @staticmethod
+    def get_signature(analyzer_type: str) -> str:
+        """
+        Return a signature of the analyzer, which changes whenever its stopwords change (an index must be rebuilt when
+        the signature of its analyzer changes).
+        """
+        if analyzer_type.endswith(SHINGLES_SUFFIX):
+            return AnalyzerFactory.get_signature(analyzer_type[:-len(SHINGLES_SUFFIX)]) + SHINGLES_SUFFIX
+        if analyzer_type == MULTI_FIELD_ANALYZER:
+            return "|".join(AnalyzerFactory.get_signature(field_analyzer) for field_analyzer in Config.VALID_ANALYZERS)
+        source = AnalyzerFactory.STOPWORD_SOURCES.get(analyzer_type)
+        if source is None:
+            return analyzer_type
+        return f"{analyzer_type}:{stopwords_digest(get_stopwords(source))}"
+
+    @staticmethod
+    def get_field_analyzers(analyzer_type: str) -> List[Tuple[str, str]]:
+        """
+        Return the (field, analyzer type) pairs of the text fields indexed by the analyzer of an index, without the
+        shingle fields.
+        """
+        if analyzer_type.endswith(SHINGLES_SUFFIX):
+            analyzer_type = analyzer_type[:-len(SHINGLES_SUFFIX)]
+        if analyzer_type == MULTI_FIELD_ANALYZER:
+            return [(get_field_name(field_analyzer, True), field_analyzer) for field_analyzer in Config.VALID_ANALYZERS]
+        return [(get_field_name(analyzer_type), analyzer_type)]
+
+    @staticmethod
+    def get_text_fields(analyzer_type: str) -> List[str]:
+        """
+        Return the fields the text of a document is indexed in by the analyzer of an index.
+        """
+        fields = [field for field, _ in AnalyzerFactory.get_field_analyzers(analyzer_type)]
+        if analyzer_type.endswith(SHINGLES_SUFFIX):
+            fields += [get_shingle_field_name(field) for field in fields]
+        return fields
+
+    @staticmethod
+    def get_shingle_analyzer(analyzer: "Analyzer") -> "Analyzer":
+        """
+        Return the analyzer producing the two-word shingles of the tokens of an analyzer (and nothing for texts of a
+        single token). Positions left empty by removed stopwords are filled with '_', so the shingles of a query match
+        the shingles of the indexed text.
+        """
+        with AnalyzerFactory._lock:
+            key = ("shingles", analyzer)
+            shingle_analyzer = AnalyzerFactory._analyzers.get(key)
+            if shingle_analyzer is None:
+                shingle_analyzer = AnalyzerFactory._analyzers[key] = ShingleAnalyzerWrapper(analyzer, 2, 2, " ", False,
+                                                                                            False, "_")
+            return shingle_analyzer
+
+    @staticmethod
+    def create_analyzer(analyzer_type: str) -> "Analyzer":
+        """
+        Create a new analyzer of the given type.
+        """
+        stopword_source = AnalyzerFactory.STOPWORD_SOURCES.get(analyzer_type)
         if analyzer_type == "simple":
             # An Analyzer that filters LetterTokenizer with LowerCaseFilter
             return SimpleAnalyzer()  # https://lucene.apache.org/core/9_12_0/analysis/common/org/apache/lucene/analysis/core/SimpleAnalyzer.html
         elif analyzer_type == "standard":
-            stopwords = load_lucene_stopwords()
+            stopwords = load_stopwords(stopword_source)
             # Filters StandardTokenizer with LowerCaseFilter and StopFilter, using a configurable list of stop words.
             return StandardAnalyzer(
                 stopwords)  # https://lucene.apache.org/core/9_12_0/core/org/apache/lucene/analysis/standard/StandardAnalyzer.html
@@ -20,7 +128,7 @@ class AnalyzerFactory:
             # An Analyzer that uses WhitespaceTokenizer.
             return WhitespaceAnalyzer()  # https://lucene.apache.org/core/9_12_0/analysis/common/org/apache/lucene/analysis/core/WhitespaceAnalyzer.html
         elif analyzer_type == "stop":
-            stopwords = load_lucene_stopwords()
+            stopwords = load_stopwords(stopword_source)
             # LetterTokenizer with LowerCaseFilter and StopFilter
             return StopAnalyzer(
                 stopwords)  # https://lucene.apache.org/core/9_12_0/analysis/common/org/apache/lucene/analysis/core/StopAnalyzer.html
@@ -29,11 +137,27 @@ class AnalyzerFactory:
             # A Analyzer.TokenStreamComponents built from an StandardTokenizer filtered with EnglishPossessiveFilter, LowerCaseFilter, StopFilter, SetKeywordMarkerFilter if a stem exclusion set is provided and PorterStemFilter.
             return EnglishAnalyzer()  # https://lucene.apache.org/core/9_12_0/analysis/common/org/apache/lucene/analysis/en/EnglishAnalyzer.html
         elif analyzer_type == "english_spacy":
-            stopwords = load_stopwords_spacy()
+            stopwords = load_stopwords(stopword_source)
             # Analyzer for English. Builds an analyzer with the SPACY english stop words.
             # A Analyzer.TokenStreamComponents built from an StandardTokenizer filtered with EnglishPossessiveFilter, LowerCaseFilter, StopFilter, SetKeywordMarkerFilter if a stem exclusion set is provided and PorterStemFilter.
             return EnglishAnalyzer(
                 stopwords)  # https://lucene.apache.org/core/9_12_0/analysis/common/org/apache/lucene/analysis/en/EnglishAnalyzer.html
+        elif analyzer_type.endswith(SHINGLES_SUFFIX):
+            # The text fields are analyzed as without shingles, every shingle field by the shingle analyzer of the
+            # analyzer of its text field.
+            field_analyzers = HashMap()
+            for field, field_analyzer in AnalyzerFactory.get_field_analyzers(analyzer_type):
+                analyzer = AnalyzerFactory.get_analyzer(field_analyzer)
+                field_analyzers.put(field, analyzer)
+                field_analyzers.put(get_shingle_field_name(field), AnalyzerFactory.get_shingle_analyzer(analyzer))
+            return PerFieldAnalyzerWrapper(AnalyzerFactory.get_analyzer("standard"), field_analyzers)
+        elif analyzer_type == MULTI_FIELD_ANALYZER:
+            # Every field text_content_<analyzer> is analyzed by its own analyzer, so the text of a document is read
+            # once and indexed for every analyzer.
+            field_analyzers = HashMap()
+            for field_analyzer in Config.VALID_ANALYZERS:
+                field_analyzers.put(get_field_name(field_analyzer, True), AnalyzerFactory.get_analyzer(field_analyzer))
+            return PerFieldAnalyzerWrapper(AnalyzerFactory.get_analyzer("standard"), field_analyzers)
 
         else:
             raise ValueError(f"Unknown analyzer type: {analyzer_type}")
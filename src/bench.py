@@ -0,0 +1,270 @@
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union, List
+
+import configargparse
+import lucene
+import numpy as np
+import pandas as pd
+from org.apache.lucene.queryparser.classic import QueryParser
+from org.apache.lucene.search import IndexSearcher
+
+from .analyzer import AnalyzerFactory
+from .catalog import IndexCatalog
+from .config import Config
+from .evaluate import evaluate_all
+from .indexer import ensure_index
+from .jvm import init_vm, attach_current_thread
+from .ranking import rank_query, rank_queries_from_file, create_search_executor, DocIdLookup
+from .shards import open_index_reader
+from .similarity import SimilarityFactory
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def _create_vocabulary(size: int, rng: np.random.Generator) -> np.ndarray:
+    """Create a vocabulary of distinct, letter-only words (so every analyzer tokenizes them the same way)."""
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    words = set()
+    while len(words) < size:
+        lengths = rng.integers(3, 10, size=size)
+        words.update("".join(rng.choice(letters, length)) for length in lengths[:size - len(words)])
+    return np.array(sorted(words))
+
+
+def generate_corpus(work_dir: str, nr_docs: int, doc_length: int, vocabulary_size: int, nr_queries: int,
+                    query_length: int, seed: int = 42) -> dict:
+    """
+    Generate a synthetic corpus with Zipf-distributed words, a query file and a reference file.
+
+    The documents are written as output_<id>.txt files like the real corpus, the queries as a TSV file and the
+    reference results as a CSV file with 10 (random) relevant documents per query.
+
+    :return: The paths of the generated data and the size of the corpus in bytes.
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = _create_vocabulary(vocabulary_size, rng)
+    data_dir = os.path.join(work_dir, "docs")
+    os.makedirs(data_dir, exist_ok=True)
+
+    # Zipf's law: the probability of the word with rank r is proportional to 1 / r
+    cumulative = np.cumsum(1.0 / np.arange(1, vocabulary_size + 1))
+    cumulative /= cumulative[-1]
+
+    def sample_words(n: int) -> np.ndarray:
+        return vocabulary[np.searchsorted(cumulative, rng.random(n), side="right").clip(max=vocabulary_size - 1)]
+
+    nr_bytes = 0
+    for doc_id in range(1, nr_docs + 1):
+        length = max(1, int(rng.normal(doc_length, doc_length / 4)))
+        text = " ".join(sample_words(length))
+        with open(os.path.join(data_dir, f"output_{doc_id}.txt"), "w", encoding="utf-8") as f:
+            f.write(text)
+        nr_bytes += len(text.encode("utf-8"))
+
+    queries_file = os.path.join(work_dir, "queries.tsv")
+    queries = pd.DataFrame({
+        "Query number": np.arange(1, nr_queries + 1),
+        "Query": [" ".join(sample_words(max(1, rng.poisson(query_length)))) for _ in range(nr_queries)],
+    })
+    queries.to_csv(queries_file, sep="\t", index=False)
+
+    reference_file = os.path.join(work_dir, "reference.csv")
+    pd.DataFrame({
+        "Query_number": np.repeat(np.arange(1, nr_queries + 1), 10),
+        "doc_number": rng.integers(1, nr_docs + 1, size=nr_queries * 10),
+    }).to_csv(reference_file, index=False)
+
+    return {"data_dir": data_dir, "queries_file": queries_file, "reference_file": reference_file,
+            "nr_bytes": nr_bytes}
+
+
+def _latency_summary(latencies: List[float]) -> dict:
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "queries": len(latencies),
+        "mean_ms": float(np.mean(latencies_ms)),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "max_ms": float(np.max(latencies_ms)),
+    }
+
+
+def benchmark_indexing(corpus: dict, index_dir: str, analyzer_type: str, num_threads: int, ram_buffer_mb: float,
+                       merge_policy: str, merge_factor: int, nr_docs: int, shards: int = 1) -> dict:
+    shutil.rmtree(index_dir, ignore_errors=True)
+    start_time = time.perf_counter()
+    index_path = ensure_index(IndexCatalog(index_dir), corpus["data_dir"], analyzer_type, "bm25",
+                              num_threads=num_threads, ram_buffer_mb=ram_buffer_mb, merge_policy=merge_policy,
+                              merge_factor=merge_factor, shards=shards)
+    elapsed_time = time.perf_counter() - start_time
+    return {
+        "index_path": index_path,
+        "threads": num_threads,
+        "shards": shards,
+        "seconds": elapsed_time,
+        "docs_per_s": nr_docs / elapsed_time,
+        "mb_per_s": corpus["nr_bytes"] / (1024 * 1024) / elapsed_time,
+    }
+
+
+def benchmark_latency(searcher: IndexSearcher, analyzer: "Analyzer", doc_id_lookup: DocIdLookup,
+                      query_texts: List[str], query_type: str, top_k: int, search_mode: str = "default") -> dict:
+    """Measure the latency of every query, searched one at a time."""
+    query_parser = QueryParser("text_content", analyzer)
+    latencies = []
+    for query_text in query_texts:
+        start_time = time.perf_counter()
+        rank_query(searcher, query_parser, query_text, doc_id_lookup, top_k=top_k, query_type=query_type,
+                   search_mode=search_mode)
+        latencies.append(time.perf_counter() - start_time)
+    return _latency_summary(latencies)
+
+
+def benchmark_search_modes(searcher: IndexSearcher, analyzer: "Analyzer", doc_id_lookup: DocIdLookup,
+                           query_texts: List[str], top_k: int, search_modes: List[str]) -> dict:
+    """
+    Measure the latency of boolean_or queries for every search mode, and check that every mode ranks the same
+    documents as the exhaustive search.
+    """
+    query_parser = QueryParser("text_content", analyzer)
+    exhaustive = [rank_query(searcher, query_parser, query_text, doc_id_lookup, top_k=top_k,
+                             query_type="boolean_or", search_mode="exhaustive") for query_text in query_texts]
+    results = {}
+    for search_mode in search_modes:
+        rankings = [rank_query(searcher, query_parser, query_text, doc_id_lookup, top_k=top_k,
+                               query_type="boolean_or", search_mode=search_mode) for query_text in query_texts]
+        results[search_mode] = {
+            **benchmark_latency(searcher, analyzer, doc_id_lookup, query_texts, "boolean_or", top_k, search_mode),
+            "same_rankings_as_exhaustive": rankings == exhaustive,
+        }
+    return results
+
+
+def benchmark_throughput(searcher: IndexSearcher, analyzer: "Analyzer", doc_id_lookup: DocIdLookup,
+                         query_texts: List[str], query_type: str, top_k: int, clients: int) -> dict:
+    """Measure the number of queries per second answered for a number of concurrent clients."""
+    local = threading.local()
+
+    def search(query_text: str) -> float:
+        if not hasattr(local, "query_parser"):
+            local.query_parser = QueryParser("text_content", analyzer)
+        start_time = time.perf_counter()
+        rank_query(searcher, local.query_parser, query_text, doc_id_lookup, top_k=top_k, query_type=query_type)
+        return time.perf_counter() - start_time
+
+    with ThreadPoolExecutor(max_workers=clients, initializer=attach_current_thread) as executor:
+        start_time = time.perf_counter()
+        latencies = list(executor.map(search, query_texts))
+        elapsed_time = time.perf_counter() - start_time
+    return {"clients": clients, "qps": len(query_texts) / elapsed_time, **_latency_summary(latencies)}
+
+
+def benchmark_evaluation(searcher: IndexSearcher, analyzer: "Analyzer", doc_id_lookup: DocIdLookup, corpus: dict,
+                         work_dir: str, top_k: int) -> dict:
+    rankings_file = os.path.join(work_dir, "rankings.csv")
+    rank_queries_from_file(searcher, QueryParser("text_content", analyzer), corpus["queries_file"], rankings_file,
+                           delimiter="\t", top_k=top_k, query_type="boolean_or", doc_id_lookup=doc_id_lookup)
+    start_time = time.perf_counter()
+    evaluate_all(rankings_file, corpus["reference_file"], [1, 3, 5, 10])
+    return {"seconds": time.perf_counter() - start_time}
+
+
+def run_benchmark(args: configargparse.Namespace) -> dict:
+    init_vm()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="ir_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    logging.info(f"Generating a synthetic corpus of {args.docs} documents in '{work_dir}'...")
+    corpus = generate_corpus(work_dir, args.docs, args.doc_length, args.vocabulary, args.queries, args.query_length,
+                             seed=args.seed)
+
+    results = {
+        "config": vars(args),
+        "environment": {"python": platform.python_version(), "lucene": lucene.VERSION, "cpus": os.cpu_count(),
+                        "platform": platform.platform()},
+        "corpus": {"docs": args.docs, "mb": corpus["nr_bytes"] / (1024 * 1024), "queries": args.queries},
+    }
+
+    logging.info("Benchmarking indexing...")
+    results["indexing"] = benchmark_indexing(corpus, os.path.join(work_dir, "index"), args.analyzer,
+                                             args.index_threads, args.ram_buffer_mb, args.merge_policy,
+                                             args.merge_factor, args.docs, shards=args.shards)
+
+    analyzer = AnalyzerFactory.get_analyzer(args.analyzer)
+    reader = open_index_reader(results["indexing"]["index_path"], args.shards)
+    search_executor = create_search_executor(args.intra_query_threads)
+    searcher = IndexSearcher(reader, search_executor)
+    searcher.setSimilarity(SimilarityFactory.get_similarity("bm25"))
+    doc_id_lookup = DocIdLookup(reader, preload=True)
+    query_texts = list(pd.read_csv(corpus["queries_file"], delimiter="\t")["Query"])
+    try:
+        logging.info("Benchmarking query latency...")
+        results["latency"] = {query_type: benchmark_latency(searcher, analyzer, doc_id_lookup, query_texts,
+                                                            query_type, args.top_k)
+                              for query_type in args.query_types}
+        logging.info("Benchmarking search modes...")
+        results["search_modes"] = benchmark_search_modes(searcher, analyzer, doc_id_lookup, query_texts, args.top_k,
+                                                         args.search_modes)
+        logging.info("Benchmarking query throughput...")
+        results["throughput"] = [benchmark_throughput(searcher, analyzer, doc_id_lookup, query_texts, "boolean_or",
+                                                      args.top_k, clients) for clients in args.clients]
+        logging.info("Benchmarking evaluation...")
+        results["evaluation"] = benchmark_evaluation(searcher, analyzer, doc_id_lookup, corpus, work_dir, args.top_k)
+    finally:
+        reader.close()
+        if search_executor is not None:
+            search_executor.shutdown()
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def main(args: Union[str, List[str]] = None) -> int:
+    parser = configargparse.ArgParser(description="IR: assignment 2, benchmark suite",
+                                      formatter_class=configargparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--docs", type=int, default=10000, help="Number of synthetic documents.")
+    parser.add_argument("--doc_length", type=int, default=200, help="Average number of words per document.")
+    parser.add_argument("--vocabulary", type=int, default=50000, help="Number of distinct words.")
+    parser.add_argument("--queries", type=int, default=1000, help="Number of synthetic queries.")
+    parser.add_argument("--query_length", type=int, default=5, help="Average number of words per query.")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the random generator.")
+    parser.add_argument("--analyzer", default="standard", choices=Config.VALID_ANALYZERS, help="The analyzer.")
+    parser.add_argument("--query_types", nargs="+", default=Config.VALID_QUERY_TYPES,
+                        choices=Config.VALID_QUERY_TYPES, help="Query types to measure the latency of.")
+    parser.add_argument("--top_k", type=int, default=10, help="Number of results per query.")
+    parser.add_argument("--search_modes", nargs="+", default=Config.VALID_SEARCH_MODES,
+                        choices=Config.VALID_SEARCH_MODES, help="Search modes to compare for boolean_or queries.")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="Numbers of concurrent clients to measure the throughput for.")
+    parser.add_argument("--index_threads", type=int, default=os.cpu_count() or 1, help="Indexing threads.")
+    parser.add_argument("--ram_buffer_mb", type=float, default=256.0, help="IndexWriter RAM buffer (MB).")
+    parser.add_argument("--merge_policy", default="tiered", choices=Config.VALID_MERGE_POLICIES,
+                        help="The merge policy.")
+    parser.add_argument("--merge_factor", type=int, default=10, help="Number of segments merged at once.")
+    parser.add_argument("--shards", type=int, default=1, help="Number of shards of the index.")
+    parser.add_argument("--intra_query_threads", type=int, default=0,
+                        help="Lucene threads searching the segments (and shards) concurrently for a single query.")
+    parser.add_argument("--work_dir", default=None,
+                        help="Directory for the synthetic corpus and index (a temporary directory if not given).")
+    parser.add_argument("--output", default="results/bench.json", help="JSON file the results are written to.")
+    parsed_args = parser.parse_args(args)
+
+    results = run_benchmark(parsed_args)
+    os.makedirs(os.path.dirname(parsed_args.output) or ".", exist_ok=True)
+    with open(parsed_args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    logging.info(f"Saved benchmark results to '{parsed_args.output}'.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
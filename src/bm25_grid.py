@@ -0,0 +1,436 @@
+import json
+import logging
+import os
+import sys
+import time
+from typing import Union, List, Tuple, Dict, Iterator, Sequence
+
+import configargparse
+import numpy as np
+import pandas as pd
+from org.apache.lucene.index import PostingsEnum
+from org.apache.lucene.queryparser.classic import QueryParser
+from org.apache.lucene.search import IndexSearcher, DocIdSetIterator, BooleanQuery, BooleanClause, BoostQuery, \
+    TermQuery
+from org.apache.lucene.util import SmallFloat
+
+from .analyzer import AnalyzerFactory, get_field_name
+from .catalog import IndexCatalog
+from .config import Config
+from .evaluate import load_results, average_precisions_and_recalls
+from .indexer import ensure_index
+from .jvm import init_vm
+from .query_factory import QueryFactory
+from .ranking import get_queries_delimiter, read_queries_in_chunks, search_top_docs, DocIdLookup
+from .shards import open_index_reader
+from .similarity import SimilarityFactory
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Arrays of an export, stored as .npy files in the export directory and memory-mapped when loaded
+EXPORT_ARRAYS = ["doc_ids", "norms", "length_table", "term_offsets", "term_idfs", "postings_docs", "postings_freqs",
+                 "query_numbers", "query_offsets", "query_terms", "query_boosts"]
+STATS_FILE = "stats.json"
+
+
+def extract_weighted_terms(query: "Query", boost: float = 1.0) -> Tuple[Dict["Term", float], int]:
+    """
+    Flatten a rewritten disjunction into its terms and their boosts. Lucene rewrites duplicate SHOULD clauses into a
+    single boosted clause, and the BM25 score of a boosted term is linear in its boost, so the score of the query is the
+    sum of the scores of the terms weighted by their boosts.
+
+    :return: The boost of every term, and the number of clauses that are not (boosted) term queries in a disjunction
+    (which the BM25 grid engine cannot score).
+    """
+    if TermQuery.instance_(query):
+        return {TermQuery.cast_(query).getTerm(): boost}, 0
+    if BoostQuery.instance_(query):
+        boost_query = BoostQuery.cast_(query)
+        return extract_weighted_terms(boost_query.getQuery(), boost * boost_query.getBoost())
+    if BooleanQuery.instance_(query):
+        terms, unsupported = {}, 0
+        for clause in BooleanQuery.cast_(query).clauses():
+            if clause.getOccur() != BooleanClause.Occur.SHOULD:
+                unsupported += 1
+                continue
+            clause_terms, clause_unsupported = extract_weighted_terms(clause.getQuery(), boost)
+            for term, term_boost in clause_terms.items():
+                terms[term] = terms.get(term, 0.0) + term_boost
+            unsupported += clause_unsupported
+        return terms, unsupported
+    return {}, 1
+
+
+def _read_postings(reader: "IndexReader", term: "Term", live_docs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Read the (live) documents and term frequencies of a term, as internal document ids of the reader.
+
+    Lucene has no bulk postings API that can be called from Python, so every posting costs two calls into the JVM (see
+    the postings read time in the export log). The arrays of every segment are preallocated from the document frequency
+    of the term in the segment, and deleted documents are dropped at once at the end.
+    """
+    segment_docs, segment_freqs = [], []
+    for context in reader.leaves():
+        leaf = context.reader()
+        doc_freq = leaf.docFreq(term)  # includes the deleted documents, as the postings do
+        if doc_freq == 0:
+            continue
+        postings = leaf.postings(term, PostingsEnum.FREQS)
+        docs = np.empty(doc_freq, dtype=np.int32)
+        freqs = np.empty(doc_freq, dtype=np.float32)
+        next_doc, freq = postings.nextDoc, postings.freq
+        for i in range(doc_freq):
+            docs[i] = next_doc()
+            freqs[i] = freq()
+        docs += context.docBase
+        segment_docs.append(docs)
+        segment_freqs.append(freqs)
+    if not segment_docs:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+    docs, freqs = np.concatenate(segment_docs), np.concatenate(segment_freqs)
+    live = live_docs[docs]
+    return docs[live], freqs[live]
+
+
+def _read_norms(reader: "IndexReader", field: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Read the encoded length norm and whether the document is live for every document of the reader. Only the segments
+    with deletions are checked for deleted documents.
+    """
+    norms = np.zeros(reader.maxDoc(), dtype=np.uint8)
+    live_docs = np.ones(reader.maxDoc(), dtype=bool)
+    has_deletions = reader.hasDeletions()
+    for context in reader.leaves():
+        leaf = context.reader()
+        norm_values = leaf.getNormValues(field)
+        if norm_values is not None:
+            doc = norm_values.nextDoc()
+            while doc != DocIdSetIterator.NO_MORE_DOCS:
+                norms[context.docBase + doc] = norm_values.longValue() & 0xFF
+                doc = norm_values.nextDoc()
+        if not has_deletions or not leaf.hasDeletions():
+            continue
+        leaf_live_docs = leaf.getLiveDocs()
+        if leaf_live_docs is not None:
+            for doc in range(leaf.maxDoc()):
+                live_docs[context.docBase + doc] = leaf_live_docs.get(doc)
+    return norms, live_docs
+
+
+def export_postings(searcher: IndexSearcher, query_parser: QueryParser, queries_file: str, export_dir: str,
+                    doc_id_lookup: DocIdLookup) -> dict:
+    """
+    Export everything BM25 needs to score the queries of a query file without Lucene: the postings (documents and
+    term frequencies) of the query terms, the encoded length norm of every document, the idf of every term and the
+    collection statistics of the field. The queries are parsed as boolean_or queries with the analyzer of the query
+    parser. The arrays are written as .npy files to export_dir, so they can be memory-mapped by load_export.
+
+    :return: The statistics of the export.
+    """
+    reader = searcher.getIndexReader()
+    field = query_parser.getField()
+    collection_stats = searcher.collectionStatistics(field)
+    if collection_stats is None:
+        raise ValueError(f"Field '{field}' of the index has no documents.")
+    norms, live_docs = _read_norms(reader, field)
+
+    term_ids = {}  # term -> index of the term in the export
+    term_offsets, term_idfs, postings_docs, postings_freqs = [0], [], [], []
+    query_numbers, query_offsets, query_terms, query_boosts = [], [0], [], []
+    nr_unsupported = 0
+    postings_time = 0.0
+    for chunk in read_queries_in_chunks(queries_file, get_queries_delimiter(queries_file)):
+        for query_number, query_text in zip(chunk["Query number"], chunk["Query"]):
+            query = QueryFactory.create_query(query_text=query_text, query_type="boolean_or", query_parser=query_parser)
+            terms, unsupported = extract_weighted_terms(searcher.rewrite(query))
+            nr_unsupported += unsupported
+            for term, boost in terms.items():
+                if term not in term_ids:
+                    term_ids[term] = len(term_ids)
+                    postings_start = time.time()
+                    docs, freqs = _read_postings(reader, term, live_docs)
+                    postings_time += time.time() - postings_start
+                    postings_docs.append(docs)
+                    postings_freqs.append(freqs)
+                    term_offsets.append(term_offsets[-1] + len(docs))
+                    doc_freq = reader.docFreq(term)  # as Lucene, the document frequency includes deleted documents
+                    term_idfs.append(np.log(1 + (collection_stats.docCount() - doc_freq + 0.5) / (doc_freq + 0.5)))
+                query_terms.append(term_ids[term])
+                query_boosts.append(boost)
+            query_numbers.append(query_number)
+            query_offsets.append(len(query_terms))
+    if nr_unsupported:
+        logging.warning(f"{nr_unsupported} query clauses are not term disjunctions and are ignored by the BM25 grid.")
+
+    arrays = {
+        "doc_ids": doc_id_lookup.doc_ids,
+        "norms": norms,
+        # the document length every encoded norm stands for, as used by BM25Similarity
+        "length_table": np.array([SmallFloat.byte4ToInt(i if i < 128 else i - 256) for i in range(256)],
+                                 dtype=np.float32),
+        "term_offsets": np.array(term_offsets, dtype=np.int64),
+        "term_idfs": np.array(term_idfs, dtype=np.float32),
+        "postings_docs": np.concatenate(postings_docs) if postings_docs else np.empty(0, dtype=np.int32),
+        "postings_freqs": np.concatenate(postings_freqs) if postings_freqs else np.empty(0, dtype=np.float32),
+        "query_numbers": np.array(query_numbers, dtype=np.int64),
+        "query_offsets": np.array(query_offsets, dtype=np.int64),
+        "query_terms": np.array(query_terms, dtype=np.int64),
+        "query_boosts": np.array(query_boosts, dtype=np.float32),
+    }
+    os.makedirs(export_dir, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(export_dir, f"{name}.npy"), array)
+    stats = {
+        "field": field,
+        "queries_file": os.path.abspath(queries_file),
+        "doc_count": collection_stats.docCount(),
+        "sum_total_term_freq": collection_stats.sumTotalTermFreq(),
+        "queries": len(query_numbers),
+        "terms": len(term_ids),
+        "postings": int(term_offsets[-1]),
+    }
+    with open(os.path.join(export_dir, STATS_FILE), "w", encoding="utf-8") as f:
+        json.dump(stats, f, indent=2)
+    logging.info(f"Exported {stats['postings']} postings of {stats['terms']} terms for {stats['queries']} queries "
+                 f"to '{export_dir}' (reading the postings took {postings_time:.2f} seconds).")
+    return stats
+
+
+def load_export(export_dir: str) -> dict:
+    """Load an export (see export_postings), memory-mapping its arrays."""
+    with open(os.path.join(export_dir, STATS_FILE), "r", encoding="utf-8") as f:
+        export = json.load(f)
+    for name in EXPORT_ARRAYS:
+        export[name] = np.load(os.path.join(export_dir, f"{name}.npy"), mmap_mode="r")
+    return export
+
+
+def create_norm_caches(export: dict, parameters: Sequence[Tuple[float, float]]) -> np.ndarray:
+    """
+    Compute, as BM25Similarity does, the inverse length normalization 1 / (k1 * (1 - b + b * length / avgdl)) of every
+    encoded norm for every (k1, b) pair, in single precision.
+
+    :return: An array of shape (len(parameters), 256).
+    """
+    avgdl = np.float32(export["sum_total_term_freq"] / export["doc_count"])
+    k1 = np.array([k1 for k1, _ in parameters], dtype=np.float32)[:, None]
+    b = np.array([b for _, b in parameters], dtype=np.float32)[:, None]
+    length_table = np.asarray(export["length_table"], dtype=np.float32)[None, :]
+    return np.float32(1) / (k1 * ((np.float32(1) - b) + b * length_table / avgdl))
+
+
+def _top_k(scores: np.ndarray, docs: np.ndarray, top_k: int) -> np.ndarray:
+    """Return the top k documents by descending score, ties broken by ascending document id as Lucene does."""
+    if len(scores) > top_k:
+        kth_score = np.partition(scores, len(scores) - top_k)[len(scores) - top_k]
+        candidates = np.flatnonzero(scores >= kth_score)  # ascending document ids
+    else:
+        candidates = np.arange(len(scores))
+    return docs[candidates[np.argsort(-scores[candidates], kind="stable")[:top_k]]]
+
+
+def score_queries(export: dict, parameters: Sequence[Tuple[float, float]], top_k: int = 10,
+                  chunk_size: int = 64) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Rank all queries of an export for every (k1, b) pair with BM25, vectorized over the pairs.
+
+    A posting of a term with frequency f in a document with norm n scores w - w / (1 + f * cache[n]) with w the boost
+    times the idf of the term (as BM25Similarity, in single precision), and the score of a document is the sum over the
+    terms of the query (in double precision, as Lucene's disjunction scorers). Everything that does not depend on k1
+    and b is computed once per query; the scores of chunk_size pairs are computed at once.
+
+    :return: For every query (by index), the internal ids of its top k documents for every pair, as an array of shape
+    (len(parameters), top_k) padded with -1.
+    """
+    norm_caches = create_norm_caches(export, parameters)
+    term_offsets, query_offsets = export["term_offsets"], export["query_offsets"]
+    for query in range(len(export["query_numbers"])):
+        top_docs = np.full((len(parameters), top_k), -1, dtype=np.int64)
+        terms = export["query_terms"][query_offsets[query]:query_offsets[query + 1]]
+        boosts = export["query_boosts"][query_offsets[query]:query_offsets[query + 1]]
+        slices = [slice(term_offsets[term], term_offsets[term + 1]) for term in terms]
+        docs = np.concatenate([export["postings_docs"][s] for s in slices]) if slices else np.empty(0, np.int32)
+        if len(docs) == 0:
+            yield query, top_docs
+            continue
+        freqs = np.concatenate([export["postings_freqs"][s] for s in slices])
+        weights = np.repeat(boosts * export["term_idfs"][terms], [s.stop - s.start for s in slices])
+
+        # group the postings by document
+        order = np.argsort(docs, kind="stable")
+        docs, freqs, weights = docs[order], freqs[order], weights[order]
+        starts = np.flatnonzero(np.r_[True, docs[1:] != docs[:-1]])
+        unique_docs = docs[starts]
+        norms = export["norms"][docs]
+
+        for chunk_start in range(0, len(parameters), chunk_size):
+            norm_inverse = norm_caches[chunk_start:chunk_start + chunk_size][:, norms]
+            posting_scores = weights - weights / (np.float32(1) + freqs * norm_inverse)
+            doc_scores = np.add.reduceat(posting_scores, starts, axis=1, dtype=np.float64).astype(np.float32)
+            for row, scores in enumerate(doc_scores):
+                ranked = _top_k(scores, unique_docs, top_k)
+                top_docs[chunk_start + row, :len(ranked)] = ranked
+        yield query, top_docs
+
+
+def _reference_documents(expected_queries: np.ndarray, expected_docs: np.ndarray, query_numbers: np.ndarray,
+                         max_k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Arrange the first max_k reference documents (in file order) of every query of an export in a matrix.
+
+    :return: The reference documents of every query, of shape (len(query_numbers), max_k) and padded with a value that
+    is never a document id, and whether every query is evaluated (it has reference results and is the first query of
+    the export with its query number).
+    """
+    padding = np.iinfo(np.int64).min
+    reference = np.full((len(query_numbers), max_k), padding, dtype=np.int64)
+    # the first query of the export with every query number
+    unique_numbers, first_queries = np.unique(query_numbers, return_index=True)
+    is_evaluated = np.zeros(len(query_numbers), dtype=bool)
+    if len(expected_queries) == 0 or len(unique_numbers) == 0:
+        return reference, is_evaluated
+
+    # position of every reference entry within the entries of its query
+    order = np.argsort(expected_queries, kind="stable")
+    sorted_queries, sorted_docs = expected_queries[order], expected_docs[order]
+    positions = np.arange(len(sorted_queries)) - np.searchsorted(sorted_queries, sorted_queries, side="left")
+    slots = np.minimum(np.searchsorted(unique_numbers, sorted_queries), len(unique_numbers) - 1)
+    keep = (unique_numbers[slots] == sorted_queries) & (positions < max_k)
+    reference[first_queries[slots[keep]], positions[keep]] = sorted_docs[keep]
+    is_evaluated[first_queries[slots[keep]]] = True
+    return reference, is_evaluated
+
+
+def sweep_bm25(export: dict, parameters: Sequence[Tuple[float, float]], reference_file: str, top_k: int = 10,
+               k_list: Sequence[int] = (1, 3, 5, 10), chunk_size: int = 64) -> pd.DataFrame:
+    """
+    Rank the queries of an export for every (k1, b) pair and evaluate the rankings against the reference results,
+    without writing any rankings file.
+
+    The rankings are evaluated as they are scored, query by query (as evaluate_arrays does): only the sums of the
+    average precisions and recalls of every pair are kept, so memory use does not depend on the number of queries.
+
+    :return: MAP@K and MAR@K for every pair and k.
+    """
+    max_k = max(k_list)
+    expected_queries, expected_docs = load_results(reference_file)
+    reference, is_evaluated = _reference_documents(expected_queries, expected_docs,
+                                                   np.asarray(export["query_numbers"]), max_k)
+    doc_ids = np.asarray(export["doc_ids"])
+    precision_sums = np.zeros((len(parameters), len(k_list)))
+    recall_sums = np.zeros((len(parameters), len(k_list)))
+    for query, top_docs in score_queries(export, parameters, top_k=top_k, chunk_size=chunk_size):
+        if not is_evaluated[query]:
+            continue
+        found = top_docs >= 0
+        ranked = doc_ids[np.where(found, top_docs, 0)]
+        # relevance: pairs x the max_k reference positions, whatever top_k, True when the reference document was found
+        relevance = np.any((reference[query][None, :, None] == ranked[:, None, :]) & found[:, None, :], axis=2)
+        average_precisions, recalls = average_precisions_and_recalls(relevance, found.sum(axis=1), k_list)
+        precision_sums += average_precisions
+        recall_sums += recalls
+
+    # the queries of the reference results that are not in the export score 0
+    nr_reference_queries = max(len(np.unique(expected_queries)), 1)
+    rows = [{"k1": k1, "b": b, "k": k, "MAP@K": precision_sums[parameter, column] / nr_reference_queries,
+             "MAR@K": recall_sums[parameter, column] / nr_reference_queries}
+            for parameter, (k1, b) in enumerate(parameters) for column, k in enumerate(k_list)]
+    return pd.DataFrame(rows, columns=["k1", "b", "k", "MAP@K", "MAR@K"])
+
+
+def verify_export(searcher: IndexSearcher, query_parser: QueryParser, export: dict, queries_file: str,
+                  nr_queries: int, top_k: int = 10) -> int:
+    """
+    Compare the top k documents of the BM25 grid engine with the top k documents Lucene finds for the first queries
+    of the query file, with the default BM25 parameters.
+
+    :return: The number of queries with the same ranking.
+    """
+    searcher.setSimilarity(SimilarityFactory.get_similarity("bm25"))
+    queries = next(iter(read_queries_in_chunks(queries_file, get_queries_delimiter(queries_file),
+                                               chunk_size=max(nr_queries, 1))), None)
+    if queries is None:
+        return 0
+    nr_same = 0
+    engine_rankings = score_queries(export, [(1.2, 0.75)], top_k=top_k)
+    for query_text, (_, top_docs) in zip(queries["Query"][:nr_queries], engine_rankings):
+        query = QueryFactory.create_query(query_text=query_text, query_type="boolean_or", query_parser=query_parser)
+        lucene_docs = [hit.doc for hit in search_top_docs(searcher, query, top_k).scoreDocs]
+        nr_same += lucene_docs == [doc for doc in top_docs[0] if doc >= 0]
+    return nr_same
+
+
+def parse_values(values: List[str]) -> List[float]:
+    """Parse parameter values: numbers, or ranges start:stop:step (stop included)."""
+    parsed = []
+    for value in values:
+        if ":" in value:
+            start, stop, step = (float(part) for part in value.split(":"))
+            parsed.extend(float(v) for v in np.round(np.arange(start, stop + step / 2, step), 6))
+        else:
+            parsed.append(float(value))
+    return parsed
+
+
+def main(args: Union[str, List[str]] = None) -> int:
+    parser = configargparse.ArgParser(description="IR: assignment 2, offline BM25 parameter sweep")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Export the postings of the query terms of an index.")
+    export_parser.add_argument("--data_dir", required=True, help="The documents the index is built from.")
+    export_parser.add_argument("--index_dir", default="index", help="Directory where the indexes are stored.")
+    export_parser.add_argument("--analyzer", default="standard", choices=Config.VALID_ANALYZERS, help="The analyzer.")
+    export_parser.add_argument("--queries", required=True, help="The query file.")
+    export_parser.add_argument("--shards", type=int, default=1, help="Number of shards of the index.")
+    export_parser.add_argument("--multi_field", action="store_true", help="Export from a multi-field index.")
+    export_parser.add_argument("--corpus_format", default="auto", choices=Config.VALID_CORPUS_FORMATS,
+                               help="Format of the documents.")
+    export_parser.add_argument("--verify", type=int, default=10,
+                               help="Number of queries whose rankings are compared with Lucene after the export.")
+    export_parser.add_argument("--output", required=True, help="Directory the arrays are written to.")
+
+    sweep_parser = subparsers.add_parser("sweep", help="Evaluate a grid of BM25 parameters on an export.")
+    sweep_parser.add_argument("export", help="Directory of the export.")
+    sweep_parser.add_argument("--k1", nargs="+", default=["1.2"], help="Values (or ranges start:stop:step) of k1.")
+    sweep_parser.add_argument("--b", nargs="+", default=["0.75"], help="Values (or ranges start:stop:step) of b.")
+    sweep_parser.add_argument("--reference_file", required=True, help="The reference results.")
+    sweep_parser.add_argument("--top_k", type=int, default=10, help="Number of results per query.")
+    sweep_parser.add_argument("--chunk_size", type=int, default=64, help="Number of (k1, b) pairs scored at once.")
+    sweep_parser.add_argument("--output", default="results/evaluation/bm25_grid.csv",
+                              help="CSV file the evaluation of every (k1, b) pair is written to.")
+    parsed_args = parser.parse_args(args)
+
+    start_time = time.time()
+    if parsed_args.command == "export":
+        init_vm()
+        index_path = ensure_index(IndexCatalog(parsed_args.index_dir), parsed_args.data_dir, parsed_args.analyzer,
+                                  "bm25", shards=parsed_args.shards, corpus_format=parsed_args.corpus_format,
+                                  multi_field=parsed_args.multi_field)
+        reader = open_index_reader(index_path, parsed_args.shards)
+        try:
+            searcher = IndexSearcher(reader)
+            query_parser = QueryParser(get_field_name(parsed_args.analyzer, parsed_args.multi_field),
+                                       AnalyzerFactory.get_analyzer(parsed_args.analyzer))
+            export_postings(searcher, query_parser, parsed_args.queries, parsed_args.output, DocIdLookup(reader))
+            if parsed_args.verify > 0:
+                nr_same = verify_export(searcher, query_parser, load_export(parsed_args.output), parsed_args.queries,
+                                        parsed_args.verify)
+                logging.info(f"The BM25 grid engine ranks {nr_same} of the first {parsed_args.verify} queries the "
+                             f"same as Lucene.")
+        finally:
+            reader.close()
+    else:
+        parameters = [(k1, b) for k1 in parse_values(parsed_args.k1) for b in parse_values(parsed_args.b)]
+        results = sweep_bm25(load_export(parsed_args.export), parameters, parsed_args.reference_file,
+                             top_k=parsed_args.top_k, chunk_size=parsed_args.chunk_size)
+        os.makedirs(os.path.dirname(parsed_args.output) or ".", exist_ok=True)
+        results.to_csv(parsed_args.output, index=False)
+        best = results[results["k"] == results["k"].max()].sort_values("MAP@K", ascending=False).iloc[0]
+        logging.info(f"Evaluated {len(parameters)} (k1, b) pairs, best MAP@{int(best['k'])}: {best['MAP@K']:.4f} "
+                     f"(k1={best['k1']}, b={best['b']}). Saved to '{parsed_args.output}'.")
+    logging.info(f"Completed in {time.time() - start_time:.2f} seconds")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
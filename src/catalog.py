@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import tempfile
+from typing import Optional
+
+from .corpus import corpus_name, OFFSETS_SUFFIX
+
+
+class IndexCatalog:
+    """
+    Keeps track of the indexes stored in an index directory.
+
+    An index is identified only by what determines its postings on disk: the documents in the data directory, the
+    analyzer, the norm encoding of the similarity and the number of shards. Query-time parameters (the similarity
+    itself, BM25 k1 and b) are not part of the identity, so a single index serves every similarity configuration.
+
+    The catalog is stored as a JSON file in the index directory, recording for every index a fingerprint of the data
+    directory it was built from and the signature of its analyzer. An index whose fingerprint no longer matches the data
+    directory, or whose analyzer signature changed (e.g. different stopwords), is stale.
+    """
+    CATALOG_FILE = "catalog.json"
+
+    def __init__(self, index_dir: str) -> None:
+        self.index_dir = index_dir
+        self._catalog_path = os.path.join(index_dir, self.CATALOG_FILE)
+        self._entries = self._load()
+
+    def _load(self) -> dict:
+        if not os.path.exists(self._catalog_path):
+            return {}
+        with open(self._catalog_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _save(self) -> None:
+        # write to a temporary file first, so a concurrent reader never sees a partially written catalog
+        os.makedirs(self.index_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.index_dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self._catalog_path)
+
+    @staticmethod
+    def get_index_name(data_dir: str, analyzer: str, norm_encoding: str, shards: int = 1) -> str:
+        """
+        Create the name of the index for the given data directory, analyzer, norm encoding and number of shards.
+        """
+        # Get the base name of the directory (or packed corpus) from data_dir (e.g., 'full_docs_small')
+        base_name = corpus_name(data_dir)
+        if shards > 1:
+            return f"{base_name}_{analyzer}_{norm_encoding}_{shards}shards"
+        return f"{base_name}_{analyzer}_{norm_encoding}"
+
+    @staticmethod
+    def fingerprint(data_dir: str) -> str:
+        """
+        Compute a fingerprint of the documents in a data directory, based on the name, size and modification time of
+        every text file. The fingerprint of a packed corpus is based on its file (and offset table).
+        """
+        digest = hashlib.sha1()
+        if os.path.isdir(data_dir):
+            entries = sorted((entry for entry in os.scandir(data_dir) if entry.name.endswith(".txt")),
+                             key=lambda entry: entry.name)
+            files = [(entry.name, entry.stat()) for entry in entries]
+        else:
+            paths = [data_dir, data_dir + OFFSETS_SUFFIX]
+            files = [(os.path.basename(path), os.stat(path)) for path in paths if os.path.exists(path)]
+        for name, stat in files:
+            digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+    def get_index_path(self, data_dir: str, analyzer: str, norm_encoding: str, shards: int = 1) -> str:
+        return os.path.join(self.index_dir, self.get_index_name(data_dir, analyzer, norm_encoding, shards))
+
+    def lookup(self, data_dir: str, analyzer: str, norm_encoding: str, shards: int = 1) -> Optional[dict]:
+        """
+        Return the catalog entry of an index, or None if the index is not registered.
+        """
+        return self._entries.get(self.get_index_name(data_dir, analyzer, norm_encoding, shards))
+
+    def is_up_to_date(self, data_dir: str, analyzer: str, norm_encoding: str,
+                      analyzer_signature: Optional[str] = None, shards: int = 1) -> bool:
+        """
+        Check whether an up-to-date index exists for the given data directory, analyzer and norm encoding.
+
+        :param analyzer_signature: The current signature of the analyzer, if given it must match the signature the
+        index was built with.
+        """
+        entry = self.lookup(data_dir, analyzer, norm_encoding, shards)
+        if entry is None:
+            return False
+        if analyzer_signature is not None and entry.get("analyzer_signature") != analyzer_signature:
+            return False
+        index_path = self.get_index_path(data_dir, analyzer, norm_encoding, shards)
+        if not (os.path.exists(index_path) and any(os.scandir(index_path))):
+            return False
+        return entry["fingerprint"] == self.fingerprint(data_dir)
+
+    def register(self, data_dir: str, analyzer: str, norm_encoding: str,
+                 analyzer_signature: Optional[str] = None, shards: int = 1) -> None:
+        """
+        Record that an index was (re)built from the current contents of the data directory.
+        """
+        self._entries = self._load()  # pick up indexes registered by other processes in the meantime
+        self._entries[self.get_index_name(data_dir, analyzer, norm_encoding, shards)] = {
+            "data_dir": os.path.abspath(data_dir),
+            "analyzer": analyzer,
+            "norm_encoding": norm_encoding,
+            "analyzer_signature": analyzer_signature,
+            "shards": shards,
+            "fingerprint": self.fingerprint(data_dir),
+        }
+        self._save()
@@ -15,8 +15,13 @@ class Config:
     _instance = None  # To ensure only one instance (singleton)
     VALID_ANALYZERS = ["simple", "standard", "whitespace", "stop", "english", "english_spacy"]
     VALID_SIMILARITIES = ["bm25", "classic"]
-    VALID_QUERY_TYPES = ["fuzzy", "phrase", "boolean_and", "boolean_or"]
+    VALID_QUERY_TYPES = ["fuzzy", "phrase", "analyzed_phrase", "boolean_and", "boolean_or"]
     VALID_MAX_EDITS = [0, 1, 2]
+    VALID_MERGE_POLICIES = ["tiered", "log_byte_size", "log_doc", "none"]
+    VALID_CORPUS_FORMATS = ["auto", "directory", "jsonl", "tsv", "tar", "packed"]
+    VALID_SEARCH_MODES = ["default", "exhaustive", "fast"]
+    VALID_RUN_FORMATS = ["npz", "trec"]
+    VALID_DIRECTORIES = ["fs", "mmap", "niofs"]
 
     def __new__(cls) -> "Config":
         """
@@ -52,7 +57,14 @@ class Config:
             "--data_dir",
             required=True,
             default="data/documents/full_docs_small",
-            help="Directory containing the documents.",
+            help="Directory containing the documents, or a packed corpus file (JSONL, TSV, tar or packed).",
+        )
+        self._parser.add_argument(
+            "--corpus_format",
+            required=False,
+            default="auto",
+            help="Format of the corpus in data_dir (auto, directory, jsonl, tsv, tar, packed), auto detects the format "
+                 "from the path.",
         )
         self._parser.add_argument(
             "--index_dir",
@@ -91,7 +103,7 @@ class Config:
             "--queries",
             required=False,
             default="data/queries/dev_small_queries.csv",
-            help="File containing the queries (supported formats: CSV and TSV)",
+            help="File containing the queries (supported formats: CSV and TSV, optionally gzipped)",
         )
         self._parser.add_argument(
             "--ranking_dir",
@@ -103,7 +115,28 @@ class Config:
             "--evaluation_file",
             required=False,
             default="results/evaluation/evaluation.csv",
-            help="A CSV file used to append the evaluation results.",
+            help="A CSV file the evaluation results of the results store are exported to with --export_evaluation. "
+                 "A new results store first imports the results of this file.",
+        )
+        self._parser.add_argument(
+            "--export_evaluation",
+            required=False,
+            action="store_true",
+            help="Export the evaluation results of the results store to the evaluation file after the run.",
+        )
+        self._parser.add_argument(
+            "--results_db",
+            required=False,
+            default="results/evaluation/results.db",
+            help="The SQLite database the evaluation results, configuration and phase timings of every run are "
+                 "recorded in.",
+        )
+        self._parser.add_argument(
+            "--run_formats",
+            required=False,
+            nargs="*",
+            default=[],
+            help="Formats (npz, trec) the run (the rankings with their scores) is also saved in, in the background.",
         )
         self._parser.add_argument(
             "--reference_file",
@@ -115,7 +148,7 @@ class Config:
             "--query_type",
             required=False,
             default="boolean_or",
-            help="The type of query to be evaluated (fuzzy, phrase, boolean_and, boolean_or)",
+            help="The type of query to be evaluated (fuzzy, phrase, analyzed_phrase, boolean_and, boolean_or)",
         )
         self._parser.add_argument(
             "--maxEdits",
@@ -131,8 +164,216 @@ class Config:
             type=int,
             help="Specify the number of terms that may occur between terms in the phrase"
         )
+        # Search performance
+        self._parser.add_argument(
+            "--search_threads",
+            required=False,
+            default=os.cpu_count() or 1,
+            type=int,
+            help="Number of worker threads that search queries concurrently.",
+        )
+        self._parser.add_argument(
+            "--intra_query_threads",
+            required=False,
+            default=0,
+            type=int,
+            help="Number of Lucene threads that search the segments of the index concurrently for a single query "
+                 "(0 disables intra-query concurrency).",
+        )
+        self._parser.add_argument(
+            "--search_mode",
+            required=False,
+            default="default",
+            help="How hits are collected (default, exhaustive, fast): Lucene's default counts the first 1000 hits "
+                 "exactly, exhaustive scores and counts every hit, fast counts only total_hits_threshold hits and then "
+                 "skips blocks of documents that cannot enter the top k.",
+        )
+        self._parser.add_argument(
+            "--total_hits_threshold",
+            required=False,
+            default=0,
+            type=int,
+            help="Number of hits counted exactly in the fast search mode (0 skips counting the hits).",
+        )
+        self._parser.add_argument(
+            "--directory",
+            required=False,
+            default="fs",
+            help="Directory implementation the index is searched with (fs, mmap, niofs): fs lets Lucene choose, mmap "
+                 "memory-maps the index files, niofs reads them without memory-mapping them.",
+        )
+        self._parser.add_argument(
+            "--preload_extensions",
+            required=False,
+            nargs="*",
+            default=[],
+            help="Extensions of the index files (e.g. tim doc nvd) loaded into memory when the index is opened "
+                 "(mmap directory only).",
+        )
+        self._parser.add_argument(
+            "--warmup_queries",
+            required=False,
+            default=0,
+            type=int,
+            help="Number of queries searched (and discarded) before the timed ranking starts.",
+        )
+        self._parser.add_argument(
+            "--query_chunk_size",
+            required=False,
+            default=1000,
+            type=int,
+            help="Number of queries read, ranked and written at once.",
+        )
+        self._parser.add_argument(
+            "--resume",
+            required=False,
+            action="store_true",
+            help="Resume an interrupted ranking run after its last completed query.",
+        )
+        self._parser.add_argument(
+            "--result_cache_size",
+            required=False,
+            default=10000,
+            type=int,
+            help="Maximum number of query results kept in the LRU result cache (0 disables the cache).",
+        )
+        self._parser.add_argument(
+            "--fuzzy_cache_size",
+            required=False,
+            default=10000,
+            type=int,
+            help="Maximum number of fuzzy term expansions kept in the LRU expansion cache (0 disables the cache).",
+        )
+        self._parser.add_argument(
+            "--query_cache_size",
+            required=False,
+            default=10000,
+            type=int,
+            help="Maximum number of parsed queries kept in the LRU query cache (0 disables the cache).",
+        )
+        self._parser.add_argument(
+            "--query_cache_file",
+            required=False,
+            default=None,
+            help="File the analyzed terms of parsed queries are stored in, so reruns skip query analysis.",
+        )
+        # Search server
+        self._parser.add_argument(
+            "--host",
+            required=False,
+            default="127.0.0.1",
+            help="Address the search server listens on.",
+        )
+        self._parser.add_argument(
+            "--port",
+            required=False,
+            default=8080,
+            type=int,
+            help="Port the search server listens on.",
+        )
+        self._parser.add_argument(
+            "--refresh_interval",
+            required=False,
+            default=5.0,
+            type=float,
+            help="Interval (in seconds) at which the search server checks the index for new commits.",
+        )
+        # Indexing performance
+        self._parser.add_argument(
+            "--index_threads",
+            required=False,
+            default=os.cpu_count() or 1,
+            type=int,
+            help="Number of worker threads that read, parse and add documents to the index concurrently.",
+        )
+        self._parser.add_argument(
+            "--incremental",
+            required=False,
+            action="store_true",
+            help="Update an outdated index with only the added, changed and removed documents instead of a rebuild.",
+        )
+        self._parser.add_argument(
+            "--multi_field",
+            required=False,
+            action="store_true",
+            help="Index the text once in a field per analyzer, so a single index serves every analyzer.",
+        )
+        self._parser.add_argument(
+            "--shingles",
+            required=False,
+            action="store_true",
+            help="Also index the two-word shingles of the text, and search exact analyzed phrases in them.",
+        )
+        self._parser.add_argument(
+            "--dedup_threshold",
+            required=False,
+            default=0.0,
+            type=float,
+            help="Index only one document of every cluster of near-duplicate documents, whose estimated Jaccard "
+                 "similarity of their word shingles is at least the threshold (0 disables deduplication).",
+        )
+        self._parser.add_argument(
+            "--expand_duplicates",
+            required=False,
+            action="store_true",
+            help="Follow every ranked document of a deduplicated index by its near-duplicates.",
+        )
+        self._parser.add_argument(
+            "--ram_buffer_mb",
+            required=False,
+            default=256.0,
+            type=float,
+            help="Amount of RAM (in MB) the IndexWriter may use to buffer documents before flushing a segment.",
+        )
+        self._parser.add_argument(
+            "--merge_policy",
+            required=False,
+            default="tiered",
+            help="The merge policy used while indexing (tiered, log_byte_size, log_doc, none)",
+        )
+        self._parser.add_argument(
+            "--merge_factor",
+            required=False,
+            default=10,
+            type=int,
+            help="Number of segments merged at once (segments per tier for the tiered merge policy).",
+        )
+        self._parser.add_argument(
+            "--shards",
+            required=False,
+            default=1,
+            type=int,
+            help="Number of shards the documents are partitioned across (built in parallel processes).",
+        )
+        # Instrumentation
+        self._parser.add_argument(
+            "--metrics_file",
+            required=False,
+            default=None,
+            help="File the timers and counters of the pipeline phases are written to (Prometheus text format if it "
+                 "ends in .prom, JSON otherwise).",
+        )
+        self._parser.add_argument(
+            "--profile",
+            required=False,
+            action="store_true",
+            help="Profile the ranking with cProfile and break down the phases of the slowest queries.",
+        )
+        self._parser.add_argument(
+            "--profile_slowest",
+            required=False,
+            default=10,
+            type=int,
+            help="Number of slowest queries broken down when profiling.",
+        )
+        self._parser.add_argument(
+            "--profile_dir",
+            required=False,
+            default="results/profile",
+            help="Directory the cProfile statistics are written to.",
+        )
 
-    def parse(self, args_str: Optional[str] = None) -> None:
+    def parse(self, args_str: Optional[str] = None, rank_queries_file: bool = True) -> None:
         """
         Parse the configuration settings.
 
@@ -141,11 +382,16 @@ class Config:
         args_str : Optional[str]
             If None, arguments are taken from sys.argv; otherwise, a string of arguments.
             Arguments not specified on the command line are taken from the config file.
+        rank_queries_file : bool
+            Whether a query file will be ranked and evaluated. If not (e.g. for the search server), the query,
+            ranking and evaluation paths are not validated.
         """
         self._namespace = vars(self._parser.parse_args(args_str))
         self._validate_analyzer()
-        self._validate_paths()
+        self._validate_paths(rank_queries_file)
         self._validate_query_parameters()
+        self._validate_indexing_parameters()
+        self._validate_search_parameters()
 
     def _validate_analyzer(self) -> None:
         """
@@ -155,24 +401,35 @@ class Config:
         if analyzer not in self.VALID_ANALYZERS:
             raise ValueError(f"Invalid analyzer '{analyzer}'. Valid options are: {', '.join(self.VALID_ANALYZERS)}")
 
-    def _validate_paths(self) -> None:
+    def _validate_paths(self, rank_queries_file: bool = True) -> None:
         """
         Validate that the specified data directory exists.
         """
         data_dir = self.get("data_dir")
         if not os.path.exists(data_dir):
             raise FileNotFoundError(f"Data directory '{data_dir}' does not exist.")
+        corpus_format = self.get("corpus_format")
+        if corpus_format not in self.VALID_CORPUS_FORMATS:
+            raise ValueError(f"Invalid corpus format '{corpus_format}'. "
+                             f"Valid options are: {', '.join(self.VALID_CORPUS_FORMATS)}")
+        if not rank_queries_file:
+            return
         ranking_dir = self.get("ranking_dir")
         if not os.path.exists(ranking_dir):
             raise FileNotFoundError(f"Ranking directory '{ranking_dir}' does not exist.")
         evaluation_file = self.get("evaluation_file")
-        if not evaluation_file.endswith('.csv'):
+        if evaluation_file is not None and not evaluation_file.endswith('.csv'):
             raise ValueError(f"Invalid file format for evaluation file. Expected a .csv, but got '{evaluation_file}'.")
+        for run_format in self.get("run_formats"):
+            if run_format not in self.VALID_RUN_FORMATS:
+                raise ValueError(f"Invalid run format '{run_format}'. "
+                                 f"Valid options are: {', '.join(self.VALID_RUN_FORMATS)}")
         queries = self.get("queries")
         if not os.path.exists(queries):
             raise FileNotFoundError(f"Specified queries file '{queries}' does not exist.")
-        if not (queries.endswith('.tsv') or queries.endswith('.csv')):
-            raise ValueError(f"Invalid file format for queries. Expected a .csv or .tsv file, but got '{queries}'.")
+        if not queries.endswith(('.tsv', '.csv', '.tsv.gz', '.csv.gz')):
+            raise ValueError(
+                f"Invalid file format for queries. Expected a (gzipped) .csv or .tsv file, but got '{queries}'.")
         reference_file = self.get("reference_file")
         if not os.path.exists(reference_file):
             raise FileNotFoundError(f"Reference file '{reference_file}' does not exist.")
@@ -196,9 +453,63 @@ class Config:
         if query_type == "fuzzy" and max_edits not in self.VALID_MAX_EDITS:
             raise ValueError("maxEdits must be between 0 and 2")
         slop = self.get("slop")
-        if query_type == "phrase" and int(slop) < 0:
+        if query_type in ["phrase", "analyzed_phrase"] and int(slop) < 0:
             raise ValueError("Slop must be positive")
 
+    def _validate_indexing_parameters(self) -> None:
+        """
+        Validate that the specified indexing parameters are valid.
+        """
+        if self.get("index_threads") < 1:
+            raise ValueError("index_threads must be at least 1")
+        if self.get("ram_buffer_mb") <= 0:
+            raise ValueError("ram_buffer_mb must be positive")
+        merge_policy = self.get("merge_policy")
+        if merge_policy not in self.VALID_MERGE_POLICIES:
+            raise ValueError(
+                f"Invalid merge policy '{merge_policy}'. Valid options are: {', '.join(self.VALID_MERGE_POLICIES)}")
+        if self.get("merge_factor") < 2:
+            raise ValueError("merge_factor must be at least 2")
+        if self.get("shards") < 1:
+            raise ValueError("shards must be at least 1")
+        if not 0 <= self.get("dedup_threshold") <= 1:
+            raise ValueError("dedup_threshold must be between 0 and 1")
+        if self.get("dedup_threshold") > 0 and self.get("incremental"):
+            raise ValueError("dedup_threshold cannot be combined with incremental updates")
+
+    def _validate_search_parameters(self) -> None:
+        """
+        Validate that the specified search parameters are valid.
+        """
+        if self.get("search_threads") < 1:
+            raise ValueError("search_threads must be at least 1")
+        if self.get("intra_query_threads") < 0:
+            raise ValueError("intra_query_threads must be positive")
+        search_mode = self.get("search_mode")
+        if search_mode not in self.VALID_SEARCH_MODES:
+            raise ValueError(
+                f"Invalid search mode '{search_mode}'. Valid options are: {', '.join(self.VALID_SEARCH_MODES)}")
+        if self.get("total_hits_threshold") < 0:
+            raise ValueError("total_hits_threshold must be positive")
+        directory = self.get("directory")
+        if directory not in self.VALID_DIRECTORIES:
+            raise ValueError(
+                f"Invalid directory '{directory}'. Valid options are: {', '.join(self.VALID_DIRECTORIES)}")
+        if self.get("preload_extensions") and directory != "mmap":
+            raise ValueError("preload_extensions requires the mmap directory")
+        if self.get("warmup_queries") < 0:
+            raise ValueError("warmup_queries must be positive")
+        if self.get("query_chunk_size") < 1:
+            raise ValueError("query_chunk_size must be at least 1")
+        if self.get("result_cache_size") < 0:
+            raise ValueError("result_cache_size must be positive")
+        if self.get("fuzzy_cache_size") < 0:
+            raise ValueError("fuzzy_cache_size must be positive")
+        if self.get("query_cache_size") < 0:
+            raise ValueError("query_cache_size must be positive")
+        if self.get("profile_slowest") < 0:
+            raise ValueError("profile_slowest must be positive")
+
     def __getattr__(self, option):
         """
         Retrieve configuration options as attributes.
@@ -212,6 +523,12 @@ class Config:
 
         return self._namespace[option]
 
+    def to_dict(self) -> dict:
+        """Return all configuration options."""
+        if self._namespace is None:
+            raise RuntimeError("The configuration has not been initialized. Call `parse()` first.")
+        return dict(self._namespace)
+
     def __getitem__(self, item):
         return self.__getattr__(item)
 
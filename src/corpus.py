@@ -0,0 +1,218 @@
+import gzip
+import io
+import json
+import logging
+import mmap
+import os
+import sys
+import tarfile
+from abc import ABC, abstractmethod
+from typing import Iterator, Tuple, List, Union
+
+import configargparse
+import numpy as np
+
+from .config import Config
+from .shards import shard_of
+
+READ_BUFFER_SIZE = 1 << 20  # packed corpora are read sequentially through a 1 MB buffer
+OFFSETS_SUFFIX = ".offsets.npy"
+OFFSETS_BLOCK_SIZE = 1 << 16  # number of offset table entries converted at once
+
+
+def extract_id_from_filename(filename: str) -> int:
+    """
+    Extract textfile id from filename.
+    :param filename: the filename (not including the path)
+    :return: the integer present in the filename.
+    """
+    id_str = os.path.basename(filename).split('_')[1]
+    id_str = id_str.split('.')[0]
+    return int(id_str)
+
+
+def corpus_name(path: str) -> str:
+    """
+    Return the name of a corpus: the name of its directory, or the name of its file without the corpus extensions
+    (e.g. 'full_docs' for both data/documents/full_docs and data/documents/full_docs.jsonl.gz).
+    """
+    name = os.path.basename(os.path.normpath(path))
+    if os.path.isdir(path):
+        return name
+    for extension in [".gz", ".tgz", ".tar", ".jsonl", ".tsv", ".pack"]:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return name
+
+
+def detect_corpus_format(path: str) -> str:
+    """Detect the format of a corpus from its path."""
+    if os.path.isdir(path):
+        return "directory"
+    name = path[:-len(".gz")] if path.endswith(".gz") else path
+    if name.endswith(".jsonl"):
+        return "jsonl"
+    if name.endswith(".tsv"):
+        return "tsv"
+    if name.endswith(".tar") or path.endswith(".tgz"):
+        return "tar"
+    if name.endswith(".pack"):
+        return "packed"
+    raise ValueError(f"Cannot detect the format of corpus '{path}', specify the corpus format.")
+
+
+def _open_text(path: str) -> io.TextIOBase:
+    if path.endswith(".gz"):
+        return io.TextIOWrapper(io.BufferedReader(gzip.open(path, "rb"), buffer_size=READ_BUFFER_SIZE),
+                                encoding="utf-8")
+    return open(path, "r", encoding="utf-8", buffering=READ_BUFFER_SIZE)
+
+
+class Corpus(ABC):
+    """
+    A collection of documents, read as (doc_id, text) records.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    @abstractmethod
+    def records(self) -> Iterator[Tuple[int, str]]:
+        """Return the (doc_id, text) records of all documents, in the order of the corpus."""
+
+    def shard_records(self, shard: int = 0, shards: int = 1) -> Iterator[Tuple[int, str]]:
+        """Return the records of the documents routed to a shard."""
+        for doc_id, text in self.records():
+            if shards <= 1 or shard_of(doc_id, shards) == shard:
+                yield doc_id, text
+
+
+class DirectoryCorpus(Corpus):
+    """A directory with a text file output_<id>.txt per document."""
+
+    def files(self, shard: int = 0, shards: int = 1) -> List[str]:
+        """Return the text files of the documents routed to a shard."""
+        return [entry.name for entry in os.scandir(self.path) if entry.name.endswith(".txt")
+                and (shards <= 1 or shard_of(extract_id_from_filename(entry.name), shards) == shard)]
+
+    def records(self) -> Iterator[Tuple[int, str]]:
+        for file in self.files():
+            with open(os.path.join(self.path, file), "r", encoding="utf-8") as f:
+                yield extract_id_from_filename(file), f.read()
+
+
+class JsonlCorpus(Corpus):
+    """
+    A (possibly gzipped) file with a JSON object per document, e.g. {"doc_id": 1, "text": "..."}. The "id" and
+    "contents" keys are accepted as well.
+    """
+
+    def records(self) -> Iterator[Tuple[int, str]]:
+        with _open_text(self.path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                doc_id = record["doc_id"] if "doc_id" in record else record["id"]
+                yield int(doc_id), record["text"] if "text" in record else record["contents"]
+
+
+class TsvCorpus(Corpus):
+    """
+    A (possibly gzipped) file with a line <doc_id>\\t<text> per document, optionally preceded by a header line.
+    """
+
+    def records(self) -> Iterator[Tuple[int, str]]:
+        with _open_text(self.path) as f:
+            for line_number, line in enumerate(f):
+                doc_id, _, text = line.rstrip("\n").partition("\t")
+                if line_number == 0 and not doc_id.strip().isdigit():
+                    continue  # header
+                yield int(doc_id), text
+
+
+class TarCorpus(Corpus):
+    """
+    A (possibly compressed) tar archive of output_<id>.txt files, read as a stream so the archive is never extracted.
+    """
+
+    def records(self) -> Iterator[Tuple[int, str]]:
+        with tarfile.open(self.path, mode="r|*", bufsize=READ_BUFFER_SIZE) as archive:
+            for member in archive:
+                if not member.isfile() or not member.name.endswith(".txt"):
+                    continue
+                yield extract_id_from_filename(member.name), archive.extractfile(member).read().decode("utf-8")
+
+
+class PackedCorpus(Corpus):
+    """
+    The texts of all documents concatenated in a single file (<name>.pack), with an offset table (<name>.pack
+    .offsets.npy) holding the id, start and end offset of every document. The file is memory-mapped, so documents are
+    sliced out of the page cache without any reads or file opens per document.
+    """
+
+    def __init__(self, path: str) -> None:
+        super().__init__(path)
+        self.offsets = np.load(path + OFFSETS_SUFFIX, mmap_mode="r")
+
+    def records(self) -> Iterator[Tuple[int, str]]:
+        return self.shard_records()
+
+    def shard_records(self, shard: int = 0, shards: int = 1) -> Iterator[Tuple[int, str]]:
+        # only the documents of the shard are sliced out of the file and decoded
+        if len(self.offsets) == 0:
+            return
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            data.madvise(mmap.MADV_SEQUENTIAL)
+            for block_start in range(0, len(self.offsets), OFFSETS_BLOCK_SIZE):
+                for doc_id, start, end in self.offsets[block_start:block_start + OFFSETS_BLOCK_SIZE].tolist():
+                    if shards <= 1 or shard_of(doc_id, shards) == shard:
+                        yield doc_id, data[start:end].decode("utf-8")
+
+
+def open_corpus(path: str, corpus_format: str = "auto") -> Corpus:
+    """
+    Open a corpus: a directory of text files, a JSONL, TSV or tar(.gz) file, or a packed file with an offset table.
+    """
+    if corpus_format == "auto":
+        corpus_format = detect_corpus_format(path)
+    corpora = {"directory": DirectoryCorpus, "jsonl": JsonlCorpus, "tsv": TsvCorpus, "tar": TarCorpus,
+               "packed": PackedCorpus}
+    if corpus_format not in corpora:
+        raise ValueError(f"Unknown corpus format: {corpus_format}")
+    return corpora[corpus_format](path)
+
+
+def pack_corpus(corpus: Corpus, output_file: str) -> int:
+    """
+    Write the documents of a corpus to a packed file with an offset table.
+
+    :return: The number of packed documents.
+    """
+    offsets = []
+    with open(output_file, "wb", buffering=READ_BUFFER_SIZE) as f:
+        for doc_id, text in corpus.records():
+            start = f.tell()
+            f.write(text.encode("utf-8"))
+            offsets.append((doc_id, start, f.tell()))
+    with open(output_file + OFFSETS_SUFFIX, "wb") as f:
+        np.save(f, np.array(offsets, dtype=np.int64).reshape(-1, 3))
+    return len(offsets)
+
+
+def main(args: Union[str, List[str]] = None) -> int:
+    parser = configargparse.ArgParser(description="IR: assignment 2, pack a corpus into a single file")
+    parser.add_argument("source", help="The corpus to pack (directory of text files, JSONL, TSV or tar file).")
+    parser.add_argument("output", help="The packed file to write (e.g. data/documents/full_docs.pack).")
+    parser.add_argument("--corpus_format", default="auto", choices=Config.VALID_CORPUS_FORMATS, help="Format of the source.")
+    parsed_args = parser.parse_args(args)
+
+    nr_docs = pack_corpus(open_corpus(parsed_args.source, parsed_args.corpus_format), parsed_args.output)
+    logging.info(f"Packed {nr_docs} documents into '{parsed_args.output}'.")
+    return 0
+
+
+if __name__ == "__main__":
+    # only configure logging when run as a script, the module is also imported by the indexer
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(main())
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+import zlib
+from typing import Iterable, Tuple, Dict, List, Optional, Set, Sequence
+
+import numpy as np
+
+DUPLICATES_FILE = "duplicates.json"
+MERSENNE_PRIME = (1 << 31) - 1  # hashes are permuted modulo this prime, so a * hash + b fits in 64 bits
+
+
+def choose_bands(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """
+    Choose the number of bands and rows per band of the LSH index, so documents whose estimated similarity exceeds the
+    threshold share a band with high probability: the similarity (1 / bands) ** (1 / rows) at which the probability of
+    sharing a band rises steeply is chosen as the highest one below the threshold. Candidates below the threshold are
+    filtered out by comparing their signatures, so missed duplicates cost more than extra candidates.
+
+    :return: The number of bands and the number of rows per band.
+    """
+    candidates = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    below = [candidate for candidate in candidates if (1 / candidate[0]) ** (1 / candidate[1]) <= threshold]
+    return max(below or candidates[:1], key=lambda candidate: (1 / candidate[0]) ** (1 / candidate[1]))
+
+
+class MinHasher:
+    """
+    Computes MinHash signatures of the word shingles of texts. The fraction of equal values in the signatures of two
+    texts estimates the Jaccard similarity of their sets of shingles.
+    """
+
+    def __init__(self, num_perm: int = 128, shingle_size: int = 5, seed: int = 1) -> None:
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        generator = np.random.default_rng(seed)
+        self._a = generator.integers(1, MERSENNE_PRIME, num_perm, dtype=np.uint64)[:, None]
+        self._b = generator.integers(0, MERSENNE_PRIME, num_perm, dtype=np.uint64)[:, None]
+
+    def shingle_hashes(self, text: str) -> np.ndarray:
+        """Hash the (distinct) shingles of shingle_size consecutive words of a text."""
+        words = text.lower().split()
+        word_hashes = np.fromiter((zlib.crc32(word.encode("utf-8")) for word in words), dtype=np.uint64,
+                                  count=len(words))
+        size = min(self.shingle_size, len(word_hashes))
+        if size == 0:
+            return np.zeros(1, dtype=np.uint64)
+        # polynomial rolling hash of every window of size words, modulo 2^32
+        hashes = np.zeros(len(word_hashes) - size + 1, dtype=np.uint64)
+        for offset in range(size):
+            hashes = (hashes * np.uint64(1_000_003) + word_hashes[offset:len(hashes) + offset]) & np.uint64(0xFFFFFFFF)
+        return np.unique(hashes % np.uint64(MERSENNE_PRIME))
+
+    def signature(self, text: str, block_size: int = 4096) -> np.ndarray:
+        """Compute the MinHash signature of a text, the shingles are permuted in blocks to bound memory use."""
+        hashes = self.shingle_hashes(text)
+        signature = np.full(self.num_perm, MERSENNE_PRIME, dtype=np.uint64)
+        for start in range(0, len(hashes), block_size):
+            permuted = (self._a * hashes[None, start:start + block_size] + self._b) % np.uint64(MERSENNE_PRIME)
+            np.minimum(signature, permuted.min(axis=1), out=signature)
+        return signature.astype(np.uint32)
+
+
+class NearDuplicateDetector:
+    """
+    Clusters near-duplicate documents in a single streaming pass with MinHash and locality-sensitive hashing.
+
+    Every document is compared with the canonical documents seen so far that share a band of its signature, and joins
+    the cluster of the first one whose estimated similarity reaches the threshold; otherwise it becomes the canonical
+    document of a new cluster.
+
+    The LSH table (a hash of every band of every canonical document) and the signatures of the canonical documents are
+    kept in a private temporary SQLite database, which lives on disk beyond a page cache of cache_mb, so memory use
+    does not grow with the corpus. Only the ids of the duplicates found are kept in memory.
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 128, shingle_size: int = 5,
+                 cache_mb: int = 64) -> None:
+        self.threshold = threshold
+        self.min_hasher = MinHasher(num_perm=num_perm, shingle_size=shingle_size)
+        self.bands, self.rows = choose_bands(threshold, num_perm)
+        # an empty file name opens a temporary database on disk, deleted when it is closed
+        self._connection = sqlite3.connect("")
+        self._connection.execute(f"PRAGMA cache_size = {-cache_mb * 1024}")
+        self._connection.execute("PRAGMA journal_mode = OFF")
+        self._connection.execute("PRAGMA synchronous = OFF")
+        self._connection.execute("CREATE TABLE canonicals (canonical INTEGER PRIMARY KEY, doc_id INTEGER NOT NULL, "
+                                 "signature BLOB NOT NULL)")
+        self._connection.execute("CREATE TABLE buckets (bucket INTEGER NOT NULL, canonical INTEGER NOT NULL)")
+        self._connection.execute("CREATE INDEX buckets_bucket ON buckets (bucket)")
+        self._nr_canonicals = 0
+        self.duplicates: Dict[int, List[int]] = {}  # canonical document id -> ids of its duplicates
+
+    def _bucket(self, band: int, signature: np.ndarray) -> int:
+        """Hash a band of a signature to a signed 64-bit bucket, colliding buckets only add candidates."""
+        digest = hashlib.blake2b(signature[band * self.rows:(band + 1) * self.rows].tobytes(), digest_size=8,
+                                 salt=band.to_bytes(2, "little"))
+        return int.from_bytes(digest.digest(), "little", signed=True)
+
+    def add(self, doc_id: int, text: str) -> Optional[int]:
+        """
+        Add a document to the clusters.
+
+        :return: The id of the canonical document of its cluster if the document is a near-duplicate, None otherwise.
+        """
+        signature = self.min_hasher.signature(text)
+        buckets = [self._bucket(band, signature) for band in range(self.bands)]
+        candidates = self._connection.execute(
+            f"SELECT canonical, doc_id, signature FROM canonicals WHERE canonical IN "
+            f"(SELECT canonical FROM buckets WHERE bucket IN ({', '.join('?' * len(buckets))})) ORDER BY canonical",
+            buckets).fetchall()
+        for _, canonical_id, canonical_signature in candidates:
+            if np.mean(np.frombuffer(canonical_signature, dtype=np.uint32) == signature) >= self.threshold:
+                self.duplicates.setdefault(canonical_id, []).append(doc_id)
+                return canonical_id
+
+        canonical = self._nr_canonicals
+        self._nr_canonicals += 1
+        self._connection.execute("INSERT INTO canonicals VALUES (?, ?, ?)", (canonical, doc_id, signature.tobytes()))
+        self._connection.executemany("INSERT INTO buckets VALUES (?, ?)", [(bucket, canonical) for bucket in buckets])
+        return None
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+def detect_near_duplicates(records: Iterable[Tuple[int, str]], threshold: float = 0.8) -> Dict[int, List[int]]:
+    """
+    Find the near-duplicate documents of a corpus, streaming its (doc_id, text) records once.
+
+    :return: The ids of the duplicates of every canonical document that has duplicates.
+    """
+    start_time = time.time()
+    detector = NearDuplicateDetector(threshold=threshold)
+    nr_docs = 0
+    try:
+        for doc_id, text in records:
+            detector.add(doc_id, text)
+            nr_docs += 1
+    finally:
+        detector.close()
+    nr_duplicates = sum(len(duplicates) for duplicates in detector.duplicates.values())
+    logging.info(f"Found {nr_duplicates} near-duplicates of {len(detector.duplicates)} documents among {nr_docs} "
+                 f"documents ({nr_duplicates / max(nr_docs, 1):.1%}, similarity threshold {threshold}) in "
+                 f"{time.time() - start_time:.2f} seconds.")
+    return detector.duplicates
+
+
+class DuplicateMap:
+    """
+    The near-duplicates of the canonical documents of an index, stored in the index directory. Rankings of a
+    deduplicated index can be expanded with the duplicates of their documents.
+    """
+
+    def __init__(self, duplicates: Dict[int, List[int]]) -> None:
+        self.duplicates = duplicates
+
+    @property
+    def duplicate_ids(self) -> Set[int]:
+        """The ids of all duplicates, which are not indexed."""
+        return {doc_id for duplicates in self.duplicates.values() for doc_id in duplicates}
+
+    def save(self, index_path: str) -> None:
+        self.save_file(os.path.join(index_path, DUPLICATES_FILE))
+
+    def save_file(self, file: str) -> None:
+        """Write the duplicates to a JSON file, through a temporary file so a crash never leaves a partial file."""
+        directory = os.path.dirname(file) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({str(canonical): duplicates for canonical, duplicates in self.duplicates.items()}, f)
+        os.replace(tmp_path, file)
+
+    @staticmethod
+    def load(index_path: str) -> "DuplicateMap":
+        """Load the duplicates of an index, an index without duplicates file has none."""
+        duplicates_file = os.path.join(index_path, DUPLICATES_FILE)
+        if not os.path.exists(duplicates_file):
+            return DuplicateMap({})
+        return DuplicateMap.load_file(duplicates_file)
+
+    @staticmethod
+    def load_file(file: str) -> "DuplicateMap":
+        with open(file, "r", encoding="utf-8") as f:
+            return DuplicateMap({int(canonical): duplicates for canonical, duplicates in json.load(f).items()})
+
+    def expand(self, doc_ids: Sequence[int], scores: Sequence[float],
+               top_k: Optional[int] = None) -> Tuple[List[int], List[float]]:
+        """
+        Expand a ranking with the duplicates of its documents, every duplicate ranked right after its canonical
+        document with the same score.
+
+        :param top_k: Number of documents kept of the expanded ranking; all if None.
+        """
+        expanded_ids, expanded_scores = [], []
+        for doc_id, score in zip(doc_ids, scores):
+            cluster = [doc_id] + self.duplicates.get(doc_id, [])
+            expanded_ids.extend(cluster)
+            expanded_scores.extend([score] * len(cluster))
+        return expanded_ids[:top_k], expanded_scores[:top_k]
+
+    def __len__(self) -> int:
+        return len(self.duplicates)
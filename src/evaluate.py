@@ -1,8 +1,13 @@
+import functools
 import logging
+import os
+from typing import Dict, Sequence, Tuple
 
 import numpy as np
 import pandas as pd
 
+from .run import Run
+
 
 class Evaluation:
     def __init__(self, map_at_k: float, mar_at_k: float):
@@ -14,77 +19,136 @@ class Evaluation:
         return csv_entry
 
 
+def load_results(file: str, chunk_size: int = 1_000_000) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load a result file (Query_number,doc_number) into arrays. The file is read in chunks, so only the compact arrays
+    are kept in memory.
+
+    :return: The query numbers and document numbers, in file order.
+    """
+    query_chunks, doc_chunks = [], []
+    for chunk in pd.read_csv(file, usecols=["Query_number", "doc_number"], chunksize=chunk_size,
+                             compression="infer"):
+        query_chunks.append(chunk["Query_number"].to_numpy())
+        doc_chunks.append(chunk["doc_number"].to_numpy())
+    if not query_chunks:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(query_chunks), np.concatenate(doc_chunks)
+
+
+@functools.lru_cache(maxsize=4)
+def _load_cached_results(file: str, modified: int, size: int) -> Tuple[np.ndarray, np.ndarray]:
+    queries, docs = load_results(file)
+    queries.flags.writeable = docs.flags.writeable = False  # shared by all evaluations against the file
+    return queries, docs
+
+
+def load_reference_results(file: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load a reference file (see load_results) once: the arrays are kept in memory and shared by every evaluation against
+    the file, until the file changes.
+    """
+    stat = os.stat(file)
+    return _load_cached_results(os.path.abspath(file), stat.st_mtime_ns, stat.st_size)
+
+
 def evaluate(result_file: str, expected_result_file: str, k: int) -> Evaluation:
-    result = pd.read_csv(result_file)
-    expected = pd.read_csv(expected_result_file)
-    result_dict = dict()
-    expected_dict = dict()
-    for i, (_, row) in enumerate(result.iterrows()):
-        if row["Query_number"] not in result_dict:
-            result_dict[row["Query_number"]] = []
-        result_dict[row["Query_number"]].append(row["doc_number"])
-    for i, (_, row) in enumerate(expected.iterrows()):
-        if row["Query_number"] not in expected_dict:
-            expected_dict[row["Query_number"]] = []
-        expected_dict[row["Query_number"]].append(row["doc_number"])
-    map_at_k = evaluate_precision(expected_dict, result_dict, k)
-    mar_at_k = evaluate_recall(expected_dict, result_dict, k)
-    return Evaluation(map_at_k, mar_at_k)
-
-
-def evaluate_precision(result_dict: dict, expected_dict: dict, k: int) -> float:
-    precision_list = []
-    for key in result_dict.keys():
-        relevant_precisions = []
-        relevant_docs_count = 0
-
-        if key in expected_dict.keys():
-            # calculate precision only in the top k
-            for i, doc_id in enumerate(result_dict[key][:k]):
-                if doc_id in expected_dict[key]:  # calculate precision only if the document is relevant
-                    relevant_docs_count += 1
-                    relevant_precisions.append(relevant_docs_count / (i + 1))
-
-            # average precision for query
-            if relevant_precisions:
-                precision_list.append(np.mean(relevant_precisions))
-            else:
-                precision_list.append(0)
-        else:
-            precision_list.append(0)
-
-    # mean average precision
-    if precision_list:
-        result = np.mean(precision_list)
-        logging.info(f'Mean Average Precision at {k}: {result}')
-        return result
-    else:
-        logging.info(f'Mean Average Precision at {k}: 0')
-        return 0
-
-
-def evaluate_recall(result_dict: dict, expected_dict: dict, k: int) -> float:
-    recall_list = []
-    for key in result_dict.keys():
-        if key in expected_dict.keys():
-            relevant_docs = get_amount_of_relevant_docs(result_dict, expected_dict, key, k)
-            recall_list.append(relevant_docs / len(expected_dict[key]))
-        else:
-            recall_list.append(0)
-    if len(recall_list) != 0:
-        result = np.mean(recall_list)
-        logging.info(f'Mean average recall at {k}: {result}')
-        return result
-    else:
-        logging.info(f'Mean average recall at {k}: 0')
-        return 0.0
-
-
-def get_amount_of_relevant_docs(result_dict: dict, expected_dict: dict, key: str, k: int):
-    expected_list = expected_dict[key]
-    relevant_docs = 0
-    for i in range(min(k, len(result_dict[key]))):
-        result = result_dict[key][i]
-        if result in expected_list:
-            relevant_docs += 1
-    return relevant_docs
+    return evaluate_all(result_file, expected_result_file, [k])[k]
+
+
+def evaluate_all(result_file: str, expected_result_file: str, k_list: Sequence[int]) -> Dict[int, Evaluation]:
+    """
+    Evaluate a result file against a reference file for every k in k_list, reading each file only once.
+    """
+    result_queries, result_docs = load_results(result_file)
+    expected_queries, expected_docs = load_reference_results(expected_result_file)
+    return evaluate_arrays(result_queries, result_docs, expected_queries, expected_docs, k_list)
+
+
+def evaluate_run(run: Run, expected_result_file: str, k_list: Sequence[int]) -> Dict[int, Evaluation]:
+    """
+    Evaluate a run kept in memory against a reference file for every k in k_list, without writing and reading back its
+    rankings.
+    """
+    expected_queries, expected_docs = load_reference_results(expected_result_file)
+    return evaluate_arrays(run.query_numbers, run.doc_ids, expected_queries, expected_docs, k_list)
+
+
+def evaluate_arrays(result_queries: np.ndarray, result_docs: np.ndarray, expected_queries: np.ndarray,
+                    expected_docs: np.ndarray, k_list: Sequence[int]) -> Dict[int, Evaluation]:
+    """
+    Compute MAP@K and MAR@K for every k in k_list in a single vectorized pass.
+
+    For every query of the reference results, the first k reference documents (in file order) are checked against the
+    documents found for the query. A reference document is relevant when it was found. The average precision of a
+    query is the mean of the precisions at the relevant positions, its recall is the number of relevant documents
+    divided by the number of documents found. Queries without results score 0.
+
+    :param result_queries: Query number of every result entry.
+    :param result_docs: Document number of every result entry.
+    :param expected_queries: Query number of every reference entry.
+    :param expected_docs: Document number of every reference entry.
+    :param k_list: The cut-offs to evaluate.
+    :return: The evaluation for every k.
+    """
+    max_k = max(k_list)
+    nr_expected = len(expected_queries)
+
+    # dense integer codes for query and document numbers, shared by results and reference
+    query_codes, query_numbers = pd.factorize(np.concatenate([expected_queries, result_queries]))
+    doc_codes, doc_numbers = pd.factorize(np.concatenate([expected_docs, result_docs]))
+    nr_queries = len(query_numbers)
+    pair_keys = query_codes.astype(np.int64) * max(len(doc_numbers), 1) + doc_codes
+    expected_codes = query_codes[:nr_expected]
+
+    # position of every reference entry within the entries of its query
+    order = np.argsort(expected_codes, kind="stable")
+    sorted_codes = expected_codes[order]
+    positions = np.empty(nr_expected, dtype=np.int64)
+    positions[order] = np.arange(nr_expected) - np.searchsorted(sorted_codes, sorted_codes, side="left")
+
+    # relevance matrix: queries x positions, True when the reference document was found for the query
+    relevant = np.isin(pair_keys[:nr_expected], pair_keys[nr_expected:])
+    in_top = positions < max_k
+    relevance = np.zeros((nr_queries, max_k), dtype=bool)
+    relevance[expected_codes[in_top], positions[in_top]] = relevant[in_top]
+
+    # only the queries of the reference results are evaluated
+    is_expected = np.zeros(nr_queries, dtype=bool)
+    is_expected[expected_codes] = True
+    relevance = relevance[is_expected]
+    nr_found = np.bincount(query_codes[nr_expected:], minlength=nr_queries)[is_expected]
+
+    average_precisions, recalls = average_precisions_and_recalls(relevance, nr_found, k_list)
+
+    evaluations = {}
+    for column, k in enumerate(k_list):
+        map_at_k = float(np.mean(average_precisions[:, column])) if len(average_precisions) else 0.0
+        mar_at_k = float(np.mean(recalls[:, column])) if len(recalls) else 0.0
+        logging.info(f'Mean Average Precision at {k}: {map_at_k}')
+        logging.info(f'Mean average recall at {k}: {mar_at_k}')
+        evaluations[k] = Evaluation(map_at_k, mar_at_k)
+    return evaluations
+
+
+def average_precisions_and_recalls(relevance: np.ndarray, nr_found: np.ndarray,
+                                   k_list: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the average precision and the recall of every ranking for every k in k_list (see evaluate_arrays).
+
+    :param relevance: Whether the reference document at every position was found, of shape (rankings, positions) with
+    at least max(k_list) positions.
+    :param nr_found: The number of documents found for every ranking.
+    :param k_list: The cut-offs to evaluate.
+    :return: The average precisions and the recalls, both of shape (rankings, len(k_list)).
+    """
+    relevant_so_far = np.cumsum(relevance, axis=1)
+    precisions = relevant_so_far / np.arange(1, relevance.shape[1] + 1)
+    average_precisions = np.zeros((len(relevance), len(k_list)))
+    recalls = np.zeros((len(relevance), len(k_list)))
+    for column, k in enumerate(k_list):
+        nr_relevant = relevant_so_far[:, k - 1]
+        precision_sum = np.sum(precisions[:, :k] * relevance[:, :k], axis=1)
+        np.divide(precision_sum, nr_relevant, out=average_precisions[:, column], where=nr_relevant > 0)
+        np.divide(nr_relevant, nr_found, out=recalls[:, column], where=nr_found > 0)
+    return average_precisions, recalls
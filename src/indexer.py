@@ -0,0 +1,429 @@
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import Iterable, Callable, Optional, List, Dict, Tuple, Sequence, AbstractSet
+
+from java.nio.file import Paths
+from org.apache.lucene.document import Document, TextField, Field, StoredField, NumericDocValuesField, StringField
+from org.apache.lucene.index import IndexWriter, IndexWriterConfig, TieredMergePolicy, LogByteSizeMergePolicy, \
+    LogDocMergePolicy, NoMergePolicy, Term
+from org.apache.lucene.store import FSDirectory
+
+from .analyzer import AnalyzerFactory, MULTI_FIELD_ANALYZER, SHINGLES_SUFFIX
+from .catalog import IndexCatalog
+from .corpus import open_corpus, extract_id_from_filename, DirectoryCorpus, corpus_name
+from .dedup import detect_near_duplicates, DuplicateMap
+from .instrumentation import metrics
+from .jvm import init_vm, attach_current_thread
+from .manifest import IndexManifest, content_hash
+from .shards import shard_of, get_shard_paths
+from .similarity import SimilarityFactory
+
+DUPLICATES_CACHE_DIR = "duplicates"  # near-duplicates detected per corpus, in the index directory
+
+
+def doc_id_term(doc_id: int) -> Term:
+    """Return the term that identifies the document with the given id in the index."""
+    return Term("doc_id", str(doc_id))
+
+
+def index_txt_file(ind_writer: IndexWriter, data_dir: str, file: str, update: bool = False,
+                   text_fields: Sequence[str] = ("text_content",)) -> str:
+    """
+    Indexes a single text file.
+
+    :param update: Replace the document with the same id, if any, instead of adding a new document.
+    :param text_fields: The fields the text is indexed in.
+    :return: The content hash of the file.
+    """
+    data_path = os.path.join(data_dir, file)
+    with metrics.timer("document_read"):
+        with open(data_path, "r", encoding='utf-8') as f:
+            text_to_index = f.read()
+    return index_document(ind_writer, extract_id_from_filename(file), text_to_index, update=update,
+                          text_fields=text_fields)
+
+
+def index_document(ind_writer: IndexWriter, doc_id: int, text: str, update: bool = False,
+                   text_fields: Sequence[str] = ("text_content",)) -> str:
+    """
+    Indexes the text of a single document.
+
+    :param update: Replace the document with the same id, if any, instead of adding a new document.
+    :param text_fields: The fields the text is indexed in, every field is analyzed by the analyzer the index writer
+    uses for that field.
+    :return: The content hash of the document.
+    """
+    doc = Document()
+    for text_field in text_fields:
+        doc.add(TextField(text_field, text, Field.Store.NO))  # Don't store the text field
+    doc.add(StoredField("doc_id", doc_id))  # stored but not indexed
+    doc.add(NumericDocValuesField("doc_id", doc_id))  # column-stride copy for fast id lookups while ranking
+    doc.add(StringField("doc_id", str(doc_id), Field.Store.NO))  # indexed as a single term to update by id
+    with metrics.timer("add_document"):  # includes the analysis of the text
+        if update:
+            ind_writer.updateDocument(doc_id_term(doc_id), doc)
+        else:
+            ind_writer.addDocument(doc)
+    metrics.increment("documents_indexed")
+    return content_hash(text)
+
+
+def create_merge_policy(merge_policy: str, merge_factor: int) -> "MergePolicy":
+    """
+    Create the Lucene merge policy used while indexing.
+
+    :param merge_policy: The merge policy (tiered, log_byte_size, log_doc, none).
+    :param merge_factor: How many segments are merged at once (segments per tier for the tiered policy).
+    :return: The merge policy.
+    """
+    if merge_policy == "tiered":
+        # https://lucene.apache.org/core/9_12_0/core/org/apache/lucene/index/TieredMergePolicy.html
+        policy = TieredMergePolicy()
+        policy.setSegmentsPerTier(float(merge_factor))
+        return policy
+    elif merge_policy == "log_byte_size":
+        # https://lucene.apache.org/core/9_12_0/core/org/apache/lucene/index/LogByteSizeMergePolicy.html
+        policy = LogByteSizeMergePolicy()
+        policy.setMergeFactor(merge_factor)
+        return policy
+    elif merge_policy == "log_doc":
+        # https://lucene.apache.org/core/9_12_0/core/org/apache/lucene/index/LogDocMergePolicy.html
+        policy = LogDocMergePolicy()
+        policy.setMergeFactor(merge_factor)
+        return policy
+    elif merge_policy == "none":
+        return NoMergePolicy.INSTANCE
+    else:
+        raise ValueError(f"Unknown merge policy: {merge_policy}")
+
+
+def create_index_writer_config(analyzer: "Analyzer", similarity: "Similarity", ram_buffer_mb: float = 16.0,
+                               merge_policy: str = "tiered", merge_factor: int = 10,
+                               open_mode: "IndexWriterConfig.OpenMode" = IndexWriterConfig.OpenMode.CREATE
+                               ) -> IndexWriterConfig:
+    """
+    Set up an IndexWriterConfig with the specified analyzer, similarity and buffering/merging settings.
+
+    :param ram_buffer_mb: Amount of RAM (in MB) used to buffer added documents before they are flushed as a segment.
+    :param merge_policy: The merge policy (tiered, log_byte_size, log_doc, none).
+    :param merge_factor: How many segments are merged at once.
+    :param open_mode: CREATE overwrites existing index files, APPEND updates an existing index.
+    """
+    index_writer_config = IndexWriterConfig(analyzer)
+    index_writer_config.setSimilarity(similarity)
+    index_writer_config.setOpenMode(open_mode)
+    index_writer_config.setRAMBufferSizeMB(ram_buffer_mb)
+    index_writer_config.setMergePolicy(create_merge_policy(merge_policy, merge_factor))
+    return index_writer_config
+
+
+def _run_bounded(executor: ThreadPoolExecutor, fn: Callable, items: Iterable, max_in_flight: int) -> List:
+    """
+    Submit fn(item) for every item to the executor, while keeping at most max_in_flight tasks queued. Exceptions raised
+    by a task are re-raised in the calling thread.
+
+    :return: The results of the tasks, in completion order.
+    """
+    results = []
+    pending = set()
+    for item in items:
+        if len(pending) >= max_in_flight:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            results.extend(future.result() for future in done)
+        pending.add(executor.submit(fn, item))
+    results.extend(future.result() for future in wait(pending).done)
+    return results
+
+
+def index_directory(ind_writer: IndexWriter, data_dir: str, num_threads: int = 1, files: Optional[List[str]] = None,
+                    update: bool = False, text_fields: Sequence[str] = ("text_content",)) -> Dict[str, str]:
+    """
+    Indexes all text files in a directory. With more than one thread, the files are read and parsed by a bounded pool
+    of worker threads that all feed the (thread-safe) IndexWriter, so document analysis runs concurrently.
+
+    :param ind_writer: The index writer.
+    :param data_dir: Directory containing the documents.
+    :param num_threads: Number of worker threads.
+    :param files: The files to index; all text files in data_dir if None.
+    :param update: Replace existing documents with the same id instead of adding new documents.
+    :param text_fields: The fields the text is indexed in.
+    :return: The content hash of every indexed file.
+    """
+    start_time = time.time()
+    if files is None:
+        files = [entry.name for entry in os.scandir(data_dir) if entry.name.endswith(".txt")]
+
+    def index_file(file: str) -> Tuple[str, str]:
+        return file, index_txt_file(ind_writer, data_dir, file, update=update, text_fields=text_fields)
+
+    if num_threads <= 1:
+        hashes = dict(index_file(file) for file in files)
+    else:
+        with ThreadPoolExecutor(max_workers=num_threads, initializer=attach_current_thread) as executor:
+            hashes = dict(_run_bounded(executor, index_file, files, max_in_flight=4 * num_threads))
+    elapsed_time = time.time() - start_time
+    logging.info(f"Indexed {len(files)} documents in {elapsed_time:.2f} seconds "
+                 f"({len(files) / max(elapsed_time, 1e-9):.1f} docs/s, {num_threads} thread(s)).")
+    return hashes
+
+
+def index_records(ind_writer: IndexWriter, records: Iterable[Tuple[int, str]], num_threads: int = 1,
+                  text_fields: Sequence[str] = ("text_content",)) -> int:
+    """
+    Indexes (doc_id, text) records, e.g. of a packed corpus. The records are read sequentially by the calling thread,
+    with more than one thread they are analyzed and added by a bounded pool of worker threads.
+
+    :return: The number of indexed documents.
+    """
+    start_time = time.time()
+
+    def index_record(record: Tuple[int, str]) -> None:
+        index_document(ind_writer, *record, text_fields=text_fields)
+
+    nr_docs = 0
+    if num_threads <= 1:
+        for record in records:
+            index_record(record)
+            nr_docs += 1
+    else:
+        with ThreadPoolExecutor(max_workers=num_threads, initializer=attach_current_thread) as executor:
+            nr_docs = len(_run_bounded(executor, index_record, records, max_in_flight=4 * num_threads))
+    elapsed_time = time.time() - start_time
+    logging.info(f"Indexed {nr_docs} documents in {elapsed_time:.2f} seconds "
+                 f"({nr_docs / max(elapsed_time, 1e-9):.1f} docs/s, {num_threads} thread(s)).")
+    return nr_docs
+
+
+def partition_files(files: List[str], shards: int) -> List[List[str]]:
+    """Split text files into the files of every shard, routing every document on its id."""
+    partitions = [[] for _ in range(shards)]
+    for file in files:
+        partitions[shard_of(extract_id_from_filename(file), shards)].append(file)
+    return partitions
+
+
+def update_index(ind_writers: List[IndexWriter], data_dir: str, manifest: IndexManifest, num_threads: int = 1,
+                 text_fields: Sequence[str] = ("text_content",)) -> None:
+    """
+    Brings an existing index up to date with the text files in data_dir: documents of removed files are deleted,
+    documents of changed files are replaced and added files are indexed. Unchanged files are not touched.
+
+    :param ind_writers: The index writer of every shard of the index, documents are updated in the shard they are
+    routed to.
+    """
+    diff = manifest.diff(data_dir)
+    logging.info(f"Incremental update of the index: {len(diff.added)} added, {len(diff.changed)} changed and "
+                 f"{len(diff.removed)} removed file(s).")
+    shards = len(ind_writers)
+    for file in diff.removed:
+        doc_id = extract_id_from_filename(file)
+        ind_writers[shard_of(doc_id, shards)].deleteDocuments(doc_id_term(doc_id))
+    hashes = {}
+    for ind_writer, files in zip(ind_writers, partition_files(diff.added + diff.changed, shards)):
+        hashes.update(index_directory(ind_writer, data_dir, num_threads=num_threads, files=files, update=True,
+                                      text_fields=text_fields))
+    manifest.update(data_dir, hashes, removed=diff.removed)
+
+
+def open_index_writer(index_path: str, analyzer_type: str, similarity_type: str, ram_buffer_mb: float = 16.0,
+                      merge_policy: str = "tiered", merge_factor: int = 10,
+                      open_mode: "IndexWriterConfig.OpenMode" = IndexWriterConfig.OpenMode.CREATE) -> IndexWriter:
+    """
+    Open an index writer on (a shard of) an index.
+    """
+    # Set up IndexWriterConfig with specified analyzer and buffering/merging settings. The norms written at index
+    # time do not depend on the similarity parameters, so the default parameters are used.
+    with metrics.timer("analyzer_create"):
+        analyzer = AnalyzerFactory.get_analyzer(analyzer_type)
+    similarity = SimilarityFactory.get_similarity(similarity_type=similarity_type)
+    index_writer_config = create_index_writer_config(analyzer, similarity, ram_buffer_mb=ram_buffer_mb,
+                                                     merge_policy=merge_policy, merge_factor=merge_factor,
+                                                     open_mode=open_mode)
+    # Create and open the index directory
+    index_dir = FSDirectory.open(Paths.get(index_path))
+    return IndexWriter(index_dir, index_writer_config)
+
+
+def close_index_writer(ind_writer: IndexWriter) -> None:
+    with metrics.timer("index_commit"):
+        ind_writer.commit()
+    with metrics.timer("index_merge"):  # closing waits for the running merges
+        ind_writer.close()
+
+
+def build_shard(index_path: str, data_dir: str, analyzer_type: str, similarity_type: str, shard: int = 0,
+                shards: int = 1, corpus_format: str = "auto", num_threads: int = 1, ram_buffer_mb: float = 16.0,
+                merge_policy: str = "tiered", merge_factor: int = 10,
+                skip_doc_ids: AbstractSet[int] = frozenset()) -> Dict[str, str]:
+    """
+    Build (a shard of) an index from scratch with the documents of the corpus routed to the shard. The shards of a
+    sharded index are built in separate processes, so the JVM is started if needed.
+
+    :param skip_doc_ids: The ids of the documents that are not indexed (e.g. near-duplicates).
+    :return: The content hash of every indexed text file (none for packed corpora).
+    """
+    init_vm()
+    corpus = open_corpus(data_dir, corpus_format)
+    text_fields = AnalyzerFactory.get_text_fields(analyzer_type)
+    index_writer = open_index_writer(index_path, analyzer_type, similarity_type, ram_buffer_mb=ram_buffer_mb,
+                                     merge_policy=merge_policy, merge_factor=merge_factor)
+    try:
+        if isinstance(corpus, DirectoryCorpus):
+            files = [file for file in corpus.files(shard, shards)
+                     if not skip_doc_ids or extract_id_from_filename(file) not in skip_doc_ids]
+            return index_directory(index_writer, data_dir, num_threads=num_threads, files=files,
+                                   text_fields=text_fields)
+        records = ((doc_id, text) for doc_id, text in corpus.shard_records(shard, shards)
+                   if doc_id not in skip_doc_ids)
+        index_records(index_writer, records, num_threads=num_threads, text_fields=text_fields)
+        return {}
+    finally:
+        close_index_writer(index_writer)
+
+
+def build_shards(index_path: str, data_dir: str, analyzer_type: str, similarity_type: str, shards: int = 1,
+                 corpus_format: str = "auto", num_threads: int = 1, ram_buffer_mb: float = 16.0,
+                 merge_policy: str = "tiered", merge_factor: int = 10,
+                 skip_doc_ids: AbstractSet[int] = frozenset()) -> Dict[str, str]:
+    """
+    Build an index of all documents of a corpus from scratch. The documents of a sharded index are partitioned on
+    their id and the shards are built in parallel by a pool of processes (each with its own JVM, so indexing is not
+    limited by the GIL), which share the indexing threads.
+
+    :param skip_doc_ids: The ids of the documents that are not indexed (e.g. near-duplicates).
+    :return: The content hash of every indexed text file (none for packed corpora).
+    """
+    arguments = {"analyzer_type": analyzer_type, "similarity_type": similarity_type, "corpus_format": corpus_format,
+                 "ram_buffer_mb": ram_buffer_mb, "merge_policy": merge_policy, "merge_factor": merge_factor,
+                 "skip_doc_ids": skip_doc_ids}
+    if shards <= 1:
+        return build_shard(index_path, data_dir, num_threads=num_threads, **arguments)
+
+    hashes = {}
+    threads_per_shard = max(1, num_threads // shards)
+    # the JVM does not survive a fork, so the worker processes are spawned
+    with ProcessPoolExecutor(max_workers=min(shards, os.cpu_count() or 1),
+                             mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [executor.submit(build_shard, shard_path, data_dir, shard=shard, shards=shards,
+                                   num_threads=threads_per_shard, **arguments)
+                   for shard, shard_path in enumerate(get_shard_paths(index_path, shards))]
+        for future in futures:
+            hashes.update(future.result())
+    return hashes
+
+
+def _dedup_name(threshold: float) -> str:
+    # the exact threshold, without its decimal point as the k1 and b of run names, so different thresholds never share
+    # an index or detected duplicates
+    return f"dedup{str(threshold).replace('.', '')}"
+
+
+def find_near_duplicates(catalog: IndexCatalog, data_dir: str, threshold: float,
+                         corpus_format: str = "auto") -> DuplicateMap:
+    """
+    Detect the near-duplicate documents of a corpus (see detect_near_duplicates). The whole corpus is clustered before
+    it is partitioned, so duplicates routed to different shards are found.
+
+    The duplicates do not depend on the analyzer, so they are detected once per contents of the corpus: they are stored
+    in the index directory under the fingerprint of the corpus, and reused by the deduplicated index of every analyzer.
+    """
+    cache_dir = os.path.join(catalog.index_dir, DUPLICATES_CACHE_DIR)
+    prefix = f"{corpus_name(data_dir)}_{_dedup_name(threshold)}_"
+    cache_file = os.path.join(cache_dir, f"{prefix}{catalog.fingerprint(data_dir)}.json")
+    if os.path.exists(cache_file):
+        logging.info(f"Reusing the near-duplicates detected in {data_dir} from '{cache_file}'.")
+        return DuplicateMap.load_file(cache_file)
+
+    with metrics.timer("deduplication"):
+        duplicate_map = DuplicateMap(detect_near_duplicates(open_corpus(data_dir, corpus_format).records(),
+                                                            threshold=threshold))
+    if os.path.isdir(cache_dir):
+        # the duplicates detected in earlier contents of the corpus are stale
+        for entry in os.scandir(cache_dir):
+            if entry.name.startswith(prefix) and entry.name.endswith(".json"):
+                os.remove(entry.path)
+    duplicate_map.save_file(cache_file)
+    return duplicate_map
+
+
+def ensure_index(catalog: IndexCatalog, data_dir: str, analyzer_type: str, similarity_type: str,
+                 num_threads: int = 1, ram_buffer_mb: float = 16.0, merge_policy: str = "tiered",
+                 merge_factor: int = 10, incremental: bool = False, shards: int = 1,
+                 corpus_format: str = "auto", multi_field: bool = False, shingles: bool = False,
+                 dedup_threshold: float = 0.0) -> str:
+    """
+    Make sure an up-to-date index exists for the documents in data_dir, the analyzer and the norm encoding of the
+    similarity, building it if needed.
+
+    :param data_dir: The corpus: a directory of text files or a packed corpus file.
+    :param incremental: Update an outdated index with only the added, changed and removed files, instead of rebuilding
+    it from scratch. Requires the manifest written when the index was built and a directory of text files.
+    :param shards: Number of shards the documents are partitioned across.
+    :param corpus_format: The format of the corpus, detected from data_dir if auto.
+    :param multi_field: Index the text in a field per analyzer (see get_field_name), so a single index serves every
+    analyzer.
+    :param shingles: Also index the two-word shingles of every text field (see get_shingle_field_name).
+    :param dedup_threshold: If positive, near-duplicate documents (with an estimated Jaccard similarity of their word
+    shingles of at least the threshold) are detected before indexing and only the first document of every cluster is
+    indexed (see DuplicateMap). Cannot be combined with incremental updates.
+    :return: The path of the index.
+    """
+    if dedup_threshold > 0 and incremental:
+        raise ValueError("Near-duplicate detection clusters the whole corpus, it cannot be combined with incremental "
+                         "updates.")
+    if multi_field:
+        analyzer_type = MULTI_FIELD_ANALYZER
+    if shingles:
+        analyzer_type += SHINGLES_SUFFIX
+    # a deduplicated index holds other documents than a full index, so it is cataloged under its own name
+    index_name = f"{analyzer_type}_{_dedup_name(dedup_threshold)}" if dedup_threshold > 0 else analyzer_type
+    norm_encoding = SimilarityFactory.get_norm_encoding(similarity_type)
+    analyzer_signature = AnalyzerFactory.get_signature(analyzer_type)
+    full_index_path = catalog.get_index_path(data_dir, index_name, norm_encoding, shards)
+    if catalog.is_up_to_date(data_dir, index_name, norm_encoding, analyzer_signature, shards):
+        logging.info(f"Index directory '{full_index_path}' is up to date, skipping indexing.")
+        return full_index_path
+
+    os.makedirs(full_index_path, exist_ok=True)
+    manifest = IndexManifest(full_index_path)
+    # documents can only be updated in place if the index was built with the same analyzer
+    entry = catalog.lookup(data_dir, index_name, norm_encoding, shards)
+    update = (incremental and entry is not None and entry.get("analyzer_signature") == analyzer_signature
+              and manifest.exists())
+    if update and not isinstance(open_corpus(data_dir, corpus_format), DirectoryCorpus):
+        logging.info("Incremental updates need a directory of text files, rebuilding the index of the packed corpus.")
+        update = False
+
+    if update:
+        index_writers = [open_index_writer(shard_path, analyzer_type, similarity_type, ram_buffer_mb=ram_buffer_mb,
+                                           merge_policy=merge_policy, merge_factor=merge_factor,
+                                           open_mode=IndexWriterConfig.OpenMode.APPEND)
+                         for shard_path in get_shard_paths(full_index_path, shards)]
+        try:
+            update_index(index_writers, data_dir, manifest, num_threads=num_threads,
+                         text_fields=AnalyzerFactory.get_text_fields(analyzer_type))
+        finally:
+            for index_writer in index_writers:
+                close_index_writer(index_writer)
+    else:
+        skip_doc_ids = frozenset()
+        if dedup_threshold > 0:
+            duplicate_map = find_near_duplicates(catalog, data_dir, dedup_threshold, corpus_format=corpus_format)
+            duplicate_map.save(full_index_path)
+            skip_doc_ids = frozenset(duplicate_map.duplicate_ids)
+            metrics.increment("duplicates_skipped", len(skip_doc_ids))
+        # Start indexing files
+        logging.info(f"Indexing {data_dir} into {shards} shard(s) using {num_threads} thread(s)...")
+        manifest.entries = {}
+        manifest.update(data_dir, build_shards(full_index_path, data_dir, analyzer_type, similarity_type,
+                                               shards=shards, corpus_format=corpus_format, num_threads=num_threads,
+                                               ram_buffer_mb=ram_buffer_mb, merge_policy=merge_policy,
+                                               merge_factor=merge_factor, skip_doc_ids=skip_doc_ids))
+
+    manifest.save()
+    catalog.register(data_dir, index_name, norm_encoding, analyzer_signature, shards)
+    logging.info(f"Indexing complete, saved to '{full_index_path}'.")
+    return full_index_path
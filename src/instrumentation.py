@@ -0,0 +1,244 @@
+import cProfile
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Iterator, Optional, Tuple
+
+from org.apache.lucene.search import ScoreMode
+
+from .query_factory import QueryFactory
+
+
+class TimerStats:
+    """Number of measurements, total, minimum and maximum duration (in seconds) of a timed phase."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def to_dict(self) -> dict:
+        return {"count": self.count, "total_s": self.total, "mean_s": self.total / self.count if self.count else 0.0,
+                "min_s": self.min if self.count else 0.0, "max_s": self.max}
+
+
+class Metrics:
+    """
+    Thread-safe timers and counters of the phases of the pipeline (config parsing, JVM start, indexing, query parsing,
+    searching, writing rankings, evaluation...). Makes use of the singleton pattern, like Config.
+
+    Phases are timed with the timer context manager, events are counted with increment. Optionally, the slowest
+    queries are tracked so they can be profiled after a run. The metrics can be exported as JSON or in the Prometheus
+    text format.
+    """
+
+    _instance = None
+
+    def __new__(cls) -> "Metrics":
+        if cls._instance is None:
+            cls._instance = super(Metrics, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self) -> None:
+        if self.__dict__.get("_initialized", False):
+            return
+        self._lock = threading.Lock()
+        self.timers: Dict[str, TimerStats] = {}
+        self.counters: Dict[str, int] = {}
+        self.slowest_queries_limit = 0  # number of slowest queries to track, 0 disables tracking
+        self._slowest_queries: List[Tuple[float, int, dict]] = []  # min-heap on the latency
+        self._sequence = 0  # tie breaker, so query descriptions are never compared by the heap
+        self.reports: Dict[str, object] = {}  # additional sections of the exported metrics
+        self._initialized = True
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """Time the enclosed block as (an occurrence of) the phase with the given name."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start_time)
+
+    def record(self, name: str, seconds: float) -> None:
+        with self._lock:
+            stats = self.timers.get(name)
+            if stats is None:
+                stats = self.timers[name] = TimerStats()
+            stats.add(seconds)
+
+    def increment(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe_query(self, seconds: float, **query) -> None:
+        """Consider a ranked query for the slowest queries, if those are tracked."""
+        if self.slowest_queries_limit <= 0:
+            return
+        with self._lock:
+            self._sequence += 1
+            entry = (seconds, self._sequence, query)
+            if len(self._slowest_queries) < self.slowest_queries_limit:
+                heapq.heappush(self._slowest_queries, entry)
+            elif seconds > self._slowest_queries[0][0]:
+                heapq.heapreplace(self._slowest_queries, entry)
+
+    def slowest_queries(self) -> List[Tuple[float, dict]]:
+        """Return the (latency, query) pairs of the slowest queries, slowest first."""
+        with self._lock:
+            return [(seconds, query) for seconds, _, query in sorted(self._slowest_queries, reverse=True)]
+
+    def phase_totals(self) -> Dict[str, float]:
+        """Return the total time (in seconds) spent in every phase so far."""
+        with self._lock:
+            return {name: stats.total for name, stats in sorted(self.timers.items())}
+
+    def reset(self) -> None:
+        with self._lock:
+            self.timers.clear()
+            self.counters.clear()
+            self._slowest_queries.clear()
+            self.reports.clear()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {"timers": {name: stats.to_dict() for name, stats in sorted(self.timers.items())},
+                    "counters": dict(sorted(self.counters.items())), **self.reports}
+
+    def to_prometheus(self, prefix: str = "ir") -> str:
+        """Export the timers as summaries and the counters as counters in the Prometheus text format."""
+        with self._lock:
+            lines = [f"# HELP {prefix}_phase_seconds Time spent in each phase of the pipeline.",
+                     f"# TYPE {prefix}_phase_seconds summary"]
+            for name, stats in sorted(self.timers.items()):
+                lines.append(f'{prefix}_phase_seconds_sum{{phase="{name}"}} {stats.total}')
+                lines.append(f'{prefix}_phase_seconds_count{{phase="{name}"}} {stats.count}')
+            lines += [f"# HELP {prefix}_events_total Number of events of each kind.",
+                      f"# TYPE {prefix}_events_total counter"]
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'{prefix}_events_total{{event="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def save(self, metrics_file: str) -> None:
+        """Write the metrics to a file, in the Prometheus text format if it ends in .prom and as JSON otherwise."""
+        os.makedirs(os.path.dirname(metrics_file) or ".", exist_ok=True)
+        with open(metrics_file, "w", encoding="utf-8") as f:
+            if metrics_file.endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), f, indent=2)
+        logging.info(f"Saved metrics to '{metrics_file}'.")
+
+    def log_summary(self) -> None:
+        for name, stats in self.to_dict()["timers"].items():
+            logging.info(f"{name}: {stats['total_s']:.3f} s in {stats['count']} call(s) "
+                         f"(mean {stats['mean_s'] * 1000:.3f} ms, max {stats['max_s'] * 1000:.3f} ms)")
+
+
+def report_index_size(index_path: str, sizes: Dict[str, Dict[str, int]], metrics: Metrics) -> None:
+    """Log the size on disk of an index per file type (see index_size_by_extension) and add it to the metrics."""
+    total = sum(stats["bytes"] for stats in sizes.values())
+    logging.info(f"Index '{index_path}' takes {total / 2 ** 20:.1f} MB on disk:")
+    for file_type, stats in sizes.items():
+        logging.info(f"  {file_type}: {stats['bytes'] / 2 ** 20:.1f} MB in {stats['files']} file(s) "
+                     f"({stats['bytes'] / max(total, 1):.1%})")
+    metrics.reports.setdefault("index_size", {})[index_path] = {"total_bytes": total, "file_types": sizes}
+
+
+def profile_query(index_searcher: "IndexSearcher", query_parser: "QueryParser", query_text: str, top_k: int = 10,
+                  query_type: str = "", maxEdits: int = 0, slop: int = 0, shingles: bool = False,
+                  index_name: str = "", analyzer_name: str = "",
+                  fuzzy_cache: Optional["FuzzyExpansionCache"] = None,
+                  query_cache: Optional["ParsedQueryCache"] = None) -> dict:
+    """
+    Search a query again, timing its phases separately in the spirit of Lucene's QueryProfiler: creating (parsing) the
+    query, rewriting it (e.g. expanding fuzzy terms), creating the weight (collecting the term statistics) and
+    collecting the top hits.
+
+    The query is created as it was ranked: with the same shingles setting, and through the same parsed query and fuzzy
+    expansion caches, so the profiled query is the searched one.
+
+    :return: The duration of every phase (in milliseconds), the rewritten query and the number of hits.
+    """
+    phases = {}
+    start_time = time.perf_counter()
+    query = None
+    if query_cache is not None and query_type != "fuzzy":
+        query = query_cache.get(query_cache.create_key(analyzer_name, query_parser.getField(), query_type, query_text,
+                                                       maxEdits=maxEdits, slop=slop, shingles=shingles))
+    if query is None:
+        query = QueryFactory.create_query(query_text=query_text, query_type=query_type, query_parser=query_parser,
+                                          maxEdits=maxEdits, slop=slop, index_searcher=index_searcher,
+                                          fuzzy_cache=fuzzy_cache, index_name=index_name, shingles=shingles)
+    if query_type == "analyzed_phrase":
+        query = QueryFactory.prune_absent_terms(query, index_searcher.getIndexReader())
+    phases["create_query_ms"] = (time.perf_counter() - start_time) * 1000
+    start_time = time.perf_counter()
+    rewritten = index_searcher.rewrite(query)
+    phases["rewrite_ms"] = (time.perf_counter() - start_time) * 1000
+    start_time = time.perf_counter()
+    index_searcher.createWeight(rewritten, ScoreMode.TOP_SCORES, 1.0)
+    phases["create_weight_ms"] = (time.perf_counter() - start_time) * 1000
+    start_time = time.perf_counter()
+    top_docs = index_searcher.search(rewritten, top_k)
+    phases["search_ms"] = (time.perf_counter() - start_time) * 1000
+    return {"query": query_text, "query_type": query_type, **phases, "rewritten_query": rewritten.toString(),
+            "total_hits": top_docs.totalHits.toString()}
+
+
+def profile_slowest_queries(index_searcher: "IndexSearcher", query_parser: "QueryParser", metrics: "Metrics",
+                            fuzzy_cache: Optional["FuzzyExpansionCache"] = None,
+                            query_cache: Optional["ParsedQueryCache"] = None) -> List[dict]:
+    """
+    Profile the slowest queries tracked by the metrics and add the breakdowns to the exported metrics.
+
+    :param fuzzy_cache: The fuzzy expansion cache the queries were ranked with.
+    :param query_cache: The parsed query cache the queries were ranked with.
+    """
+    profiles = []
+    for seconds, query in metrics.slowest_queries():
+        profile = profile_query(index_searcher, query_parser, **query, fuzzy_cache=fuzzy_cache,
+                                query_cache=query_cache)
+        profile["latency_ms"] = seconds * 1000
+        profiles.append(profile)
+        logging.info(f"Slow query '{profile['query']}' ({profile['latency_ms']:.2f} ms): "
+                     f"create {profile['create_query_ms']:.2f} ms, rewrite {profile['rewrite_ms']:.2f} ms, "
+                     f"weight {profile['create_weight_ms']:.2f} ms, search {profile['search_ms']:.2f} ms")
+    metrics.reports["slowest_queries"] = profiles
+    return profiles
+
+
+@contextmanager
+def profiled(profile_file: Optional[str]) -> Iterator[None]:
+    """
+    Run the enclosed block under cProfile and dump the statistics to profile_file, if a file is given. cProfile only
+    profiles the calling thread: work done by worker threads (e.g. the search threads of rank_queries_from_file) is
+    not included, so a complete profile of the search needs a single search thread.
+    """
+    if profile_file is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(os.path.dirname(profile_file) or ".", exist_ok=True)
+        profiler.dump_stats(profile_file)
+        logging.info(f"Saved profile to '{profile_file}' (inspect with python -m pstats).")
+
+
+# Instantiate shared metrics for global access. Only one can exist.
+metrics = Metrics()
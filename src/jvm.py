@@ -0,0 +1,25 @@
+import lucene
+
+from .instrumentation import metrics
+
+
+def init_vm() -> "JCCEnv":
+    """
+    Start the JVM that backs PyLucene. The JVM can only be started once per process, so subsequent calls return the
+    environment of the already running VM.
+    """
+    env = lucene.getVMEnv()
+    if env is None:
+        with metrics.timer("jvm_init"):
+            env = lucene.initVM(vmargs=['-Djava.awt.headless=true'])  # initialize VM to adapt Java Lucene to Python
+    return env
+
+
+def attach_current_thread() -> None:
+    """
+    Attach the calling (non-main) Python thread to the JVM. Every thread that calls into Lucene must be attached first,
+    which makes this function suitable as the initializer of a thread pool.
+    """
+    env = lucene.getVMEnv()
+    if not env.isCurrentThreadAttached():
+        env.attachCurrentThread()
@@ -1,22 +1,28 @@
-import csv
 import logging
 import os
 import time
-from typing import Union, List, Optional
+from typing import Union, List, Sequence, Optional, Dict
 
 import lucene
-import pandas as pd
-from java.nio.file import Paths
-from org.apache.lucene.document import Document, TextField, Field, StoredField
-from org.apache.lucene.index import IndexWriter, IndexWriterConfig, DirectoryReader
 from org.apache.lucene.queryparser.classic import QueryParser
 from org.apache.lucene.search import IndexSearcher
-from org.apache.lucene.store import FSDirectory
 
-from .analyzer import AnalyzerFactory
+from .analyzer import AnalyzerFactory, get_field_name
+from .catalog import IndexCatalog
 from .config import config
-from .evaluate import evaluate
-from .query_factory import QueryFactory
+from .corpus import corpus_name
+from .dedup import DuplicateMap
+from .evaluate import evaluate_all, evaluate_run
+from .indexer import ensure_index
+from .instrumentation import metrics, profiled, profile_slowest_queries, report_index_size
+from .jvm import init_vm
+from .query_cache import ParsedQueryCache
+from .run import Run, RunWriter
+from .results_store import ResultsStore, open_results_store
+from .ranking import rank_queries_from_file, create_rankings_file_name, get_queries_delimiter, \
+    create_search_executor, warmup_searcher
+from .search_cache import SearchResultCache, FuzzyExpansionCache
+from .shards import open_index_reader, index_size_by_extension
 from .similarity import SimilarityFactory
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -26,119 +32,37 @@ def float_to_str_no_decimal_point(x: float) -> str:
     return str(x).replace('.', '')
 
 
-def create_index_dir_name(data_dir: str, analyzer: str) -> str:
-    # Get the base name of the directory from data_dir (e.g., 'full_docs_small')
-    base_name = os.path.basename(os.path.normpath(data_dir))
+def create_run_name(data_dir: str, analyzer: str, similarity: str, k1: float, b: float) -> str:
+    # Get the base name of the directory (or packed corpus) from data_dir (e.g., 'full_docs_small')
+    base_name = corpus_name(data_dir)
 
-    # Combine the base directory name with the analyzer name to create a unique index dir name
-    index_dir_name = f"{base_name}_{analyzer}"
+    # Combine the base directory name with the analyzer and similarity settings to create a unique run name
+    return f"{base_name}_{analyzer}_{similarity}_{float_to_str_no_decimal_point(k1)}_{float_to_str_no_decimal_point(b)}"
 
-    return index_dir_name
 
-
-def extract_id_from_filename(filename: str) -> int:
-    """
-    Extract textfile id from filename.
-    :param filename: the filename (not including the path)
-    :return: the integer present in the filename.
-    """
-    id_str = filename.split('_')[1]
-    id_str = id_str.split('.')[0]
-    return int(id_str)
-
-
-def index_txt_file(ind_writer: IndexWriter, data_dir: str, file: str) -> None:
-    """Indexes a single text file."""
-    data_path = os.path.join(data_dir, file)
-    doc = Document()
-    with open(data_path, "r", encoding='utf-8') as f:
-        text_to_index = f.read()
-        doc.add(TextField("text_content", text_to_index, Field.Store.NO))  # Don't store the text field
-        doc_id = extract_id_from_filename(file)
-        doc.add(StoredField("doc_id", doc_id))  # stored but not indexed
-        ind_writer.addDocument(doc)
-
-
-def rank_queries_from_file(index_searcher: IndexSearcher, query_parser: QueryParser, input_file: str, output_file: str,
-                           delimiter: str = ',',
-                           top_k: Optional[int] = 10, query_type: str = "", maxEdits: int = 0, slop: int = 0) -> None:
+def record_evaluation(rankings_file: str, run_name: str, reference_file: str, results_store: ResultsStore,
+                      elapsed_time: float, k_list: Sequence[int] = (1, 3, 5, 10), run: Optional[Run] = None,
+                      run_config: Optional[dict] = None, timings: Optional[Dict[str, float]] = None) -> None:
     """
-    Reads queries from a csv file and generates a ranking for them.
-
-    :param input_file: Path to the input CSV or TSV file with queries.
-    :param output_file: Path to the output file where rankings will be saved.
-    :param delimiter: The character used to separate values in the input file (default is ',').
-    :param top_k: How many top ranked documents to save in the output file; if None, saves all.
-    :param query_type: The type of query
-    :param maxEdits: The maximum number of edits allowed per query
+    Evaluate the rankings of a run against the reference results and record MAP@K and MAR@K in the results store.
+
+    :param run: The rankings of the run in memory; if not given, the rankings are read from the rankings file.
+    :param run_config: The configuration of the run, recorded with the results.
+    :param timings: The time spent in every phase of the run, recorded with the results.
     """
-    logging.info(
-        f"Ranking documents for the queries in '{input_file}' with limit: {top_k if top_k is not None else 'no limit'}...")
-    queries_df = pd.read_csv(input_file, delimiter=delimiter)
-    with open(output_file, 'w') as output_f:
-        output_f.write("Query_number,doc_number\n")
-        # loop over queries
-        for i, (_, row) in enumerate(queries_df.iterrows()):
-            query_number = row['Query number']
-            query_text = row['Query']
-
-            # TODO: different types of querying? fuzzy queries, boolean queries, exact queries, ...?
-            query = QueryFactory.create_query(query_text=query_text, query_type=query_type, query_parser=query_parser,
-                                              maxEdits=maxEdits, slop=slop)
-
-            top_docs = index_searcher.search(query, top_k)  # Get top k results
-            hits = top_docs.scoreDocs  # internal doc id's found for query
-            nr_hits = top_docs.totalHits  # number of hits
-            for hit in hits:
-                internal_id = hit.doc
-                doc = index_searcher.doc(internal_id)
-                doc_id = doc.get("doc_id")
-                output_f.write(f"{query_number},{doc_id}\n")
-    logging.info(f"Saved document rankings to '{output_file}'.")
-
-
-def update_evaluation_file(evaluation_file_path: str, run_name: str, k: int, map_at_k: float, mar_at_k: float,
-                           elapsed_time: float):
-    # Check if the file exists
-    file_exists = os.path.exists(evaluation_file_path)
-
-    # Open the CSV file in read mode if it exists to check for existing entries
-    if file_exists:
-        with open(evaluation_file_path, mode='r', newline='', encoding='utf-8') as file:
-            reader = csv.reader(file)
-            rows = list(reader)
-
-        # Check if headers exist, if not, create them
-        if not rows or rows[0] != ['run_name', 'k', 'MAP@K', 'MAR@K', 'time(s)']:
-            rows.insert(0, ['run_name', 'k', 'MAP@K', 'MAR@K', 'time(s)'])
-
-        # Check if the run_name and k already exist
-        updated = False
-        for i, row in enumerate(rows):
-            if row[0] == run_name and int(row[1]) == k:
-                # If run_name and k exist, update that row with new values
-                rows[i] = [run_name, k, map_at_k, mar_at_k, f"{elapsed_time:.2f}"]
-                updated = True
-                break
-
-        if not updated:
-            # If run_name and k do not exist, append a new row
-            rows.append([run_name, k, map_at_k, mar_at_k, f"{elapsed_time:.2f}"])
-
-    else:
-        # If the file does not exist, create it and add the header
-        rows = [['run_name', 'k', 'MAP@K', 'MAR@K', 'time(s)'],
-                [run_name, k, map_at_k, mar_at_k, f"{elapsed_time:.2f}"]]
-
-    # Write the updated or new rows to the CSV file
-    with open(evaluation_file_path, mode='w', newline='', encoding='utf-8') as file:
-        writer = csv.writer(file)
-        writer.writerows(rows)
+    with metrics.timer("evaluation"):
+        if run is not None:
+            evaluations = evaluate_run(run, expected_result_file=reference_file, k_list=k_list)
+        else:
+            evaluations = evaluate_all(result_file=rankings_file, expected_result_file=reference_file, k_list=k_list)
+    with metrics.timer("results_record"):
+        results_store.record(run_name, evaluations, elapsed_time, run_config=run_config, timings=timings)
 
 
 def main(args: Union[str, List[str]] = None) -> int:
     start_time = time.time()  # Start timing
-    config.parse(args)  # parse config file or command line arguments
+    with metrics.timer("config_parse"):
+        config.parse(args)  # parse config file or command line arguments
     if config.get('help', False):
         return 0
 
@@ -156,89 +80,101 @@ def main(args: Union[str, List[str]] = None) -> int:
     logging.info(f"evaluation_dir: {config.get('evaluation_dir')}")
     logging.info(f"reference_file: {config.get('reference_file')}")
     logging.info(f"query type: {config.query_type}")
-
-    lucene.initVM()  # initialize VM to adapt Java Lucene to Python
-
-    data_dir = config.data_dir
-    base_name = os.path.basename(os.path.normpath(config.data_dir))
-    k1 = float_to_str_no_decimal_point(config.k1)
-    b = float_to_str_no_decimal_point(config.b)
-    index_dir_name = f"{base_name}_{config.analyzer}_{config.similarity}_{k1}_{b}"
-    full_index_path = os.path.join(config.index_dir, index_dir_name)
-
-    analyzer = AnalyzerFactory.get_analyzer(config.analyzer)
+    logging.info(f"search mode: {config.search_mode}")
+    logging.info(f"directory: {config.directory}")
+
+    init_vm()  # initialize VM to adapt Java Lucene to Python
+
+    # The index only depends on the documents, the analyzer and the norm encoding, the similarity and its parameters
+    # are applied at search time. The run name still identifies the full configuration.
+    run_name = create_run_name(config.data_dir, config.analyzer, config.similarity, config.k1, config.b)
+    catalog = IndexCatalog(config.index_dir)
+    full_index_path = ensure_index(catalog, config.data_dir, config.analyzer, config.similarity,
+                                   num_threads=config.index_threads, ram_buffer_mb=config.ram_buffer_mb,
+                                   merge_policy=config.merge_policy, merge_factor=config.merge_factor,
+                                   incremental=config.incremental, shards=config.shards,
+                                   corpus_format=config.corpus_format, multi_field=config.multi_field,
+                                   shingles=config.shingles, dedup_threshold=config.dedup_threshold)
+
+    with metrics.timer("analyzer_create"):
+        analyzer = AnalyzerFactory.get_analyzer(config.analyzer)
     similarity = SimilarityFactory.get_similarity(similarity_type=config.similarity, k1=config.k1, b=config.b)
 
-    if os.path.exists(full_index_path) and any(os.scandir(full_index_path)):
-        logging.info(f"Index directory '{full_index_path}' already exists, skipping indexing.")
-    else:
-        # Set up IndexWriterConfig with specified analyzer and similarity
-        indexWriterConfig = IndexWriterConfig(analyzer)
-        indexWriterConfig.setSimilarity(similarity)
-        indexWriterConfig.setOpenMode(IndexWriterConfig.OpenMode.CREATE)  # Overwrite existing index files if present
-
-        # Create and open the index directory
-        index_dir = FSDirectory.open(Paths.get(full_index_path))
-
-        indexWriter = IndexWriter(index_dir, indexWriterConfig)
-
-        # Start indexing files
-        logging.info(f"Indexing directory {data_dir}...")
-        for file in os.listdir(data_dir):
-            if file.endswith(".txt"):
-                index_txt_file(indexWriter, data_dir, file)
-
-        indexWriter.close()
-        logging.info(f"Indexing complete, saved to '{full_index_path}'.")
-
-    # Open the index directory
-    index_dir = FSDirectory.open(Paths.get(full_index_path))
-    # create reader object
-    reader = DirectoryReader.open(index_dir)
-    # instantiate/define reader
-    searcher = IndexSearcher(reader)
+    report_index_size(full_index_path, index_size_by_extension(full_index_path), metrics)
+
+    # Open a reader of the index (of all its shards)
+    with metrics.timer("index_open"):
+        reader = open_index_reader(full_index_path, config.shards, directory_type=config.directory,
+                                   preload_extensions=config.preload_extensions)
+    # instantiate/define reader, optionally searching the segments of the index concurrently
+    search_executor = create_search_executor(config.intra_query_threads)
+    searcher = IndexSearcher(reader, search_executor)
     searcher.setSimilarity(similarity)
 
-    queries_file: str = config.queries
-    if queries_file.endswith(".tsv") or queries_file == "data/queries/queries.csv":
-        delimiter = '\t'
-    else:
-        delimiter = ','
-
-    queries_filename = os.path.splitext(os.path.basename(config.queries))[0]
-
-    # Set up the QueryParser for the 'text_content' field
-    query_parser = QueryParser("text_content", analyzer)
-    if config.query_type != "fuzzy" and config.query_type != "phrase":
-        rankings_file_name = f"{index_dir_name}_{config.query_type}_{queries_filename}.csv"
-        rankings_file = os.path.join(config.ranking_dir, rankings_file_name)
-        rank_queries_from_file(index_searcher=searcher, query_parser=query_parser, input_file=config.queries,
-                               output_file=rankings_file,
-                               delimiter=delimiter, top_k=10, query_type=config.query_type)
-    elif config.query_type == "phrase":
-        slop = config.get('slop')
-        rankings_file_name = f"{index_dir_name}_{config.query_type}_{slop}_{queries_filename}.csv"
-        rankings_file = os.path.join(config.ranking_dir, rankings_file_name)
-        rank_queries_from_file(index_searcher=searcher, query_parser=query_parser, input_file=config.queries,
-                               output_file=rankings_file,
-                               delimiter=delimiter, top_k=10, query_type=config.query_type, slop=slop)
-    else:
-        max_edits = config.get("maxEdits")
-        rankings_file_name = f"{index_dir_name}_{config.query_type}_{max_edits}_{queries_filename}.csv"
-        rankings_file = os.path.join(config.ranking_dir, rankings_file_name)
-        rank_queries_from_file(index_searcher=searcher, query_parser=query_parser, input_file=config.queries,
-                               output_file=rankings_file,
-                               delimiter=delimiter, top_k=10, query_type=config.query_type, maxEdits=max_edits)
+    result_cache = SearchResultCache(config.result_cache_size) if config.result_cache_size > 0 else None
+    fuzzy_cache = FuzzyExpansionCache(config.fuzzy_cache_size) if config.fuzzy_cache_size > 0 else None
+    query_cache = ParsedQueryCache(config.query_cache_size, config.query_cache_file) \
+        if config.query_cache_size > 0 or config.query_cache_file is not None else None
+
+    # Set up the QueryParser for the field analyzed by the analyzer ('text_content' unless the index is multi-field)
+    text_field = get_field_name(config.analyzer, config.multi_field)
+    query_parser = QueryParser(text_field, analyzer)
+    rankings_file_name = create_rankings_file_name(run_name, config.queries, config.query_type, slop=config.slop,
+                                                   max_edits=config.maxEdits)
+    rankings_file = os.path.join(config.ranking_dir, rankings_file_name)
+    if config.profile:
+        metrics.slowest_queries_limit = config.profile_slowest
+    # the rankings of a deduplicated index can be expanded with the near-duplicates of the ranked documents
+    duplicates = DuplicateMap.load(full_index_path) if config.expand_duplicates else None
+    profile_file = os.path.join(config.profile_dir, f"{rankings_file_name}.prof") if config.profile else None
+    if config.profile and config.search_threads > 1:
+        logging.warning(f"cProfile only profiles the main thread, the searches of the {config.search_threads} search "
+                        f"threads are not included in '{profile_file}' (use --search_threads 1 to profile them).")
+    if config.warmup_queries > 0:
+        # search a sample of the queries first, so the timed queries do not pay for page faults and JIT compilation
+        with metrics.timer("warmup"):
+            warmup_searcher(searcher, query_parser, config.queries, config.warmup_queries,
+                            delimiter=get_queries_delimiter(config.queries), top_k=10, query_type=config.query_type,
+                            maxEdits=config.maxEdits, slop=config.slop, search_mode=config.search_mode,
+                            total_hits_threshold=config.total_hits_threshold, shingles=config.shingles)
+    with metrics.timer("ranking"), profiled(profile_file):
+        run = rank_queries_from_file(index_searcher=searcher, query_parser=query_parser, input_file=config.queries,
+                                     output_file=rankings_file, delimiter=get_queries_delimiter(config.queries),
+                                     top_k=10, query_type=config.query_type, maxEdits=config.maxEdits, slop=config.slop,
+                                     num_threads=config.search_threads, result_cache=result_cache,
+                                     index_name=full_index_path, analyzer_name=config.analyzer,
+                                     chunk_size=config.query_chunk_size, resume=config.resume, fuzzy_cache=fuzzy_cache,
+                                     search_mode=config.search_mode, total_hits_threshold=config.total_hits_threshold,
+                                     query_cache=query_cache, shingles=config.shingles, duplicates=duplicates)
+    if query_cache is not None:
+        query_cache.save()
+    run_writer = RunWriter()
+    if run is not None and config.run_formats:
+        run_writer.submit(run, os.path.splitext(rankings_file)[0], config.run_formats,
+                          run_tag=os.path.splitext(rankings_file_name)[0])
+    if config.profile:
+        profile_slowest_queries(searcher, QueryParser(text_field, analyzer), metrics, fuzzy_cache=fuzzy_cache,
+                                query_cache=query_cache)
+    if search_executor is not None:
+        search_executor.shutdown()
     end_time = time.time()
     elapsed_time = end_time - start_time  # Calculate the elapsed time
     logging.info(f"Program execution time: {elapsed_time:.2f} seconds")
 
-    k_list = [1, 3, 5, 10]
-    for k in k_list:
-        evaluation = evaluate(result_file=rankings_file, expected_result_file=config.reference_file, k=k)
-        update_evaluation_file(evaluation_file_path=config.evaluation_file, run_name=rankings_file_name, k=k,
-                               map_at_k=evaluation.map_at_k, mar_at_k=evaluation.mar_at_k, elapsed_time=elapsed_time)
-
+    results_store = open_results_store(config.results_db, config.evaluation_file)
+    try:
+        record_evaluation(rankings_file, rankings_file_name, reference_file=config.reference_file,
+                          results_store=results_store, elapsed_time=elapsed_time, run=run,
+                          run_config=config.to_dict(), timings=metrics.phase_totals())
+        if config.export_evaluation and config.evaluation_file is not None:
+            results_store.export_csv(config.evaluation_file)
+    finally:
+        results_store.close()
+    run_writer.close()
+
+    metrics.log_summary()
+    if config.metrics_file is not None:
+        metrics.save(config.metrics_file)
     return 0
 
 
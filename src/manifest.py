@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import tempfile
+from typing import Dict, List
+
+
+def content_hash(text: str) -> str:
+    """Return the hash of the content of a document."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def hash_file(path: str) -> str:
+    """Return the content hash of a text file, read the same way the indexer reads it."""
+    with open(path, "r", encoding="utf-8") as f:
+        return content_hash(f.read())
+
+
+class ManifestDiff:
+    """The text files that were added, changed or removed since an index was last updated."""
+
+    def __init__(self, added: List[str], changed: List[str], removed: List[str]):
+        self.added = added
+        self.changed = changed
+        self.removed = removed
+
+    def is_empty(self) -> bool:
+        return not (self.added or self.changed or self.removed)
+
+
+class IndexManifest:
+    """
+    Records the name, size, modification time and content hash of every text file in an index, so the next run can
+    detect which files were added, changed or removed and update only those documents.
+
+    The manifest is stored as a JSON file in the index directory.
+    """
+    MANIFEST_FILE = "manifest.json"
+
+    def __init__(self, index_path: str) -> None:
+        self.index_path = index_path
+        self._manifest_path = os.path.join(index_path, self.MANIFEST_FILE)
+        self.entries = self._load()
+
+    def _load(self) -> Dict[str, dict]:
+        if not os.path.exists(self._manifest_path):
+            return {}
+        with open(self._manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def exists(self) -> bool:
+        return os.path.exists(self._manifest_path)
+
+    def save(self) -> None:
+        # write to a temporary file first, so an interrupted run never leaves a partially written manifest
+        fd, tmp_path = tempfile.mkstemp(dir=self.index_path, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self._manifest_path)
+
+    def diff(self, data_dir: str) -> ManifestDiff:
+        """
+        Compare the manifest with the text files in data_dir. Files whose size and modification time did not change are
+        assumed to be unchanged, the content of the others is hashed to tell whether they really changed.
+        """
+        added, changed = [], []
+        current = set()
+        for entry in os.scandir(data_dir):
+            if not entry.name.endswith(".txt"):
+                continue
+            current.add(entry.name)
+            recorded = self.entries.get(entry.name)
+            if recorded is None:
+                added.append(entry.name)
+                continue
+            stat = entry.stat()
+            if recorded["size"] == stat.st_size and recorded["mtime_ns"] == stat.st_mtime_ns:
+                continue
+            if recorded["hash"] != hash_file(entry.path):
+                changed.append(entry.name)
+            else:
+                # only touched, record the new modification time so the file is not hashed again next time
+                recorded["size"], recorded["mtime_ns"] = stat.st_size, stat.st_mtime_ns
+        removed = [file for file in self.entries if file not in current]
+        return ManifestDiff(added, changed, removed)
+
+    def update(self, data_dir: str, hashes: Dict[str, str], removed: List[str] = ()) -> None:
+        """
+        Record the (re)indexed files and their content hashes, and forget the removed files.
+        """
+        for file, file_hash in hashes.items():
+            stat = os.stat(os.path.join(data_dir, file))
+            self.entries[file] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": file_hash}
+        for file in removed:
+            self.entries.pop(file, None)
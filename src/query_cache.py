@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional, Hashable, Tuple
+
+from org.apache.lucene.index import Term
+from org.apache.lucene.search import BooleanQuery, BooleanClause, BoostQuery, MatchNoDocsQuery, PhraseQuery, \
+    SynonymQuery, TermQuery
+
+from .analyzer import AnalyzerFactory, get_shingle_field_name
+from .search_cache import normalize_query_text
+
+
+def query_to_dict(query: "Query") -> Optional[dict]:
+    """
+    Convert a parsed query to a JSON-serializable structure of its analyzed terms, or None if the query contains a type
+    of query that cannot be converted.
+    """
+    if BooleanQuery.instance_(query):
+        boolean_query = BooleanQuery.cast_(query)
+        clauses = []
+        for clause in boolean_query.clauses():
+            child = query_to_dict(clause.getQuery())
+            if child is None:
+                return None
+            clauses.append([clause.getOccur().name(), child])
+        return {"bool": clauses, "min_should_match": boolean_query.getMinimumNumberShouldMatch()}
+    if TermQuery.instance_(query):
+        term = TermQuery.cast_(query).getTerm()
+        return {"term": [term.field(), term.text()]}
+    if BoostQuery.instance_(query):
+        boost_query = BoostQuery.cast_(query)
+        child = query_to_dict(boost_query.getQuery())
+        return None if child is None else {"boost": boost_query.getBoost(), "query": child}
+    if PhraseQuery.instance_(query):
+        phrase_query = PhraseQuery.cast_(query)
+        return {"phrase": phrase_query.getField(), "terms": [term.text() for term in phrase_query.getTerms()],
+                "positions": list(phrase_query.getPositions()), "slop": phrase_query.getSlop()}
+    if SynonymQuery.instance_(query):
+        synonym_query = SynonymQuery.cast_(query)
+        return {"synonym": synonym_query.getField(), "terms": [term.text() for term in synonym_query.getTerms()]}
+    if MatchNoDocsQuery.instance_(query):
+        return {"none": True}
+    return None
+
+
+def query_from_dict(structure: dict) -> "Query":
+    """Build the query described by a structure created by query_to_dict, without analyzing any text."""
+    if "bool" in structure:
+        builder = BooleanQuery.Builder()
+        builder.setMinimumNumberShouldMatch(structure["min_should_match"])
+        for occur, child in structure["bool"]:
+            builder.add(query_from_dict(child), BooleanClause.Occur.valueOf(occur))
+        return builder.build()
+    if "term" in structure:
+        return TermQuery(Term(*structure["term"]))
+    if "boost" in structure:
+        return BoostQuery(query_from_dict(structure["query"]), structure["boost"])
+    if "phrase" in structure:
+        builder = PhraseQuery.Builder()
+        for text, position in zip(structure["terms"], structure["positions"]):
+            builder.add(Term(structure["phrase"], text), position)
+        builder.setSlop(structure["slop"])
+        return builder.build()
+    if "synonym" in structure:
+        builder = SynonymQuery.Builder(structure["synonym"])
+        for text in structure["terms"]:
+            builder.addTerm(Term(structure["synonym"], text))
+        return builder.build()
+    return MatchNoDocsQuery()
+
+
+class ParsedQueryCache:
+    """
+    Thread-safe LRU cache of parsed queries, shared by all runs of a process.
+
+    Parsed queries are immutable, so a query parsed (and analyzed) once is searched by every run with the same analyzer,
+    query type and query parameters, whatever the index, similarity or search mode. Entries are keyed on the signature
+    of the analyzer (which changes with its stopwords), the searched field, the query type and its parameters and the
+    normalized query text.
+
+    With a cache file, the analyzed terms of every cached query are also stored on disk (as JSON) and loaded by the
+    next process, so reruns of the same queries skip query analysis altogether.
+    """
+
+    def __init__(self, max_entries: int = 10000, cache_file: Optional[str] = None) -> None:
+        self.max_entries = max_entries
+        self.cache_file = cache_file
+        self._entries = OrderedDict()
+        self._stored = {}  # key (as a string) -> analyzed terms of the query, as stored in the cache file
+        self._dirty = False
+        self._signatures = {}  # analyzer -> signature
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file, "r", encoding="utf-8") as f:
+                self._stored = json.load(f)
+            logging.info(f"Loaded {len(self._stored)} analyzed queries from '{cache_file}'.")
+
+    def create_key(self, analyzer_name: str, field: str, query_type: str, query_text: str, maxEdits: int = 0,
+                   slop: int = 0, shingles: bool = False) -> Tuple[Hashable, ...]:
+        """
+        Create the cache key of a query parsed with the given analyzer.
+
+        :param shingles: Whether phrases are searched in the shingle field of the index.
+        """
+        signature = self._signatures.get(analyzer_name)
+        if signature is None:
+            signature = self._signatures[analyzer_name] = AnalyzerFactory.get_signature(analyzer_name)
+        if shingles and query_type == "analyzed_phrase":
+            field = get_shingle_field_name(field)
+        return signature, field, query_type, slop, maxEdits, normalize_query_text(query_text)
+
+    @staticmethod
+    def _to_string(key: Tuple[Hashable, ...]) -> str:
+        return "\t".join(str(part) for part in key)
+
+    def get(self, key: Tuple[Hashable, ...]) -> Optional["Query"]:
+        """Return the parsed query for the key, or None if it is not cached."""
+        with self._lock:
+            query = self._entries.get(key)
+            if query is None:
+                structure = self._stored.get(self._to_string(key))
+                if structure is None:
+                    self.misses += 1
+                    return None
+                query = query_from_dict(structure)
+                if self.max_entries > 0:
+                    self._entries[key] = query
+                    self._evict()
+            else:
+                self._entries.move_to_end(key)
+            self.hits += 1
+            return query
+
+    def put(self, key: Tuple[Hashable, ...], query: "Query") -> None:
+        """Cache the parsed query for the key (and its analyzed terms, if the cache has a file)."""
+        structure = query_to_dict(query) if self.cache_file is not None else None
+        with self._lock:
+            if self.max_entries > 0:
+                self._entries[key] = query
+                self._entries.move_to_end(key)
+                self._evict()
+            if structure is not None:
+                self._stored[self._to_string(key)] = structure
+                self._dirty = True
+
+    def _evict(self) -> None:
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def save(self) -> None:
+        """Write the analyzed terms of the cached queries to the cache file, if any were added."""
+        if self.cache_file is None or not self._dirty:
+            return
+        with self._lock:
+            directory = os.path.dirname(self.cache_file) or "."
+            os.makedirs(directory, exist_ok=True)
+            # write to a temporary file first, so an interrupted save never leaves a partially written cache file
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(self._stored, f)
+            os.replace(tmp_path, self.cache_file)
+            self._dirty = False
+        logging.info(f"Saved {len(self._stored)} analyzed queries to '{self.cache_file}'.")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return f"{len(self._entries)} entries, {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate)"
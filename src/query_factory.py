@@ -1,15 +1,27 @@
 from org.apache.lucene.index import Term
 from org.apache.lucene.queryparser.classic import QueryParser
-from org.apache.lucene.search import BooleanQuery, PhraseQuery, BooleanClause, FuzzyQuery
+from org.apache.lucene.search import BooleanQuery, PhraseQuery, BooleanClause, FuzzyQuery, MatchNoDocsQuery, \
+    TermQuery
+from org.apache.lucene.util import QueryBuilder
+
+from .analyzer import AnalyzerFactory, get_shingle_field_name
+from .search_cache import FuzzyExpansionCache
 
 
 class QueryFactory:
     @staticmethod
-    def create_query(query_text, query_type, query_parser=None, maxEdits=2, slop=0):
+    def create_query(query_text, query_type, query_parser=None, maxEdits=2, slop=0, field=None, index_searcher=None,
+                     fuzzy_cache=None, index_name="", shingles=False):
+        # the field searched by fuzzy and phrase queries: the field of the query parser, unless given explicitly
+        if field is None:
+            field = query_parser.getField() if query_parser is not None else "text_content"
         if query_type == "fuzzy":
-            return QueryFactory._create_fuzzy_query(query_text, maxEdits, 1, 50)
+            return QueryFactory._create_fuzzy_query(query_text, maxEdits, 1, 50, field, index_searcher=index_searcher,
+                                                    fuzzy_cache=fuzzy_cache, index_name=index_name)
         elif query_type == "phrase":
-            return QueryFactory._create_phrase_query(query_text, slop)
+            return QueryFactory._create_phrase_query(query_text, slop, field)
+        elif query_type == "analyzed_phrase":
+            return QueryFactory._create_analyzed_phrase_query(query_text, slop, query_parser, field, shingles)
         elif query_type == "boolean_and":
             return QueryFactory._create_boolean_query(query_text, query_parser)
         elif query_type == "boolean_or":
@@ -18,30 +30,80 @@ class QueryFactory:
             raise ValueError(f"Unknown query type: {query_type}")
 
     @staticmethod
-    def _create_fuzzy_query(query_text, maxEdits, prefixLength, maxExpansions):
+    def _create_fuzzy_query(query_text, maxEdits, prefixLength, maxExpansions, field="text_content",
+                            index_searcher=None, fuzzy_cache=None, index_name=""):
         terms = query_text.split()
         boolean_query_builder = BooleanQuery.Builder()
 
         for term_text in terms:
             escaped_term = QueryParser.escape(term_text)
-            term = Term("text_content", escaped_term)
-            fuzzy_query = FuzzyQuery(term, prefixLength, maxExpansions, maxEdits=maxEdits)
+            if fuzzy_cache is not None and index_searcher is not None:
+                fuzzy_query = QueryFactory._expand_fuzzy_term(index_searcher, fuzzy_cache, index_name, field,
+                                                              escaped_term, maxEdits, prefixLength, maxExpansions)
+            else:
+                term = Term(field, escaped_term)
+                fuzzy_query = FuzzyQuery(term, prefixLength, maxExpansions, maxEdits=maxEdits)
             boolean_query_builder.add(fuzzy_query, BooleanClause.Occur.SHOULD)
 
         return boolean_query_builder.build()
 
     @staticmethod
-    def _create_phrase_query(query_text, slop):
+    def _expand_fuzzy_term(index_searcher, fuzzy_cache, index_name, field, term_text, maxEdits, prefixLength,
+                           maxExpansions):
+        # the rewritten FuzzyQuery of a term is searched exactly as the FuzzyQuery itself, so cached expansions give
+        # the same scores
+        key = FuzzyExpansionCache.create_key(index_searcher, index_name, field, term_text, maxEdits, prefixLength,
+                                             maxExpansions)
+        expansion = fuzzy_cache.get(key)
+        if expansion is None:
+            fuzzy_query = FuzzyQuery(Term(field, term_text), prefixLength, maxExpansions, maxEdits=maxEdits)
+            expansion = index_searcher.rewrite(fuzzy_query)
+            fuzzy_cache.put(key, expansion)
+        return expansion
+
+    @staticmethod
+    def _create_phrase_query(query_text, slop, field="text_content"):
         phrase_query = PhraseQuery.Builder()
         terms = query_text.split()
 
         for t in terms:
-            term = Term("text_content", t)
+            term = Term(field, t)
             phrase_query.add(term)
 
         phrase_query.setSlop(slop)
         return phrase_query.build()
 
+    @staticmethod
+    def _create_analyzed_phrase_query(query_text, slop, query_parser, field="text_content", shingles=False):
+        # the query text is analyzed as the indexed text: terms are lowercased and stemmed, and removed stopwords leave
+        # a gap in the positions of the phrase
+        phrase_query = query_parser.createPhraseQuery(field, query_text, slop)
+        if phrase_query is None:
+            return MatchNoDocsQuery()  # nothing left after analysis (e.g. only stopwords)
+        if shingles and slop == 0 and PhraseQuery.instance_(phrase_query):
+            # the consecutive terms of an exact phrase are searched as the shingles indexed in the shingle field: a
+            # two-word phrase becomes a single term, a longer phrase a phrase of (far less frequent) shingles
+            shingle_builder = QueryBuilder(AnalyzerFactory.get_shingle_analyzer(query_parser.getAnalyzer()))
+            shingle_query = shingle_builder.createPhraseQuery(get_shingle_field_name(field), query_text, 0)
+            if shingle_query is not None:
+                return shingle_query
+        return phrase_query
+
+    @staticmethod
+    def prune_absent_terms(query, index_reader):
+        """
+        Replace an (analyzed) phrase or term query that contains a term (or shingle) that does not occur in the index by
+        a query that matches no documents, before it is searched. A phrase only matches documents with all its terms, so
+        no positions are read for a phrase that cannot match.
+        """
+        if TermQuery.instance_(query):
+            return query if index_reader.docFreq(TermQuery.cast_(query).getTerm()) > 0 else MatchNoDocsQuery()
+        if not PhraseQuery.instance_(query):
+            return query
+        if all(index_reader.docFreq(term) > 0 for term in PhraseQuery.cast_(query).getTerms()):
+            return query
+        return MatchNoDocsQuery()
+
     @staticmethod
     def _create_boolean_query(query_text, query_parser):
         query_parser.setDefaultOperator(QueryParser.Operator.AND)
@@ -49,4 +111,6 @@ class QueryFactory:
 
     @staticmethod
     def _create_standard_query(query_text, query_parser):
+        # reset the operator, the parser may have been used for boolean_and queries before
+        query_parser.setDefaultOperator(QueryParser.Operator.OR)
         return query_parser.parse(QueryParser.escape(query_text))
@@ -0,0 +1,456 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Iterable, Iterator, TextIO, Tuple, Sequence
+
+import numpy as np
+import pandas as pd
+from java.lang import Integer
+from java.util.concurrent import Executors
+from org.apache.lucene.queryparser.classic import QueryParser
+from org.apache.lucene.search import IndexSearcher, DocIdSetIterator, TopDocs, TopScoreDocCollectorManager
+
+from .dedup import DuplicateMap
+from .instrumentation import metrics
+from .jvm import attach_current_thread
+from .query_cache import ParsedQueryCache
+from .query_factory import QueryFactory
+from .run import Run, RunBuilder
+from .search_cache import SearchResultCache, FuzzyExpansionCache
+
+WRITE_BUFFER_SIZE = 1 << 20  # rankings are written through a 1 MB buffer
+
+
+def get_queries_delimiter(queries_file: str) -> str:
+    """Return the delimiter used in a (possibly gzipped) query file."""
+    if queries_file.endswith(".gz"):
+        queries_file = queries_file[:-len(".gz")]
+    if queries_file.endswith(".tsv") or queries_file == "data/queries/queries.csv":
+        return '\t'
+    return ','
+
+
+def create_rankings_file_name(run_name: str, queries_file: str, query_type: str, slop: int = 0,
+                              max_edits: int = 2) -> str:
+    """
+    Create the name of the file that contains the rankings of a run.
+
+    :param run_name: Name of the run (data, analyzer and similarity settings).
+    :param queries_file: Path to the query file.
+    :param query_type: The type of query.
+    :param slop: The slop of phrase queries.
+    :param max_edits: The maximum number of edits of fuzzy queries.
+    """
+    queries_filename = os.path.basename(queries_file)
+    if queries_filename.endswith(".gz"):
+        queries_filename = queries_filename[:-len(".gz")]
+    queries_filename = os.path.splitext(queries_filename)[0]
+    if query_type in ["phrase", "analyzed_phrase"]:
+        return f"{run_name}_{query_type}_{slop}_{queries_filename}.csv"
+    elif query_type == "fuzzy":
+        return f"{run_name}_{query_type}_{max_edits}_{queries_filename}.csv"
+    return f"{run_name}_{query_type}_{queries_filename}.csv"
+
+
+def create_search_executor(num_threads: int) -> Optional["ExecutorService"]:
+    """
+    Create the Java thread pool an IndexSearcher uses to search the segments of an index concurrently for a single
+    query, or None (no intra-query concurrency) if num_threads is 0. The pool must be shut down once searching is done.
+    """
+    if num_threads <= 0:
+        return None
+    return Executors.newFixedThreadPool(num_threads)
+
+
+def search_top_docs(index_searcher: IndexSearcher, query: "Query", top_k: int, search_mode: str = "default",
+                    total_hits_threshold: int = 0) -> TopDocs:
+    """
+    Search the top k hits of a query. The search mode sets the number of hits that are counted exactly (the total hits
+    threshold) before Lucene switches to collecting only competitive hits, which lets it skip blocks of documents
+    whose maximum score cannot enter the top k (block-max WAND for disjunctions):
+
+    - default: Lucene's default, the first max(1000, top_k) hits are counted exactly.
+    - exhaustive: every hit is scored and counted, no blocks are skipped.
+    - fast: only total_hits_threshold hits are counted (0 skips counting altogether), so blocks are skipped as soon as
+      the top k is full. The total hits of the result are a lower bound.
+
+    The top k hits (and their scores) are the same in every mode.
+    """
+    if search_mode == "default":
+        return index_searcher.search(query, top_k)
+    threshold = Integer.MAX_VALUE if search_mode == "exhaustive" else total_hits_threshold
+    # a collector manager shares its state between the slices of a single search, so it is created per search
+    return TopDocs.cast_(index_searcher.search(query, TopScoreDocCollectorManager(top_k, threshold)))
+
+
+class DocIdLookup:
+    """
+    Maps internal Lucene document ids to the ids of the documents.
+
+    The ids are read from the numeric doc values of the doc_id field, so ranking does not have to fetch (and decompress)
+    the stored fields of every hit. By default only the hits are resolved: every hit is located in its segment and read
+    by advancing that segment's doc values to it. A long-lived reader that ranks many queries (the sweep, the server)
+    can preload the ids of all documents into an array once instead. Segments that were written without doc values
+    fall back to the stored doc_id field.
+    """
+
+    def __init__(self, reader: "IndexReader", preload: bool = False) -> None:
+        """
+        :param preload: Read the ids of all documents into an array up front, instead of resolving every hit.
+        """
+        self._leaves = list(reader.leaves())
+        self._doc_bases = [context.docBase for context in self._leaves]
+        self._max_doc = reader.maxDoc()
+        self._doc_ids = None
+        if preload:
+            self._doc_ids = self._read_all()
+
+    def _read_all(self) -> np.ndarray:
+        doc_ids = np.full(self._max_doc, -1, dtype=np.int64)
+        for context in self._leaves:
+            leaf = context.reader()
+            doc_base = context.docBase
+            doc_values = leaf.getNumericDocValues("doc_id")
+            if doc_values is not None:
+                doc = doc_values.nextDoc()
+                while doc != DocIdSetIterator.NO_MORE_DOCS:
+                    doc_ids[doc_base + doc] = doc_values.longValue()
+                    doc = doc_values.nextDoc()
+            else:
+                stored_fields = leaf.storedFields()
+                for doc in range(leaf.maxDoc()):
+                    doc_ids[doc_base + doc] = int(stored_fields.document(doc).get("doc_id"))
+        return doc_ids
+
+    def get(self, internal_id: int) -> int:
+        return self.get_many([internal_id])[0]
+
+    def get_many(self, internal_ids: Sequence[int]) -> List[int]:
+        """
+        Resolve the ids of a list of hits. Without preloaded ids, the hits of every segment are resolved in increasing
+        order with a single doc values iterator of that segment (iterators are created per call, so concurrent queries
+        do not share them).
+        """
+        if self._doc_ids is not None:
+            return [int(self._doc_ids[internal_id]) for internal_id in internal_ids]
+        doc_ids = [-1] * len(internal_ids)
+        by_leaf = {}  # leaf index -> (internal id, position in the hits) of the hits in that leaf
+        for position, internal_id in enumerate(internal_ids):
+            leaf_index = bisect.bisect_right(self._doc_bases, internal_id) - 1
+            by_leaf.setdefault(leaf_index, []).append((internal_id, position))
+        for leaf_index, hits in by_leaf.items():
+            context = self._leaves[leaf_index]
+            leaf = context.reader()
+            doc_values = leaf.getNumericDocValues("doc_id")
+            stored_fields = leaf.storedFields() if doc_values is None else None
+            for internal_id, position in sorted(hits):
+                doc = internal_id - context.docBase
+                if doc_values is not None:
+                    if doc_values.advanceExact(doc):
+                        doc_ids[position] = doc_values.longValue()
+                else:
+                    doc_ids[position] = int(stored_fields.document(doc).get("doc_id"))
+        return doc_ids
+
+    @property
+    def doc_ids(self) -> np.ndarray:
+        """
+        The id of every document, indexed by internal Lucene document id (-1 for documents without an id). The ids are
+        read on first use if they were not preloaded.
+        """
+        if self._doc_ids is None:
+            self._doc_ids = self._read_all()
+        return self._doc_ids
+
+
+def rank_query(index_searcher: IndexSearcher, query_parser: QueryParser, query_text: str, doc_id_lookup: DocIdLookup,
+               top_k: Optional[int] = 10, query_type: str = "", maxEdits: int = 0, slop: int = 0,
+               result_cache: Optional[SearchResultCache] = None, index_name: str = "",
+               analyzer_name: str = "", fuzzy_cache: Optional[FuzzyExpansionCache] = None,
+               search_mode: str = "default", total_hits_threshold: int = 0,
+               query_cache: Optional[ParsedQueryCache] = None, shingles: bool = False) -> List[int]:
+    """
+    Generates a ranking for a single query (see rank_query_with_scores).
+
+    :return: The ids of the top ranked documents.
+    """
+    return rank_query_with_scores(index_searcher, query_parser, query_text, doc_id_lookup, top_k=top_k,
+                                  query_type=query_type, maxEdits=maxEdits, slop=slop, result_cache=result_cache,
+                                  index_name=index_name, analyzer_name=analyzer_name, fuzzy_cache=fuzzy_cache,
+                                  search_mode=search_mode, total_hits_threshold=total_hits_threshold,
+                                  query_cache=query_cache, shingles=shingles)[0]
+
+
+def rank_query_with_scores(index_searcher: IndexSearcher, query_parser: QueryParser, query_text: str,
+                           doc_id_lookup: DocIdLookup, top_k: Optional[int] = 10, query_type: str = "",
+                           maxEdits: int = 0, slop: int = 0, result_cache: Optional[SearchResultCache] = None,
+                           index_name: str = "", analyzer_name: str = "",
+                           fuzzy_cache: Optional[FuzzyExpansionCache] = None, search_mode: str = "default",
+                           total_hits_threshold: int = 0, query_cache: Optional[ParsedQueryCache] = None,
+                           shingles: bool = False) -> Tuple[List[int], List[float]]:
+    """
+    Generates a ranking for a single query, with the scores of the ranked documents.
+
+    :param result_cache: Cache of earlier results, consulted before searching the index.
+    :param index_name: Identifies the searched index in the caches.
+    :param analyzer_name: Identifies the analyzer of the query parser in the caches.
+    :param fuzzy_cache: Cache of the expansions of the terms of fuzzy queries.
+    :param search_mode: How the hits are collected (see search_top_docs).
+    :param total_hits_threshold: Number of hits counted exactly in the fast search mode.
+    :param query_cache: Cache of parsed queries, consulted before parsing the query.
+    :param shingles: Search exact analyzed phrases in the shingle field of the index.
+    :return: The ids of the top ranked documents and their scores.
+    """
+    cache_key = None
+    if result_cache is not None:
+        cache_key = SearchResultCache.create_key(index_searcher, index_name, analyzer_name, query_type, query_text,
+                                                 top_k, maxEdits=maxEdits, slop=slop)
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            metrics.increment("result_cache_hits")
+            return list(cached[0]), list(cached[1])
+
+    start_time = time.perf_counter()
+    with metrics.timer("query_parse"):
+        query = query_key = None
+        # fuzzy queries are built from the raw terms of the query (and expanded per index), they are not cached
+        if query_cache is not None and query_type != "fuzzy":
+            query_key = query_cache.create_key(analyzer_name, query_parser.getField(), query_type, query_text,
+                                               maxEdits=maxEdits, slop=slop, shingles=shingles)
+            query = query_cache.get(query_key)
+            if query is not None:
+                metrics.increment("query_cache_hits")
+        if query is None:
+            query = QueryFactory.create_query(query_text=query_text, query_type=query_type, query_parser=query_parser,
+                                              maxEdits=maxEdits, slop=slop, index_searcher=index_searcher,
+                                              fuzzy_cache=fuzzy_cache, index_name=index_name, shingles=shingles)
+            if query_key is not None and query is not None:
+                query_cache.put(query_key, query)
+        if query_type == "analyzed_phrase":
+            query = QueryFactory.prune_absent_terms(query, index_searcher.getIndexReader())
+
+    with metrics.timer("search"):
+        top_docs = search_top_docs(index_searcher, query, top_k, search_mode=search_mode,
+                                   total_hits_threshold=total_hits_threshold)  # Get top k results
+    hits = top_docs.scoreDocs  # internal doc id's found for query
+    with metrics.timer("doc_id_fetch"):
+        doc_ids = doc_id_lookup.get_many([hit.doc for hit in hits])
+    scores = [hit.score for hit in hits]
+    if result_cache is not None:
+        result_cache.put(cache_key, (tuple(doc_ids), tuple(scores)))
+    metrics.observe_query(time.perf_counter() - start_time, query_text=query_text, top_k=top_k,
+                          query_type=query_type, maxEdits=maxEdits, slop=slop, shingles=shingles,
+                          index_name=index_name, analyzer_name=analyzer_name)
+    return doc_ids, scores
+
+
+def read_queries_in_chunks(input_file: str, delimiter: str = ',', chunk_size: int = 1000,
+                          skip_queries: int = 0) -> Iterator[pd.DataFrame]:
+    """
+    Reads a (possibly gzipped) query file in chunks, so memory use does not depend on the size of the file.
+
+    :param skip_queries: Number of queries at the start of the file to skip.
+    """
+    return pd.read_csv(input_file, delimiter=delimiter, chunksize=chunk_size, compression="infer",
+                       skiprows=range(1, skip_queries + 1))
+
+
+def warmup_searcher(index_searcher: IndexSearcher, query_parser: QueryParser, input_file: str, nr_queries: int,
+                    delimiter: str = ',', top_k: Optional[int] = 10, query_type: str = "", maxEdits: int = 0,
+                    slop: int = 0, search_mode: str = "default", total_hits_threshold: int = 0,
+                    shingles: bool = False) -> int:
+    """
+    Search the first queries of a query file before a timed run, so the index files are paged in and the JVM has
+    compiled the search code when the timed queries are searched. The queries bypass the caches and are not counted in
+    the metrics, their results are discarded.
+
+    :param nr_queries: Number of queries replayed.
+    :return: The number of replayed queries.
+    """
+    queries = next(iter(read_queries_in_chunks(input_file, delimiter, chunk_size=max(nr_queries, 1))), None)
+    if nr_queries <= 0 or queries is None:
+        return 0
+    start_time = time.time()
+    for query_text in queries['Query'][:nr_queries]:
+        query = QueryFactory.create_query(query_text=query_text, query_type=query_type, query_parser=query_parser,
+                                          maxEdits=maxEdits, slop=slop, index_searcher=index_searcher,
+                                          shingles=shingles)
+        if query_type == "analyzed_phrase":
+            query = QueryFactory.prune_absent_terms(query, index_searcher.getIndexReader())
+        search_top_docs(index_searcher, query, top_k, search_mode=search_mode,
+                        total_hits_threshold=total_hits_threshold)
+    nr_replayed = min(nr_queries, len(queries))
+    logging.info(f"Warmed up the searcher with {nr_replayed} queries in {time.time() - start_time:.2f} seconds.")
+    return nr_replayed
+
+
+class RankingProgress:
+    """
+    Tracks the progress of ranking a query file in a file next to the rankings, so an interrupted run can be resumed.
+
+    The progress records the number of completed queries and the size of the rankings file after the last completed
+    query. It is updated after every chunk of queries and removed once all queries are ranked.
+    """
+
+    def __init__(self, output_file: str) -> None:
+        self._progress_file = f"{output_file}.progress"
+        self.queries_done = 0
+        self.offset = 0
+
+    def load(self) -> bool:
+        """Load the progress of an interrupted run, return False if there is none."""
+        if not os.path.exists(self._progress_file):
+            return False
+        with open(self._progress_file, "r", encoding="utf-8") as f:
+            progress = json.load(f)
+        self.queries_done, self.offset = progress["queries_done"], progress["offset"]
+        return True
+
+    def save(self, queries_done: int, offset: int) -> None:
+        self.queries_done, self.offset = queries_done, offset
+        tmp_file = f"{self._progress_file}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"queries_done": queries_done, "offset": offset}, f)
+        os.replace(tmp_file, self._progress_file)
+
+    def remove(self) -> None:
+        if os.path.exists(self._progress_file):
+            os.remove(self._progress_file)
+
+
+def rank_queries_from_file(index_searcher: IndexSearcher, query_parser: QueryParser, input_file: str, output_file: str,
+                           delimiter: str = ',',
+                           top_k: Optional[int] = 10, query_type: str = "", maxEdits: int = 0, slop: int = 0,
+                           num_threads: int = 1, doc_id_lookup: Optional[DocIdLookup] = None,
+                           result_cache: Optional[SearchResultCache] = None, index_name: str = "",
+                           analyzer_name: str = "", chunk_size: int = 1000, resume: bool = False,
+                           fuzzy_cache: Optional[FuzzyExpansionCache] = None, search_mode: str = "default",
+                           total_hits_threshold: int = 0, query_cache: Optional[ParsedQueryCache] = None,
+                           shingles: bool = False, duplicates: Optional[DuplicateMap] = None) -> Optional[Run]:
+    """
+    Reads queries from a csv file and generates a ranking for them.
+
+    The queries are read and ranked in chunks, the rankings of every chunk are written (and flushed) as soon as the
+    chunk is done, so memory use does not depend on the size of the query file. With more than one thread, the queries
+    are searched concurrently by a pool of worker threads sharing the index searcher (every worker has its own query
+    parser, since parsers are not thread-safe). The rankings are always written in the order of the query file.
+
+    The rankings (with their scores) are also collected in memory and returned as a Run, so they can be evaluated
+    without reading back the rankings file.
+
+    :param input_file: Path to the input CSV or TSV file with queries (optionally gzipped).
+    :param output_file: Path to the output file where rankings will be saved.
+    :param delimiter: The character used to separate values in the input file (default is ',').
+    :param top_k: How many top ranked documents to save in the output file; if None, saves all.
+    :param query_type: The type of query
+    :param maxEdits: The maximum number of edits allowed per query
+    :param num_threads: Number of worker threads searching queries concurrently.
+    :param doc_id_lookup: The document id lookup of the reader of the searcher; created if not given.
+    :param result_cache: Cache of search results shared between queries (and runs).
+    :param index_name: Identifies the searched index in the caches.
+    :param analyzer_name: Identifies the analyzer of the query parser in the caches.
+    :param chunk_size: Number of queries read, ranked and written at once.
+    :param resume: Continue an interrupted run after its last completed query, instead of starting over.
+    :param fuzzy_cache: Cache of the expansions of the terms of fuzzy queries shared between queries (and runs).
+    :param search_mode: How the hits are collected (see search_top_docs).
+    :param total_hits_threshold: Number of hits counted exactly in the fast search mode.
+    :param query_cache: Cache of parsed queries shared between runs.
+    :param shingles: Search exact analyzed phrases in the shingle field of the index.
+    :param duplicates: The near-duplicates of the documents of a deduplicated index, every ranked document is followed
+    by its duplicates (within the top k).
+    :return: The run of all queries, or None if an interrupted run was resumed (the run then only lives in the rankings
+    file, without scores).
+    """
+    logging.info(
+        f"Ranking documents for the queries in '{input_file}' with limit: {top_k if top_k is not None else 'no limit'}...")
+    start_time = time.time()
+    progress = RankingProgress(output_file)
+    resumed = False
+    if resume and progress.load() and os.path.exists(output_file):
+        logging.info(f"Resuming '{output_file}' after {progress.queries_done} completed queries.")
+        output_f = open(output_file, 'r+', buffering=WRITE_BUFFER_SIZE)
+        output_f.seek(progress.offset)
+        output_f.truncate()  # drop the rankings of a partially written chunk
+        resumed = True
+    elif resume and os.path.exists(output_file):
+        logging.info(f"Rankings in '{output_file}' are complete, nothing to resume.")
+        return None
+    else:
+        output_f = open(output_file, 'w', buffering=WRITE_BUFFER_SIZE)
+        output_f.write("Query_number,doc_number\n")
+        progress.save(0, output_f.tell())
+
+    if doc_id_lookup is None:
+        doc_id_lookup = DocIdLookup(index_searcher.getIndexReader())
+    local = threading.local()
+
+    run_builder = RunBuilder()
+
+    def rank(query_text: str) -> Tuple[List[int], List[float]]:
+        if num_threads > 1 and not hasattr(local, "query_parser"):
+            local.query_parser = QueryParser(query_parser.getField(), query_parser.getAnalyzer())
+        parser = local.query_parser if num_threads > 1 else query_parser
+        doc_ids, scores = rank_query_with_scores(index_searcher, parser, query_text, doc_id_lookup, top_k=top_k,
+                                                 query_type=query_type, maxEdits=maxEdits, slop=slop,
+                                                 result_cache=result_cache, index_name=index_name,
+                                                 analyzer_name=analyzer_name, fuzzy_cache=fuzzy_cache,
+                                                 search_mode=search_mode, total_hits_threshold=total_hits_threshold,
+                                                 query_cache=query_cache, shingles=shingles)
+        if duplicates:
+            return duplicates.expand(doc_ids, scores, top_k)
+        return doc_ids, scores
+
+    executor = ThreadPoolExecutor(max_workers=num_threads, initializer=attach_current_thread) \
+        if num_threads > 1 else None
+    nr_queries = 0
+    try:
+        pending = None  # the previous chunk, written while the workers search the current chunk
+        for chunk in read_queries_in_chunks(input_file, delimiter, chunk_size, skip_queries=progress.queries_done):
+            # map yields the rankings in the order of the queries
+            rankings = (executor.map if executor is not None else map)(rank, chunk['Query'])
+            if pending is not None:
+                nr_queries += _write_chunk(output_f, progress, run_builder, *pending)
+            pending = (chunk['Query number'], rankings)
+        if pending is not None:
+            nr_queries += _write_chunk(output_f, progress, run_builder, *pending)
+    finally:
+        output_f.close()
+        if executor is not None:
+            executor.shutdown()
+    progress.remove()
+
+    elapsed_time = time.time() - start_time
+    logging.info(f"Ranked {nr_queries} queries in {elapsed_time:.2f} seconds "
+                 f"({nr_queries / max(elapsed_time, 1e-9):.1f} queries/s, {num_threads} thread(s)).")
+    if result_cache is not None:
+        logging.info(f"Result cache: {result_cache.stats()}")
+    if query_cache is not None and query_type != "fuzzy":
+        logging.info(f"Parsed query cache: {query_cache.stats()}")
+    if fuzzy_cache is not None and query_type == "fuzzy":
+        logging.info(f"Fuzzy expansion cache: {fuzzy_cache.stats()}")
+    logging.info(f"Saved document rankings to '{output_file}'.")
+    return None if resumed else run_builder.build()
+
+
+def _write_chunk(output_f: TextIO, progress: RankingProgress, run_builder: RunBuilder, query_numbers: Iterable,
+                 rankings: Iterable[Tuple[List[int], List[float]]]) -> int:
+    """
+    Write the rankings of a chunk of queries (and add them to the run) and record the progress.
+
+    :return: The number of queries in the chunk.
+    """
+    nr_queries = 0
+    for query_number, (doc_ids, scores) in zip(query_numbers, rankings):
+        with metrics.timer("rankings_write"):
+            output_f.write("".join(f"{query_number},{doc_id}\n" for doc_id in doc_ids))
+        run_builder.add(query_number, doc_ids, scores)
+        nr_queries += 1
+    metrics.increment("queries_ranked", nr_queries)
+    with metrics.timer("rankings_write"):
+        output_f.flush()
+    progress.save(progress.queries_done + nr_queries, output_f.tell())
+    return nr_queries
@@ -0,0 +1,176 @@
+import csv
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, Optional, Union, List
+
+import configargparse
+
+from .evaluate import Evaluation
+
+EVALUATION_CSV_HEADER = ['run_name', 'k', 'MAP@K', 'MAR@K', 'time(s)']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_name TEXT PRIMARY KEY,
+    config TEXT NOT NULL,
+    timings TEXT NOT NULL,
+    elapsed_time REAL NOT NULL,
+    recorded_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS evaluations (
+    run_name TEXT NOT NULL,
+    k INTEGER NOT NULL,
+    map_at_k REAL NOT NULL,
+    mar_at_k REAL NOT NULL,
+    elapsed_time REAL NOT NULL,
+    PRIMARY KEY (run_name, k)
+);
+"""
+
+
+class ResultsStore:
+    """
+    Stores the evaluation results of runs in a SQLite database.
+
+    Every run records its configuration and the time spent in every phase, and MAP@K and MAR@K for every k. Results are
+    upserted on (run_name, k) through the primary key index, so recording a run does not read or rewrite the results of
+    the other runs. The database uses write-ahead logging and waits for locks held by other writers, so many processes
+    (e.g. parallel sweeps) can record their runs concurrently without losing updates. The results can be exported in
+    the layout of the evaluation CSV file at any time.
+    """
+
+    def __init__(self, database_file: str, timeout: float = 60.0) -> None:
+        self.database_file = database_file
+        os.makedirs(os.path.dirname(database_file) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(database_file, timeout=timeout, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(SCHEMA)
+
+    def record(self, run_name: str, evaluations: Dict[int, Evaluation], elapsed_time: float,
+               run_config: Optional[dict] = None, timings: Optional[Dict[str, float]] = None) -> None:
+        """
+        Record (or replace) the evaluation results of a run in a single transaction.
+
+        :param evaluations: The evaluation of the run for every k.
+        :param elapsed_time: The duration of the run (in seconds).
+        :param run_config: The configuration of the run.
+        :param timings: The time spent in every phase of the run (in seconds).
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO runs (run_name, config, timings, elapsed_time, recorded_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (run_name) DO UPDATE SET config = excluded.config, timings = excluded.timings, "
+                "elapsed_time = excluded.elapsed_time, recorded_at = excluded.recorded_at",
+                (run_name, json.dumps(run_config or {}, sort_keys=True, default=str),
+                 json.dumps(timings or {}, sort_keys=True), elapsed_time, time.time()))
+            self._connection.executemany(
+                "INSERT INTO evaluations (run_name, k, map_at_k, mar_at_k, elapsed_time) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (run_name, k) DO UPDATE SET map_at_k = excluded.map_at_k, "
+                "mar_at_k = excluded.mar_at_k, elapsed_time = excluded.elapsed_time",
+                [(run_name, k, evaluation.map_at_k, evaluation.mar_at_k, elapsed_time)
+                 for k, evaluation in evaluations.items()])
+
+    def get_run(self, run_name: str) -> Optional[dict]:
+        """Return the configuration, phase timings and evaluations of a run, or None if it was not recorded."""
+        with self._lock:
+            row = self._connection.execute("SELECT config, timings, elapsed_time FROM runs WHERE run_name = ?",
+                                           (run_name,)).fetchone()
+            if row is None:
+                return None
+            evaluations = self._connection.execute(
+                "SELECT k, map_at_k, mar_at_k FROM evaluations WHERE run_name = ? ORDER BY k", (run_name,)).fetchall()
+        return {"config": json.loads(row[0]), "timings": json.loads(row[1]), "elapsed_time": row[2],
+                "evaluations": {k: Evaluation(map_at_k, mar_at_k) for k, map_at_k, mar_at_k in evaluations}}
+
+    def export_csv(self, csv_file: str) -> int:
+        """
+        Export the evaluation results in the layout of the evaluation CSV file (run_name, k, MAP@K, MAR@K, time(s)),
+        in the order the results were first recorded. The file is replaced atomically.
+
+        The database holds the write lock from reading the results until the file is replaced, so exports (and
+        recordings) of other processes wait: an export of an older snapshot can never replace the export of a newer one.
+
+        :return: The number of exported results.
+        """
+        directory = os.path.dirname(csv_file) or "."
+        os.makedirs(directory, exist_ok=True)
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN IMMEDIATE")
+            rows = self._connection.execute(
+                "SELECT run_name, k, map_at_k, mar_at_k, elapsed_time FROM evaluations ORDER BY rowid").fetchall()
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w", newline="", encoding="utf-8") as file:
+                writer = csv.writer(file)
+                writer.writerow(EVALUATION_CSV_HEADER)
+                writer.writerows([run_name, k, map_at_k, mar_at_k, f"{elapsed_time:.2f}"]
+                                 for run_name, k, map_at_k, mar_at_k, elapsed_time in rows)
+            os.replace(tmp_path, csv_file)
+        logging.info(f"Exported {len(rows)} evaluation results to '{csv_file}'.")
+        return len(rows)
+
+    def import_csv(self, csv_file: str) -> int:
+        """
+        Import the results of an evaluation CSV file (e.g. written before the results store existed). Results that are
+        already stored are kept.
+
+        :return: The number of imported results.
+        """
+        with open(csv_file, mode="r", newline="", encoding="utf-8") as file:
+            rows = [row for row in csv.reader(file) if row and row != EVALUATION_CSV_HEADER]
+        with self._lock, self._connection:
+            cursor = self._connection.executemany(
+                "INSERT OR IGNORE INTO evaluations (run_name, k, map_at_k, mar_at_k, elapsed_time) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(run_name, int(k), float(map_at_k), float(mar_at_k), float(elapsed_time))
+                 for run_name, k, map_at_k, mar_at_k, elapsed_time in rows])
+        logging.info(f"Imported {cursor.rowcount} evaluation results from '{csv_file}'.")
+        return cursor.rowcount
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def open_results_store(database_file: str, evaluation_file: Optional[str] = None) -> ResultsStore:
+    """
+    Open the results store, creating it if needed. A new store first imports the results of the evaluation CSV file,
+    if it exists, so exporting the store to that file keeps the results recorded before the store existed.
+    """
+    is_new = not os.path.exists(database_file)
+    store = ResultsStore(database_file)
+    if is_new and evaluation_file is not None and os.path.exists(evaluation_file):
+        store.import_csv(evaluation_file)
+    return store
+
+
+def main(args: Union[str, List[str]] = None) -> int:
+    parser = configargparse.ArgParser(description="IR: assignment 2, results store")
+    parser.add_argument("database", help="The SQLite database of the results store.")
+    parser.add_argument("--export", help="Export the evaluation results to this CSV file.")
+    parser.add_argument("--import_csv", help="Import the evaluation results of this CSV file.")
+    parsed_args = parser.parse_args(args)
+
+    store = ResultsStore(parsed_args.database)
+    try:
+        if parsed_args.import_csv is not None:
+            store.import_csv(parsed_args.import_csv)
+        if parsed_args.export is not None:
+            store.export_csv(parsed_args.export)
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    # only configure logging when run as a script, the module is also imported by main and the sweep
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(main())
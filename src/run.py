@@ -0,0 +1,109 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Sequence
+
+import numpy as np
+
+
+class Run:
+    """
+    The rankings of a query file kept in memory as compact columns: the query number, document id, rank (starting at
+    1) and score of every ranked document, in the order of the query file.
+
+    A run is handed from ranking to evaluation directly, and can be saved as a NumPy archive (to fuse or analyze the
+    scores later) or as a TREC run file.
+    """
+
+    def __init__(self, query_numbers: np.ndarray, doc_ids: np.ndarray, ranks: np.ndarray, scores: np.ndarray) -> None:
+        self.query_numbers = query_numbers
+        self.doc_ids = doc_ids
+        self.ranks = ranks
+        self.scores = scores
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def save_npz(self, file: str) -> None:
+        """Save the columns of the run as a NumPy archive."""
+        tmp_file = f"{file}.tmp.npz"
+        np.savez(tmp_file, query_numbers=self.query_numbers, doc_ids=self.doc_ids, ranks=self.ranks,
+                 scores=self.scores)
+        os.replace(tmp_file, file)
+
+    @staticmethod
+    def load_npz(file: str) -> "Run":
+        """Load a run saved with save_npz."""
+        with np.load(file) as archive:
+            return Run(archive["query_numbers"], archive["doc_ids"], archive["ranks"], archive["scores"])
+
+    def save_trec(self, file: str, run_tag: str) -> None:
+        """Save the run as a TREC run file (query Q0 document rank score tag)."""
+        tmp_file = f"{file}.tmp"
+        with open(tmp_file, "w", encoding="utf-8", buffering=1 << 20) as f:
+            for start in range(0, len(self), 100_000):
+                end = start + 100_000
+                f.write("".join(f"{query_number} Q0 {doc_id} {rank} {score:.6f} {run_tag}\n" for
+                                query_number, doc_id, rank, score in
+                                zip(self.query_numbers[start:end].tolist(), self.doc_ids[start:end].tolist(),
+                                    self.ranks[start:end].tolist(), self.scores[start:end].tolist())))
+        os.replace(tmp_file, file)
+
+
+class RunBuilder:
+    """Collects the rankings of the queries of a query file, in order, into a Run."""
+
+    def __init__(self) -> None:
+        self._query_numbers: List[np.ndarray] = []
+        self._doc_ids: List[np.ndarray] = []
+        self._scores: List[np.ndarray] = []
+
+    def add(self, query_number: int, doc_ids: Sequence[int], scores: Sequence[float]) -> None:
+        """Add the ranked documents of a query, best first."""
+        self._query_numbers.append(np.full(len(doc_ids), query_number, dtype=np.int64))
+        self._doc_ids.append(np.asarray(doc_ids, dtype=np.int64))
+        self._scores.append(np.asarray(scores, dtype=np.float32))
+
+    def build(self) -> Run:
+        if not self._doc_ids:
+            return Run(np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.int32), np.empty(0, np.float32))
+        ranks = np.concatenate([np.arange(1, len(doc_ids) + 1, dtype=np.int32) for doc_ids in self._doc_ids])
+        return Run(np.concatenate(self._query_numbers), np.concatenate(self._doc_ids), ranks,
+                   np.concatenate(self._scores))
+
+
+class RunWriter:
+    """
+    Saves runs in the background, so ranking and evaluation do not wait for the run files to be written.
+    """
+
+    def __init__(self) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending: List[Future] = []
+
+    def submit(self, run: Run, file_base: str, formats: Sequence[str], run_tag: str) -> None:
+        """
+        Save a run in the background in every given format ('npz', 'trec').
+
+        :param file_base: Path of the run files without extension, '.npz' or '.trec' is appended.
+        """
+        for run_format in formats:
+            file = f"{file_base}.{run_format}"
+            save = (lambda f=file: run.save_npz(f)) if run_format == "npz" else \
+                (lambda f=file: run.save_trec(f, run_tag))
+            self._pending.append(self._executor.submit(self._save, save, file))
+
+    @staticmethod
+    def _save(save, file: str) -> None:
+        save()
+        logging.info(f"Saved run to '{file}'.")
+
+    def wait(self) -> None:
+        """Wait until all submitted runs are saved, raising the first error of a failed save."""
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def close(self) -> None:
+        self.wait()
+        self._executor.shutdown()
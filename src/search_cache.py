@@ -0,0 +1,141 @@
+import threading
+from collections import OrderedDict
+from typing import Optional, Hashable, Tuple
+
+from org.apache.lucene.index import DirectoryReader
+
+
+def reader_generation(reader: "IndexReader") -> int:
+    """
+    Return the generation of the index seen by a reader. The version of a DirectoryReader changes whenever a reopened
+    reader sees changes of the index; the generation of a MultiReader over shards is the sum of the versions of the
+    shards, which grows whenever one of the shards changes.
+    """
+    if DirectoryReader.instance_(reader):
+        return DirectoryReader.cast_(reader).getVersion()
+    children = reader.getContext().children()
+    if children is None:
+        return 0
+    return sum(reader_generation(child.reader()) for child in children)
+
+
+def normalize_query_text(query_text: str) -> str:
+    """Normalize the text of a query for use in a cache key (collapse whitespace)."""
+    return " ".join(query_text.split())
+
+
+class SearchResultCache:
+    """
+    Thread-safe LRU cache of search results.
+
+    Entries are keyed on the index and its generation, the analyzer, the similarity (and its parameters), the query
+    type and its parameters, the normalized query text and the number of requested results. The cache holds at most
+    max_entries results, the least recently used result is evicted first.
+
+    A cache serves a single generation of every index: when a reader of an index is reopened after the index changed,
+    the first lookup with the new generation drops all results of the older generation. Lookups from readers of an
+    older generation are not served from (or stored in) the cache.
+    """
+
+    def __init__(self, max_entries: int = 10000) -> None:
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._generations = {}  # index -> generation of the cached results
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def create_key(index_searcher: "IndexSearcher", index_name: str, analyzer_name: str, query_type: str,
+                   query_text: str, top_k: Optional[int], maxEdits: int = 0, slop: int = 0) -> Tuple[Hashable, ...]:
+        """
+        Create the cache key of a query searched with the given searcher.
+
+        :param index_name: Identifies the index searched by the searcher.
+        :param analyzer_name: Identifies the analyzer used to parse the query.
+        """
+        generation = reader_generation(index_searcher.getIndexReader())
+        similarity = index_searcher.getSimilarity().toString()  # includes the parameters, e.g. BM25(k1=1.2,b=0.75)
+        return (index_name, generation, analyzer_name, similarity, query_type, slop, maxEdits,
+                normalize_query_text(query_text), top_k)
+
+    def _is_current(self, key: Tuple[Hashable, ...]) -> bool:
+        """
+        Check whether the key belongs to the newest generation of its index seen so far. The results of older
+        generations are dropped when a newer generation shows up.
+        """
+        index, generation = key[0], key[1]
+        current_generation = self._generations.get(index, generation)
+        if generation < current_generation:
+            return False
+        if generation > current_generation:
+            for outdated in [cached for cached in self._entries if cached[0] == index]:
+                del self._entries[outdated]
+        self._generations[index] = generation
+        return True
+
+    def get(self, key: Tuple[Hashable, ...]) -> Optional[object]:
+        """Return the cached result for the key, or None if it is not cached."""
+        with self._lock:
+            result = self._entries.get(key) if self._is_current(key) else None
+            if result is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, key: Tuple[Hashable, ...], result: object) -> None:
+        """Cache the result for the key, evicting the least recently used results if the cache is full."""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if not self._is_current(key):
+                return
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return (f"{len(self._entries)} entries, {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), "
+                f"{self.evictions} evictions")
+
+
+class FuzzyExpansionCache(SearchResultCache):
+    """
+    Thread-safe LRU cache of fuzzy term expansions.
+
+    Rewriting a FuzzyQuery builds the Levenshtein automaton of its term and intersects it with the term dictionary of
+    every segment. The cache stores the rewritten query of every fuzzy term (the expanded terms, their boosts and
+    blended term statistics), so a term that was expanded before is searched as a plain weighted boolean query of its
+    expansions, without building its automaton again.
+
+    Entries are keyed on the index and its generation, the field, the term and the parameters of the FuzzyQuery. As
+    for search results, the expansions of an older generation of an index are dropped when a newer generation shows
+    up. The term statistics of an expansion belong to the reader it was rewritten with, so the cache must only be used
+    with a single reader per index generation.
+    """
+
+    @staticmethod
+    def create_key(index_searcher: "IndexSearcher", index_name: str, field: str, term_text: str, maxEdits: int,
+                   prefixLength: int, maxExpansions: int) -> Tuple[Hashable, ...]:
+        """
+        Create the cache key of the expansion of a fuzzy term in the index searched by the given searcher.
+
+        :param index_name: Identifies the index searched by the searcher.
+        """
+        generation = reader_generation(index_searcher.getIndexReader())
+        return index_name, generation, field, term_text, maxEdits, prefixLength, maxExpansions
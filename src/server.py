@@ -0,0 +1,352 @@
+import json
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from typing import Union, List, Optional, Tuple, Sequence
+
+from org.apache.lucene.index import MultiReader
+from org.apache.lucene.queryparser.classic import QueryParser
+from org.apache.lucene.search import IndexSearcher, SearcherManager, SearcherFactory
+
+from .analyzer import AnalyzerFactory, get_field_name
+from .catalog import IndexCatalog
+from .config import config, Config
+from .indexer import ensure_index
+from .instrumentation import metrics
+from .jvm import init_vm, attach_current_thread
+from .ranking import rank_query, create_search_executor, DocIdLookup
+from .search_cache import SearchResultCache, FuzzyExpansionCache
+from .shards import get_shard_paths, open_directory
+from .similarity import SimilarityFactory
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+MAX_TOP_K = 1000
+
+
+class SearchService:
+    """
+    Keeps the JVM, the analyzer and the index searcher warm to answer queries without startup cost.
+
+    The searcher of every shard of the index is managed by a SearcherManager, which is refreshed periodically so new
+    commits of the index (e.g. by an incremental indexing run) are picked up without restarting the service. The
+    similarity, query type and number of results can be chosen per request.
+
+    Requests search the current generation of the index: a reader over the readers of all shards with its document id
+    lookup. After a refresh, the next generation is built (and its document ids are loaded) outside the lock, and only
+    then swapped in, so requests never wait for it and never see an older generation again. Every request holds a
+    reference to the reader it searches, the reader of a replaced generation is closed once its last request is done.
+    """
+
+    def __init__(self, index_path: str, analyzer_type: str, search_executor=None,
+                 result_cache: Optional[SearchResultCache] = None, shards: int = 1,
+                 field: str = "text_content", fuzzy_cache: Optional[FuzzyExpansionCache] = None,
+                 search_mode: str = "default", total_hits_threshold: int = 0, shingles: bool = False,
+                 directory_type: str = "fs", preload_extensions: Sequence[str] = ()) -> None:
+        self.index_path = index_path
+        self.analyzer_type = analyzer_type
+        self.analyzer = AnalyzerFactory.get_analyzer(analyzer_type)
+        self.field = field
+        self.search_executor = search_executor
+        self.result_cache = result_cache
+        self.fuzzy_cache = fuzzy_cache
+        self.search_mode = search_mode
+        self.total_hits_threshold = total_hits_threshold
+        self.shingles = shingles
+        self._managers = [SearcherManager(open_directory(shard_path, directory_type, preload_extensions),
+                                          SearcherFactory())
+                          for shard_path in get_shard_paths(index_path, shards)]
+        self._lock = threading.Lock()  # guards the current generation
+        self._refresh_lock = threading.Lock()  # serializes building generations
+        self._local = threading.local()
+        self._generation = 0
+        self._shard_readers = self._reader = self._doc_id_lookup = None
+        self._refresh_generation()
+
+    def _open_generation(self, shard_readers: List["IndexReader"]) -> Tuple["IndexReader", DocIdLookup]:
+        """
+        Open a reader over the readers of the shards and load its document id lookup. The returned reader holds one
+        reference of its own, independent of the searchers of the SearcherManagers.
+        """
+        if len(shard_readers) == 1:
+            reader = shard_readers[0]
+            reader.incRef()
+        else:
+            # the shards are searched as one index, the MultiReader keeps the readers of the shards open
+            reader = MultiReader(shard_readers, False)
+        try:
+            return reader, DocIdLookup(reader, preload=True)
+        except Exception:
+            reader.decRef()
+            raise
+
+    def _refresh_generation(self) -> bool:
+        """
+        Swap in a new generation if the reader of any shard changed since the current generation was opened.
+
+        :return: Whether a new generation was swapped in.
+        """
+        managed_searchers = [IndexSearcher.cast_(manager.acquire()) for manager in self._managers]
+        try:
+            shard_readers = [managed_searcher.getIndexReader() for managed_searcher in managed_searchers]
+            if self._shard_readers is not None and \
+                    all(old.equals(new) for old, new in zip(self._shard_readers, shard_readers)):
+                return False
+            reader, doc_id_lookup = self._open_generation(shard_readers)
+        finally:
+            for manager, managed_searcher in zip(self._managers, managed_searchers):
+                manager.release(managed_searcher)
+        with self._lock:
+            old_reader = self._reader
+            self._reader, self._doc_id_lookup, self._shard_readers = reader, doc_id_lookup, shard_readers
+            self._generation += 1
+        if old_reader is not None:
+            old_reader.decRef()  # closed once the requests still searching it are done
+        return True
+
+    @property
+    def generation(self) -> int:
+        """The number of generations of the reader opened so far."""
+        return self._generation
+
+    def refresh(self) -> None:
+        """Pick up new commits of the index, if any, and swap in a new generation of the reader."""
+        with self._refresh_lock:
+            # maybeRefresh also returns True when nothing changed, so the readers of the shards are compared
+            for manager in self._managers:
+                manager.maybeRefresh()
+            if not self._refresh_generation():
+                return
+        logging.info(f"Search service refreshed its searcher (generation {self._generation}).")
+
+    def _acquire_reader(self) -> Tuple["IndexReader", DocIdLookup]:
+        """
+        Return the reader of the current generation and its document id lookup. The reader is shared by all requests
+        (so the fuzzy expansions cached for it stay valid) and must be released (decRef) after searching.
+        """
+        with self._lock:
+            if self._reader is None:
+                raise RuntimeError("The search service is closed")
+            self._reader.incRef()
+            return self._reader, self._doc_id_lookup
+
+    def _get_query_parser(self) -> QueryParser:
+        # query parsers are not thread-safe, every thread has its own
+        if not hasattr(self._local, "query_parser"):
+            self._local.query_parser = QueryParser(self.field, self.analyzer)
+        return self._local.query_parser
+
+    def search(self, query_texts: List[str], query_type: str = "boolean_or", top_k: int = 10,
+               similarity_type: str = "bm25", k1: float = 1.2, b: float = 0.75, maxEdits: int = 2,
+               slop: int = 0) -> List[List[int]]:
+        """
+        Rank a batch of queries.
+
+        :return: The ids of the top ranked documents of every query.
+        """
+        reader, doc_id_lookup = self._acquire_reader()
+        try:
+            # a light-weight searcher per request, so requests with different similarities do not interfere
+            searcher = IndexSearcher(reader, self.search_executor)
+            searcher.setSimilarity(SimilarityFactory.get_similarity(similarity_type=similarity_type, k1=k1, b=b))
+            query_parser = self._get_query_parser()
+            return [rank_query(searcher, query_parser, query_text, doc_id_lookup, top_k=top_k, query_type=query_type,
+                               maxEdits=maxEdits, slop=slop, result_cache=self.result_cache,
+                               index_name=self.index_path, analyzer_name=self.analyzer_type,
+                               fuzzy_cache=self.fuzzy_cache, search_mode=self.search_mode,
+                               total_hits_threshold=self.total_hits_threshold, shingles=self.shingles)
+                    for query_text in query_texts]
+        finally:
+            reader.decRef()
+
+    def close(self) -> None:
+        with self._refresh_lock:
+            with self._lock:
+                reader, self._reader, self._doc_id_lookup, self._shard_readers = self._reader, None, None, None
+            if reader is not None:
+                reader.decRef()
+            for manager in self._managers:
+                manager.close()
+
+
+def parse_search_request(request: dict) -> dict:
+    """
+    Validate a search request and convert it to the arguments of SearchService.search.
+
+    A request contains either a single "query" or a batch of "queries", and optionally the "query_type", "top_k",
+    "similarity", "k1", "b", "maxEdits" and "slop" to use.
+    """
+    if not isinstance(request, dict):
+        raise ValueError("The request must be a JSON object")
+    if "queries" in request:
+        query_texts = request["queries"]
+        if not isinstance(query_texts, list) or not all(isinstance(text, str) for text in query_texts):
+            raise ValueError("'queries' must be a list of strings")
+    elif isinstance(request.get("query"), str):
+        query_texts = [request["query"]]
+    else:
+        raise ValueError("The request must contain a 'query' string or a 'queries' list")
+
+    query_type = request.get("query_type", "boolean_or")
+    if query_type not in Config.VALID_QUERY_TYPES:
+        raise ValueError(f"Query type '{query_type}' is not supported")
+    similarity_type = request.get("similarity", "bm25")
+    if similarity_type not in Config.VALID_SIMILARITIES:
+        raise ValueError(f"Invalid similarity '{similarity_type}'. "
+                         f"Valid options are: {', '.join(Config.VALID_SIMILARITIES)}")
+    top_k = int(request.get("top_k", 10))
+    if not 1 <= top_k <= MAX_TOP_K:
+        raise ValueError(f"top_k must be between 1 and {MAX_TOP_K}")
+    max_edits = int(request.get("maxEdits", 2))
+    if max_edits not in Config.VALID_MAX_EDITS:
+        raise ValueError("maxEdits must be between 0 and 2")
+    slop = int(request.get("slop", 0))
+    if slop < 0:
+        raise ValueError("Slop must be positive")
+    return {"query_texts": query_texts, "query_type": query_type, "top_k": top_k, "similarity_type": similarity_type,
+            "k1": float(request.get("k1", 1.2)), "b": float(request.get("b", 0.75)), "maxEdits": max_edits,
+            "slop": slop}
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles the HTTP endpoints of the search server:
+
+    POST /search  rank a single query or a batch of queries (JSON body, see parse_search_request)
+    GET  /health  check whether the server is up
+    GET  /stats   result and fuzzy expansion cache statistics
+    GET  /metrics timers and counters of the search phases (Prometheus text format)
+    """
+
+    def _send_json(self, status: int, body: dict) -> None:
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self) -> None:
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif self.path == "/stats":
+            result_cache = self.server.service.result_cache
+            fuzzy_cache = self.server.service.fuzzy_cache
+            self._send_json(200, {"result_cache": result_cache.stats() if result_cache is not None else None,
+                                  "fuzzy_cache": fuzzy_cache.stats() if fuzzy_cache is not None else None})
+        elif self.path == "/metrics":
+            payload = metrics.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        else:
+            self._send_json(404, {"error": f"Unknown endpoint '{self.path}'"})
+
+    def do_POST(self) -> None:
+        if self.path != "/search":
+            self._send_json(404, {"error": f"Unknown endpoint '{self.path}'"})
+            return
+        start_time = time.time()
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            arguments = parse_search_request(json.loads(self.rfile.read(length) or b"{}"))
+        except (ValueError, TypeError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        try:
+            rankings = self.server.service.search(**arguments)
+        except Exception as e:
+            logging.exception("Search request failed")
+            self._send_json(500, {"error": str(e)})
+            return
+        results = [{"query": query_text, "doc_ids": doc_ids}
+                   for query_text, doc_ids in zip(arguments["query_texts"], rankings)]
+        self._send_json(200, {"results": results, "took_ms": (time.time() - start_time) * 1000})
+
+    def log_message(self, format: str, *args) -> None:
+        logging.debug(f"{self.address_string()} - {format % args}")
+
+
+class SearchHTTPServer(HTTPServer):
+    """
+    HTTP server that handles requests on a fixed pool of worker threads, which are attached to the JVM once.
+    """
+
+    def __init__(self, server_address, service: SearchService, num_threads: int) -> None:
+        super().__init__(server_address, SearchRequestHandler)
+        self.service = service
+        self._executor = ThreadPoolExecutor(max_workers=num_threads, initializer=attach_current_thread)
+
+    def process_request(self, request, client_address) -> None:
+        self._executor.submit(self._process_request_in_worker, request, client_address)
+
+    def _process_request_in_worker(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self._executor.shutdown(wait=True)
+
+
+def _refresh_periodically(service: SearchService, interval: float, stop: threading.Event) -> None:
+    attach_current_thread()
+    while not stop.wait(interval):
+        service.refresh()
+
+
+def main(args: Union[str, List[str]] = None) -> int:
+    config.parse(args, rank_queries_file=False)  # parse config file or command line arguments
+    if config.get('help', False):
+        return 0
+
+    init_vm()  # initialize VM to adapt Java Lucene to Python, once for the lifetime of the server
+
+    catalog = IndexCatalog(config.index_dir)
+    full_index_path = ensure_index(catalog, config.data_dir, config.analyzer, config.similarity,
+                                   num_threads=config.index_threads, ram_buffer_mb=config.ram_buffer_mb,
+                                   merge_policy=config.merge_policy, merge_factor=config.merge_factor,
+                                   incremental=config.incremental, shards=config.shards,
+                                   corpus_format=config.corpus_format, multi_field=config.multi_field,
+                                   shingles=config.shingles, dedup_threshold=config.dedup_threshold)
+    search_executor = create_search_executor(config.intra_query_threads)
+    result_cache = SearchResultCache(config.result_cache_size) if config.result_cache_size > 0 else None
+    fuzzy_cache = FuzzyExpansionCache(config.fuzzy_cache_size) if config.fuzzy_cache_size > 0 else None
+    service = SearchService(full_index_path, config.analyzer, search_executor=search_executor,
+                            result_cache=result_cache, shards=config.shards,
+                            field=get_field_name(config.analyzer, config.multi_field), fuzzy_cache=fuzzy_cache,
+                            search_mode=config.search_mode, total_hits_threshold=config.total_hits_threshold,
+                            shingles=config.shingles, directory_type=config.directory,
+                            preload_extensions=config.preload_extensions)
+
+    stop = threading.Event()
+    refresher = threading.Thread(target=_refresh_periodically, args=(service, config.refresh_interval, stop),
+                                 daemon=True)
+    refresher.start()
+
+    server = SearchHTTPServer((config.host, config.port), service, num_threads=config.search_threads)
+    logging.info(f"Search server listening on http://{config.host}:{config.port} (index '{full_index_path}')")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Shutting down the search server...")
+    finally:
+        stop.set()
+        server.server_close()
+        service.close()
+        if search_executor is not None:
+            search_executor.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
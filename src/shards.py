@@ -0,0 +1,84 @@
+import os
+import zlib
+from typing import List, Sequence, Dict
+
+from java.nio.file import Paths
+from java.util import HashSet
+from org.apache.lucene.index import DirectoryReader, MultiReader
+from org.apache.lucene.store import FSDirectory, MMapDirectory, NIOFSDirectory, FileSwitchDirectory
+
+
+def shard_of(doc_id: int, shards: int) -> int:
+    """Return the shard a document is routed to, based on a (stable) hash of its id."""
+    return zlib.crc32(str(doc_id).encode("utf-8")) % shards
+
+
+def get_shard_paths(index_path: str, shards: int = 1) -> List[str]:
+    """
+    Return the directories of the shards of an index. An index with a single shard is stored directly in index_path,
+    the shards of a sharded index in the subdirectories shard_0, shard_1...
+    """
+    if shards <= 1:
+        return [index_path]
+    return [os.path.join(index_path, f"shard_{shard}") for shard in range(shards)]
+
+
+def open_directory(path: str, directory_type: str = "fs", preload_extensions: Sequence[str] = ()) -> "Directory":
+    """
+    Open the Lucene directory of an index (or shard) for searching.
+
+    :param directory_type: fs lets Lucene choose the implementation (memory-mapped on 64-bit platforms), mmap
+    memory-maps the index files and niofs reads them with positional reads, without memory-mapping them.
+    :param preload_extensions: Extensions of the index files (e.g. tim, doc, nvd) an mmap directory loads into physical
+    memory when they are opened, so the first queries do not page them in from disk.
+    """
+    if directory_type == "niofs":
+        return NIOFSDirectory(Paths.get(path))
+    if directory_type == "fs":
+        return FSDirectory.open(Paths.get(path))
+    if not preload_extensions:
+        return MMapDirectory(Paths.get(path))
+    # the files with a preloaded extension are opened by a preloading directory, the others by a regular one
+    preloaded = MMapDirectory(Paths.get(path))
+    preloaded.setPreload(True)
+    extensions = HashSet()
+    for extension in preload_extensions:
+        extensions.add(extension.lstrip("."))
+    return FileSwitchDirectory(extensions, preloaded, MMapDirectory(Paths.get(path)), True)
+
+
+def index_size_by_extension(index_path: str) -> Dict[str, Dict[str, int]]:
+    """
+    Measure the size on disk of an index (all its shards) per file type: the extension of the Lucene files (tim, doc,
+    pos, nvd, cfs...), segments for the commit points and the file name for other files.
+
+    :return: The number of files and their total size (in bytes) per file type, largest first.
+    """
+    sizes = {}
+    for directory, _, files in os.walk(index_path):
+        for file in files:
+            name, extension = os.path.splitext(file)
+            file_type = "segments" if file.startswith("segments") else extension.lstrip(".") if name.startswith("_") \
+                else file
+            stats = sizes.setdefault(file_type, {"files": 0, "bytes": 0})
+            stats["files"] += 1
+            stats["bytes"] += os.path.getsize(os.path.join(directory, file))
+    return dict(sorted(sizes.items(), key=lambda item: item[1]["bytes"], reverse=True))
+
+
+def open_index_reader(index_path: str, shards: int = 1, directory_type: str = "fs",
+                      preload_extensions: Sequence[str] = ()) -> "IndexReader":
+    """
+    Open a reader of an index. The shards of a sharded index are opened as a single MultiReader, so term statistics
+    (and thus scores) are computed over all shards as if they were one index. An IndexSearcher with an executor searches
+    the segments of all shards concurrently and merges their top hits. Closing the reader closes the readers of the
+    shards.
+
+    :param directory_type: The directory implementation the shards are opened with (see open_directory).
+    :param preload_extensions: Extensions of the index files preloaded by an mmap directory.
+    """
+    readers = [DirectoryReader.open(open_directory(path, directory_type, preload_extensions))
+               for path in get_shard_paths(index_path, shards)]
+    if len(readers) == 1:
+        return readers[0]
+    return MultiReader(readers, True)
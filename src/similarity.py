@@ -4,6 +4,10 @@ from org.apache.lucene.search.similarities import BM25Similarity, ClassicSimilar
 
 
 class SimilarityFactory:
+    # Both similarities store the (discounted) field length as a SmallFloat.intToByte4 encoded norm, so an index built
+    # with one of them can be searched with the other, whatever the parameters (k1, b) are.
+    NORM_ENCODINGS = {"bm25": "lengthnorm", "classic": "lengthnorm"}
+
     # https://lucene.apache.org/core/9_12_0/core/org/apache/lucene/search/package-summary.html
     @staticmethod
     def get_similarity(similarity_type: str, k1: float = 1.2, b: float = 0.75) -> "Similarity":
@@ -16,3 +20,11 @@ class SimilarityFactory:
             return ClassicSimilarity()  # https://lucene.apache.org/core/9_12_0/core/org/apache/lucene/search/similarities/ClassicSimilarity.html
         else:
             raise ValueError(f"Unknown similarity type: {similarity_name}")
+
+    @staticmethod
+    def get_norm_encoding(similarity_type: str) -> str:
+        """Return the name of the norm encoding the similarity writes at index time."""
+        similarity_name = similarity_type.lower()
+        if similarity_name not in SimilarityFactory.NORM_ENCODINGS:
+            raise ValueError(f"Unknown similarity type: {similarity_name}")
+        return SimilarityFactory.NORM_ENCODINGS[similarity_name]
@@ -1,33 +1,62 @@
-from org.apache.lucene.analysis import CharArraySet
+import functools
+import hashlib
+from typing import Tuple
 
+from org.apache.lucene.analysis import CharArraySet, StopFilter
 
-def load_stopwords_spacy():
+SPACY_STOPWORDS_FILE = "resources/spacy_stopwords.txt"
+
+LUCENE_STOPWORDS = (
+    "but", "be", "with", "such", "then", "for", "no", "will", "not", "are",
+    "and", "their", "if", "this", "on", "into", "a", "or", "there", "in",
+    "that", "they", "was", "is", "it", "an", "the", "as", "at", "these",
+    "by", "to", "of"
+)
+
+
+@functools.lru_cache(maxsize=None)
+def read_stopwords(file_path: str) -> Tuple[str, ...]:
     """
-    https://github.com/igorbrigadir/stopwords/blob/master/en/spacy.txt
+    Read a stopword file with one stopword per line, once per process.
     """
-    file_path = "resources/spacy_stopwords.txt"
-    stopwords_list = []
-    # read line by line
     with open(file_path, "r", encoding="utf-8") as file:
-        for line in file:
-            stopwords_list.append(line.strip(line))
-
-    stopwords_set = CharArraySet(len(stopwords_list), True)
-    # Add each custom stopword to the set
-    for stopword in stopwords_list:
-        stopwords_set.add(stopword)
-    return stopwords_set
-
-
-def load_lucene_stopwords():
-    stopwords = [
-        "but", "be", "with", "such", "then", "for", "no", "will", "not", "are",
-        "and", "their", "if", "this", "on", "into", "a", "or", "there", "in",
-        "that", "they", "was", "is", "it", "an", "the", "as", "at", "these",
-        "by", "to", "of"
-    ]
-    stopwords_set = CharArraySet(len(stopwords), True)
-    # Add each custom stopword to the set
-    for stopword in stopwords:
-        stopwords_set.add(stopword)
-    return stopwords_set
+        return tuple(stopword for stopword in (line.strip() for line in file) if stopword)
+
+
+def create_stopword_set(stopwords: Tuple[str, ...]) -> CharArraySet:
+    """
+    Convert stopwords to an (unmodifiable, so it can be shared) case-insensitive set in a single call into Lucene,
+    instead of adding them one by one.
+    """
+    return CharArraySet.unmodifiableSet(StopFilter.makeStopSet(list(stopwords), True))
+
+
+def stopwords_digest(stopwords: Tuple[str, ...]) -> str:
+    """Return a digest of a list of stopwords, which changes whenever the stopwords change."""
+    return hashlib.sha1("\n".join(stopwords).encode("utf-8")).hexdigest()[:12]
+
+
+def get_stopwords(source: str) -> Tuple[str, ...]:
+    """
+    Return the stopwords of a source: the built-in Lucene list ("lucene") or the path of a stopword file.
+    """
+    return LUCENE_STOPWORDS if source == "lucene" else read_stopwords(source)
+
+
+@functools.lru_cache(maxsize=None)
+def load_stopwords(source: str) -> CharArraySet:
+    """
+    Return the stopword set of a source, built once per process and shared by all analyzers using it.
+    """
+    return create_stopword_set(get_stopwords(source))
+
+
+def load_stopwords_spacy() -> CharArraySet:
+    """
+    https://github.com/igorbrigadir/stopwords/blob/master/en/spacy.txt
+    """
+    return load_stopwords(SPACY_STOPWORDS_FILE)
+
+
+def load_lucene_stopwords() -> CharArraySet:
+    return load_stopwords("lucene")
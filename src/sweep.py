@@ -0,0 +1,292 @@
+import itertools
+import logging
+import os
+import sys
+import time
+from typing import Union, List, Tuple
+
+import configargparse
+import yaml
+from org.apache.lucene.queryparser.classic import QueryParser
+from org.apache.lucene.search import IndexSearcher
+
+from .analyzer import AnalyzerFactory, get_field_name
+from .catalog import IndexCatalog
+from .config import Config
+from .dedup import DuplicateMap
+from .indexer import ensure_index
+from .instrumentation import metrics, report_index_size
+from .jvm import init_vm
+from .query_cache import ParsedQueryCache
+from .results_store import open_results_store
+from .run import RunWriter
+from .main import create_run_name, record_evaluation
+from .ranking import rank_queries_from_file, create_rankings_file_name, get_queries_delimiter, \
+    create_search_executor, DocIdLookup, warmup_searcher
+from .search_cache import SearchResultCache, FuzzyExpansionCache
+from .shards import open_index_reader, index_size_by_extension
+from .similarity import SimilarityFactory
+
+# Settings that can be omitted from a grid file
+GRID_DEFAULTS = {
+    "index_dir": "index",
+    "ranking_dir": "results/ranking",
+    "evaluation_file": "results/evaluation/evaluation.csv",
+    "export_evaluation": False,
+    "results_db": "results/evaluation/results.db",
+    "top_k": 10,
+    "similarities": [{"name": "bm25"}],
+    "query_types": [{"name": "boolean_or"}],
+    "search_threads": os.cpu_count() or 1,
+    "intra_query_threads": 0,
+    "search_mode": "default",
+    "total_hits_threshold": 0,
+    "result_cache_size": 10000,
+    "fuzzy_cache_size": 10000,
+    "query_cache_size": 10000,
+    "query_cache_file": None,
+    "query_chunk_size": 1000,
+    "index_threads": os.cpu_count() or 1,
+    "incremental": False,
+    "multi_field": False,
+    "shingles": False,
+    "dedup_threshold": 0.0,
+    "expand_duplicates": False,
+    "ram_buffer_mb": 256.0,
+    "merge_policy": "tiered",
+    "merge_factor": 10,
+    "shards": 1,
+    "corpus_format": "auto",
+    "metrics_file": None,
+    "directory": "fs",
+    "preload_extensions": [],
+    "warmup_queries": 0,
+    "run_formats": [],
+}
+
+
+def load_grid(grid_file: str) -> dict:
+    """
+    Load and validate a grid file.
+
+    :param grid_file: Path to the YAML file describing the grid.
+    :return: The grid settings, completed with the default values.
+    """
+    with open(grid_file, "r", encoding="utf-8") as f:
+        grid = {**GRID_DEFAULTS, **(yaml.safe_load(f) or {})}
+
+    for required in ["data_dir", "analyzers", "queries", "reference_file"]:
+        if required not in grid:
+            raise ValueError(f"Grid file '{grid_file}' does not specify '{required}'.")
+    if isinstance(grid["queries"], str):
+        grid["queries"] = [grid["queries"]]
+
+    for analyzer in grid["analyzers"]:
+        if analyzer not in Config.VALID_ANALYZERS:
+            raise ValueError(f"Invalid analyzer '{analyzer}'. Valid options are: {', '.join(Config.VALID_ANALYZERS)}")
+    for similarity in grid["similarities"]:
+        if similarity["name"] not in Config.VALID_SIMILARITIES:
+            raise ValueError(f"Invalid similarity '{similarity['name']}'. "
+                             f"Valid options are: {', '.join(Config.VALID_SIMILARITIES)}")
+    for query_type in grid["query_types"]:
+        if query_type["name"] not in Config.VALID_QUERY_TYPES:
+            raise ValueError(f"Query type '{query_type['name']}' is not supported")
+        if any(max_edits not in Config.VALID_MAX_EDITS for max_edits in query_type.get("maxEdits", [])):
+            raise ValueError("maxEdits must be between 0 and 2")
+        if any(int(slop) < 0 for slop in query_type.get("slop", [])):
+            raise ValueError("Slop must be positive")
+
+    if grid["corpus_format"] not in Config.VALID_CORPUS_FORMATS:
+        raise ValueError(f"Invalid corpus format '{grid['corpus_format']}'. "
+                         f"Valid options are: {', '.join(Config.VALID_CORPUS_FORMATS)}")
+    if grid["search_mode"] not in Config.VALID_SEARCH_MODES:
+        raise ValueError(f"Invalid search mode '{grid['search_mode']}'. "
+                         f"Valid options are: {', '.join(Config.VALID_SEARCH_MODES)}")
+    if grid["total_hits_threshold"] < 0:
+        raise ValueError("total_hits_threshold must be positive")
+    for run_format in grid["run_formats"]:
+        if run_format not in Config.VALID_RUN_FORMATS:
+            raise ValueError(f"Invalid run format '{run_format}'. "
+                             f"Valid options are: {', '.join(Config.VALID_RUN_FORMATS)}")
+    if grid["directory"] not in Config.VALID_DIRECTORIES:
+        raise ValueError(f"Invalid directory '{grid['directory']}'. "
+                         f"Valid options are: {', '.join(Config.VALID_DIRECTORIES)}")
+    if grid["preload_extensions"] and grid["directory"] != "mmap":
+        raise ValueError("preload_extensions requires the mmap directory")
+    if grid["warmup_queries"] < 0:
+        raise ValueError("warmup_queries must be positive")
+    if not 0 <= grid["dedup_threshold"] <= 1:
+        raise ValueError("dedup_threshold must be between 0 and 1")
+    if grid["dedup_threshold"] > 0 and grid["incremental"]:
+        raise ValueError("dedup_threshold cannot be combined with incremental updates")
+    if grid["shards"] < 1:
+        raise ValueError("shards must be at least 1")
+    if not os.path.exists(grid["data_dir"]):
+        raise FileNotFoundError(f"Data directory '{grid['data_dir']}' does not exist.")
+    for queries in grid["queries"]:
+        if not os.path.exists(queries):
+            raise FileNotFoundError(f"Specified queries file '{queries}' does not exist.")
+    if not os.path.exists(grid["reference_file"]):
+        raise FileNotFoundError(f"Reference file '{grid['reference_file']}' does not exist.")
+    os.makedirs(grid["ranking_dir"], exist_ok=True)
+    return grid
+
+
+def expand_similarities(grid: dict) -> List[Tuple[str, float, float]]:
+    """
+    Expand the similarities of a grid into (similarity, k1, b) tuples. The k1/b parameters default to the BM25
+    defaults, which are also used to name runs of similarities without parameters.
+    """
+    similarities = []
+    for similarity in grid["similarities"]:
+        for k1, b in itertools.product(similarity.get("k1", [1.2]), similarity.get("b", [0.75])):
+            similarities.append((similarity["name"], float(k1), float(b)))
+    return similarities
+
+
+def expand_query_types(grid: dict) -> List[Tuple[str, int, int]]:
+    """
+    Expand the query types of a grid into (query_type, slop, maxEdits) tuples.
+    """
+    query_types = []
+    for query_type in grid["query_types"]:
+        for slop, max_edits in itertools.product(query_type.get("slop", [0]), query_type.get("maxEdits", [2])):
+            query_types.append((query_type["name"], int(slop), int(max_edits)))
+    return query_types
+
+
+def run_sweep(grid: dict) -> int:
+    """
+    Run every configuration of the grid, writing the rankings and evaluation results of each run.
+
+    :return: The number of runs.
+    """
+    init_vm()  # initialize VM to adapt Java Lucene to Python, once for the whole sweep
+
+    catalog = IndexCatalog(grid["index_dir"])
+    similarities = expand_similarities(grid)
+    query_types = expand_query_types(grid)
+    readers = {}  # index path -> reader shared by every configuration searching that index
+    doc_id_lookups = {}  # index path -> document id lookup of the reader
+    warmed_up = set()  # index paths whose reader was warmed up
+    duplicate_maps = {}  # index path -> near-duplicates of the documents of the index, to expand the rankings with
+    search_executor = create_search_executor(grid["intra_query_threads"])
+    result_cache = SearchResultCache(grid["result_cache_size"]) if grid["result_cache_size"] > 0 else None
+    # expansions only depend on the index, so they are shared by all similarities and query files searching it
+    fuzzy_cache = FuzzyExpansionCache(grid["fuzzy_cache_size"]) if grid["fuzzy_cache_size"] > 0 else None
+    # parsed queries only depend on the analyzer and the query type, so they are shared by all indexes and similarities
+    query_cache = ParsedQueryCache(grid["query_cache_size"], grid["query_cache_file"]) \
+        if grid["query_cache_size"] > 0 or grid["query_cache_file"] is not None else None
+    run_writer = RunWriter()  # saves the runs in the background while the next configurations are searched
+    # every run is recorded as soon as it is evaluated, so sweeps running in parallel never lose each other's results
+    results_store = open_results_store(grid["results_db"], grid["evaluation_file"])
+    nr_runs = 0
+    try:
+        for analyzer_type in grid["analyzers"]:
+            with metrics.timer("analyzer_create"):
+                analyzer = AnalyzerFactory.get_analyzer(analyzer_type)
+            # the index only depends on the norm encoding of the similarity, not on the similarity parameters, so it
+            # is resolved (and its data directory fingerprinted) once per analyzer and norm encoding
+            index_paths = {}  # norm encoding -> index path
+            for similarity_type, k1, b in similarities:
+                norm_encoding = SimilarityFactory.get_norm_encoding(similarity_type)
+                if norm_encoding not in index_paths:
+                    index_paths[norm_encoding] = ensure_index(
+                        catalog, grid["data_dir"], analyzer_type, similarity_type, num_threads=grid["index_threads"],
+                        ram_buffer_mb=grid["ram_buffer_mb"], merge_policy=grid["merge_policy"],
+                        merge_factor=grid["merge_factor"], incremental=grid["incremental"], shards=grid["shards"],
+                        corpus_format=grid["corpus_format"], multi_field=grid["multi_field"],
+                        shingles=grid["shingles"], dedup_threshold=grid["dedup_threshold"])
+                full_index_path = index_paths[norm_encoding]
+                if full_index_path not in readers:
+                    report_index_size(full_index_path, index_size_by_extension(full_index_path), metrics)
+                    with metrics.timer("index_open"):
+                        readers[full_index_path] = open_index_reader(full_index_path, grid["shards"],
+                                                                     directory_type=grid["directory"],
+                                                                     preload_extensions=grid["preload_extensions"])
+                    doc_id_lookups[full_index_path] = DocIdLookup(readers[full_index_path], preload=True)
+                    if grid["expand_duplicates"]:
+                        duplicate_maps[full_index_path] = DuplicateMap.load(full_index_path)
+                searcher = IndexSearcher(readers[full_index_path], search_executor)
+                searcher.setSimilarity(SimilarityFactory.get_similarity(similarity_type=similarity_type, k1=k1, b=b))
+                run_name = create_run_name(grid["data_dir"], analyzer_type, similarity_type, k1, b)
+
+                for queries_file, (query_type, slop, max_edits) in itertools.product(grid["queries"], query_types):
+                    # a new parser per run, since boolean_and queries change the default operator of the parser
+                    query_parser = QueryParser(get_field_name(analyzer_type, grid["multi_field"]), analyzer)
+                    rankings_file_name = create_rankings_file_name(run_name, queries_file, query_type, slop=slop,
+                                                                   max_edits=max_edits)
+                    rankings_file = os.path.join(grid["ranking_dir"], rankings_file_name)
+                    if grid["warmup_queries"] > 0 and full_index_path not in warmed_up:
+                        # warm up every index once, with the queries of the first run searching it
+                        with metrics.timer("warmup"):
+                            warmup_searcher(searcher, query_parser, queries_file, grid["warmup_queries"],
+                                            delimiter=get_queries_delimiter(queries_file), top_k=grid["top_k"],
+                                            query_type=query_type, maxEdits=max_edits, slop=slop,
+                                            search_mode=grid["search_mode"],
+                                            total_hits_threshold=grid["total_hits_threshold"],
+                                            shingles=grid["shingles"])
+                        warmed_up.add(full_index_path)
+                    start_time = time.time()
+                    phase_totals = metrics.phase_totals()
+                    run = rank_queries_from_file(index_searcher=searcher, query_parser=query_parser,
+                                                 input_file=queries_file, output_file=rankings_file,
+                                                 delimiter=get_queries_delimiter(queries_file), top_k=grid["top_k"],
+                                                 query_type=query_type, maxEdits=max_edits, slop=slop,
+                                                 num_threads=grid["search_threads"],
+                                                 doc_id_lookup=doc_id_lookups[full_index_path],
+                                                 result_cache=result_cache, index_name=full_index_path,
+                                                 analyzer_name=analyzer_type, chunk_size=grid["query_chunk_size"],
+                                                 fuzzy_cache=fuzzy_cache, search_mode=grid["search_mode"],
+                                                 total_hits_threshold=grid["total_hits_threshold"],
+                                                 query_cache=query_cache, shingles=grid["shingles"],
+                                                 duplicates=duplicate_maps.get(full_index_path))
+                    elapsed_time = time.time() - start_time
+                    logging.info(f"Run '{rankings_file_name}' took {elapsed_time:.2f} seconds")
+                    if run is not None and grid["run_formats"]:
+                        run_writer.submit(run, os.path.splitext(rankings_file)[0], grid["run_formats"],
+                                          run_tag=os.path.splitext(rankings_file_name)[0])
+                    run_config = {"data_dir": grid["data_dir"], "analyzer": analyzer_type,
+                                  "similarity": similarity_type, "k1": k1, "b": b, "queries": queries_file,
+                                  "query_type": query_type, "slop": slop, "maxEdits": max_edits,
+                                  "index": full_index_path, "top_k": grid["top_k"],
+                                  "search_mode": grid["search_mode"], "search_threads": grid["search_threads"],
+                                  "multi_field": grid["multi_field"], "shingles": grid["shingles"],
+                                  "shards": grid["shards"], "dedup_threshold": grid["dedup_threshold"]}
+                    timings = {phase: total - phase_totals.get(phase, 0.0)
+                               for phase, total in metrics.phase_totals().items()}
+                    record_evaluation(rankings_file, rankings_file_name, reference_file=grid["reference_file"],
+                                      results_store=results_store, elapsed_time=elapsed_time, run=run,
+                                      run_config=run_config, timings=timings)
+                    nr_runs += 1
+        if grid["export_evaluation"] and grid["evaluation_file"] is not None:
+            results_store.export_csv(grid["evaluation_file"])
+    finally:
+        run_writer.close()
+        results_store.close()
+        if query_cache is not None:
+            query_cache.save()
+        for reader in readers.values():
+            reader.close()
+        if search_executor is not None:
+            search_executor.shutdown()
+    metrics.log_summary()
+    if grid["metrics_file"] is not None:
+        metrics.save(grid["metrics_file"])
+    return nr_runs
+
+
+def main(args: Union[str, List[str]] = None) -> int:
+    parser = configargparse.ArgParser(description="IR: assignment 2, parameter sweep")
+    parser.add_argument("grid", help="YAML file describing the grid of configurations to run.")
+    parsed_args = parser.parse_args(args)
+
+    start_time = time.time()
+    grid = load_grid(parsed_args.grid)
+    nr_runs = run_sweep(grid)
+    logging.info(f"Sweep of {nr_runs} runs completed in {time.time() - start_time:.2f} seconds")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
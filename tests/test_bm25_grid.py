@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("lucene")
+
+from src.bm25_grid import score_queries, sweep_bm25  # noqa: E402
+from src.evaluate import evaluate_arrays  # noqa: E402
+
+PARAMETERS = [(k1, b) for k1 in (0.5, 1.2, 2.0) for b in (0.0, 0.75, 1.0)]
+K_LIST = (1, 3, 5, 10)
+
+
+def create_export(rng, nr_docs=200, nr_terms=30, nr_queries=40):
+    postings_docs, postings_freqs, term_offsets = [], [], [0]
+    for _ in range(nr_terms):
+        docs = np.sort(rng.choice(nr_docs, rng.integers(0, 50), replace=False)).astype(np.int32)
+        postings_docs.append(docs)
+        postings_freqs.append(rng.integers(1, 5, len(docs)).astype(np.float32))
+        term_offsets.append(term_offsets[-1] + len(docs))
+    query_terms, query_offsets = [], [0]
+    for _ in range(nr_queries):
+        query_terms.extend(rng.choice(nr_terms, rng.integers(0, 4), replace=False))
+        query_offsets.append(len(query_terms))
+    return {
+        "doc_ids": rng.permutation(nr_docs).astype(np.int64) + 1000,
+        "norms": rng.integers(0, 256, nr_docs).astype(np.uint8),
+        "length_table": np.arange(1, 257, dtype=np.float32),
+        "term_offsets": np.array(term_offsets, dtype=np.int64),
+        "term_idfs": rng.random(nr_terms).astype(np.float32),
+        "postings_docs": np.concatenate(postings_docs),
+        "postings_freqs": np.concatenate(postings_freqs),
+        "query_numbers": np.arange(1, nr_queries + 1, dtype=np.int64),
+        "query_offsets": np.array(query_offsets, dtype=np.int64),
+        "query_terms": np.array(query_terms, dtype=np.int64),
+        "query_boosts": np.ones(len(query_terms), dtype=np.float32),
+        "sum_total_term_freq": 4000,
+        "doc_count": nr_docs,
+    }
+
+
+@pytest.mark.parametrize("top_k", [5, 10, 20])
+def test_sweep_matches_evaluate_arrays(tmp_path, top_k):
+    rng = np.random.default_rng(0)
+    export = create_export(rng)
+    # reference results for some queries that are not in the export too, partly among the ranked documents
+    reference = [(query_number, int(rng.choice(export["doc_ids"][:60])))
+                 for query_number in range(1, 46) for _ in range(rng.integers(0, 15))]
+    reference_file = tmp_path / "reference.csv"
+    pd.DataFrame(reference, columns=["Query_number", "doc_number"]).to_csv(reference_file, index=False)
+    expected_queries = np.array([query_number for query_number, _ in reference], dtype=np.int64)
+    expected_docs = np.array([doc for _, doc in reference], dtype=np.int64)
+
+    sweep = sweep_bm25(export, PARAMETERS, str(reference_file), top_k=top_k, k_list=K_LIST, chunk_size=4)
+
+    rankings = list(score_queries(export, PARAMETERS, top_k=top_k))
+    for parameter, (k1, b) in enumerate(PARAMETERS):
+        result_queries, result_docs = [], []
+        for query, top_docs in rankings:
+            ranked = top_docs[parameter][top_docs[parameter] >= 0]
+            result_queries.extend([export["query_numbers"][query]] * len(ranked))
+            result_docs.extend(export["doc_ids"][ranked])
+        evaluations = evaluate_arrays(np.array(result_queries, dtype=np.int64), np.array(result_docs, dtype=np.int64),
+                                      expected_queries, expected_docs, K_LIST)
+        for k, evaluation in evaluations.items():
+            row = sweep[(sweep["k1"] == k1) & (sweep["b"] == b) & (sweep["k"] == k)].iloc[0]
+            assert row["MAP@K"] == pytest.approx(evaluation.map_at_k)
+            assert row["MAR@K"] == pytest.approx(evaluation.mar_at_k)
@@ -0,0 +1,39 @@
+import json
+
+import pytest
+
+pytest.importorskip("lucene")
+
+from src import query_cache  # noqa: E402
+from src.query_cache import ParsedQueryCache  # noqa: E402
+
+KEY = ("signature", "text_content", "term", 0, 0, "white house")
+STRUCTURE = {"term": ["text_content", "white"]}
+
+
+@pytest.fixture(autouse=True)
+def rebuild_without_jvm(monkeypatch):
+    monkeypatch.setattr(query_cache, "query_from_dict", lambda structure: ("query", json.dumps(structure)))
+
+
+def write_cache_file(tmp_path):
+    cache_file = tmp_path / "queries.json"
+    cache_file.write_text(json.dumps({ParsedQueryCache._to_string(KEY): STRUCTURE}), encoding="utf-8")
+    return str(cache_file)
+
+
+def test_size_zero_cache_rebuilds_queries_from_file(tmp_path):
+    cache = ParsedQueryCache(max_entries=0, cache_file=write_cache_file(tmp_path))
+    assert cache.get(KEY) == ("query", json.dumps(STRUCTURE))
+    assert cache.get(KEY) == ("query", json.dumps(STRUCTURE))
+    assert len(cache) == 0
+    assert cache.hits == 2
+
+
+def test_rebuilt_queries_are_kept_in_memory(tmp_path):
+    cache = ParsedQueryCache(max_entries=1, cache_file=write_cache_file(tmp_path))
+    query = cache.get(KEY)
+    assert cache.get(KEY) is query
+    assert len(cache) == 1
+    assert cache.get(KEY[:-1] + ("other",)) is None
+    assert cache.misses == 1
@@ -0,0 +1,86 @@
+import pytest
+
+pytest.importorskip("lucene")
+
+from src import server  # noqa: E402
+
+
+class FakeReader:
+    def __init__(self):
+        self.references = 1
+
+    def incRef(self):
+        self.references += 1
+
+    def decRef(self):
+        self.references -= 1
+
+    def equals(self, other):
+        return self is other
+
+
+class FakeSearcher:
+    def __init__(self, reader):
+        self.reader = reader
+
+    def getIndexReader(self):
+        return self.reader
+
+
+class FakeSearcherManager:
+    """Like Lucene's SearcherManager, maybeRefresh returns True whenever it gets the lock, changed or not."""
+
+    def __init__(self):
+        self.reader = FakeReader()
+        self.pending = False
+
+    def acquire(self):
+        self.reader.incRef()
+        return FakeSearcher(self.reader)
+
+    def release(self, searcher):
+        searcher.reader.decRef()
+
+    def maybeRefresh(self):
+        if self.pending:
+            old_reader, self.reader, self.pending = self.reader, FakeReader(), False
+            old_reader.decRef()
+        return True
+
+    def close(self):
+        self.reader.decRef()
+
+
+class FakeDocIdLookup:
+    def __init__(self, reader, preload=False):
+        self.reader = reader
+
+
+@pytest.fixture
+def service(monkeypatch):
+    monkeypatch.setattr(server, "SearcherManager", lambda directory, factory: FakeSearcherManager())
+    monkeypatch.setattr(server, "open_directory", lambda *args: None)
+    monkeypatch.setattr(server, "get_shard_paths", lambda index_path, shards: [index_path])
+    monkeypatch.setattr(server, "DocIdLookup", FakeDocIdLookup)
+    monkeypatch.setattr(server.IndexSearcher, "cast_", staticmethod(lambda searcher: searcher), raising=False)
+    search_service = server.SearchService("index", "standard")
+    yield search_service
+    search_service.close()
+
+
+def test_idle_refresh_keeps_generation(service):
+    generation, reader, doc_id_lookup = service.generation, service._reader, service._doc_id_lookup
+    service.refresh()
+    service.refresh()
+    assert service.generation == generation
+    assert service._reader is reader
+    assert service._doc_id_lookup is doc_id_lookup
+
+
+def test_refresh_swaps_generation_when_shard_changed(service):
+    generation, old_reader = service.generation, service._reader
+    service._managers[0].pending = True
+    service.refresh()
+    assert service.generation == generation + 1
+    assert service._reader is service._managers[0].reader
+    assert old_reader.references == 0